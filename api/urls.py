@@ -19,8 +19,12 @@ urlpatterns = [
     # Store Endpoints
     path('category/', store_views.CategoryListAPIView.as_view()),
     path('products/', store_views.ProductListAPIView.as_view()),
+    path('products/batch/', store_views.ProductBatchAPIView.as_view()),
+    path('products/export/', store_views.ProductExportAPIView.as_view()),
     path('products/<pid>/', store_views.ProductDetailAPIView.as_view()),
+    path('products/<pid>/related/', store_views.RelatedProductsAPIView.as_view()),
     path('cart-view/', store_views.CartAPIView.as_view()),
+    path('cart-view/batch/', store_views.CartBatchAPIView.as_view()),
     path('cart-list/<str:cart_id>/<int:user_id>/',
          store_views.CartListView.as_view()),
     path('cart-list/<str:cart_id>/', store_views.CartListView.as_view()),
@@ -37,6 +41,7 @@ urlpatterns = [
     path('reviews/<product_id>/', store_views.ReviewListAPIView.as_view()),
     path('create-review/', store_views.ReviewRatingAPIView.as_view()),
     path('search/', store_views.SearchProductsAPIView.as_view()),
+    path('search/suggest/', store_views.SearchSuggestAPIView.as_view()),
 
     # Payment Endpoints
     path('stripe-checkout/<order_oid>/',
@@ -110,6 +115,8 @@ urlpatterns = [
          vendor_views.ShopProductsAPIView.as_view()),
     path('vendor-create-product/<vendor_id>/',
          vendor_views.ProductCreateView.as_view()),
+    path('vendor-import-products/<vendor_id>/',
+         vendor_views.ProductImportAPIView.as_view()),
     path('vendor-product-edit/<vendor_id>/<product_id>/',
          vendor_views.ProductUpdateAPIView.as_view()),
     path('vendor-product-delete/<vendor_id>/<product_id>/',
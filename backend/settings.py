@@ -184,7 +184,10 @@ AWS_SECRET_ACCESS_KEY = env("AWS_SECRET_ACCESS_KEY")
 AWS_STORAGE_BUCKET_NAME = env("AWS_STORAGE_BUCKET_NAME")
 AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = 'public-read'
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+# Uploads are named after their content and stored once, see store/storage.py
+DEFAULT_FILE_STORAGE = 'store.storage.MediaStorage'
+# Media URLs remembered per process by the storage
+MEDIA_URL_CACHE_SIZE = env.int("MEDIA_URL_CACHE_SIZE", 10000)
 STATICFILES_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 AWS_S3_OBJECT_PARAMETERS = {'CacheControl': 'max-age=86400'}
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
@@ -194,6 +197,55 @@ STATIC_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/{STATIC_LOCATION}/'
 
 SITE_URL = env("SITE_URL")
 
+REST_FRAMEWORK = {
+    # Opt-in: lists are only paginated when `cursor` or `page_size` is sent
+    'DEFAULT_PAGINATION_CLASS': 'store.pagination.KeysetPagination',
+    'PAGE_SIZE': 20,
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds a serialized product detail stays cached; changes to the product,
+# its gallery/colors/sizes/specifications or reviews invalidate it earlier
+PRODUCT_DETAIL_CACHE_TIMEOUT = env.int("PRODUCT_DETAIL_CACHE_TIMEOUT", 60 * 5)
+
+# Product.views is counted in memory and written in batches: every
+# FLUSH_INTERVAL seconds, or once MAX_PENDING products are waiting. Set
+# DEDUPE_SECONDS to count repeat views by the same visitor only once.
+PRODUCT_VIEWS_FLUSH_INTERVAL = env.int("PRODUCT_VIEWS_FLUSH_INTERVAL", 10)
+PRODUCT_VIEWS_MAX_PENDING = env.int("PRODUCT_VIEWS_MAX_PENDING", 10000)
+PRODUCT_VIEWS_DEDUPE_SECONDS = env.int("PRODUCT_VIEWS_DEDUPE_SECONDS", 0)
+
+# Seconds the in-memory search indexes and tax rates go between reads of
+# their shared versions, so changes made through other workers reach them
+# within that time
+VERSION_CHECK_INTERVAL = env.int("VERSION_CHECK_INTERVAL", 5)
+
+# Resized copies of product and gallery images (store/images.py), rendered
+# after each upload by WORKERS spawned processes, or by a background thread
+# of the web process when WORKERS is 0. FORMATS the Pillow build can't
+# encode are skipped.
+IMAGE_DERIVATIVES_ENABLED = env.bool("IMAGE_DERIVATIVES_ENABLED", True)
+IMAGE_DERIVATIVE_WORKERS = env.int("IMAGE_DERIVATIVE_WORKERS", 2)
+IMAGE_DERIVATIVE_FORMATS = env.list("IMAGE_DERIVATIVE_FORMATS", ["webp"])
+
+# Carts without a user kept in the ALIAS cache instead of the Cart table
+# until checkout (store/carts.py), for TIMEOUT seconds after their last
+# change and with at most MAX_ITEMS products. The cache must be shared by
+# all workers (Redis, file based), not the local-memory one.
+CART_CACHE_ENABLED = env.bool("CART_CACHE_ENABLED", False)
+CART_CACHE_ALIAS = env("CART_CACHE_ALIAS", "default")
+CART_CACHE_TIMEOUT = env.int("CART_CACHE_TIMEOUT", 60 * 60 * 24 * 7)
+CART_CACHE_MAX_ITEMS = env.int("CART_CACHE_MAX_ITEMS", 100)
+
+# Cart items added more than this many days ago are deleted by purge_carts
+# (run by the Procfile's clock process)
+CART_MAX_AGE_DAYS = env.int("CART_MAX_AGE_DAYS", 30)
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=5),
@@ -14,3 +14,15 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory search indexes and tax rates before the first
+# request needs them, and write buffered product views periodically
+from store.fuzzy import trigram_index  # noqa: E402
+from store.suggest import suggest_index  # noqa: E402
+from store.taxes import tax_rates  # noqa: E402
+from store.viewcounts import view_counter  # noqa: E402
+
+suggest_index.warm()
+trigram_index.warm()
+tax_rates.warm()
+view_counter.start()
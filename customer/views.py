@@ -7,6 +7,7 @@ from userauths.models import Profile, User
 from userauths.serializer import ProfileSerializer
 
 from store.models import Product, Category, Cart, Tax, CartOrder, CartOrderItem, Coupon, Notification, Review, Wishlist
+from store.fieldsets import SparseFieldsetViewMixin
 from store.serializer import ProductSerializer, CategorySerializer, CartSerializer, CartOrderSerializer, CartOrderItemSerializer, CouponSerializer, ReviewSerializer, WishlistSerializer, NotificationSerializer
 
 from rest_framework import generics, status
@@ -19,7 +20,7 @@ import stripe
 import requests
 
 
-class OrdersAPIView(generics.ListAPIView):
+class OrdersAPIView(SparseFieldsetViewMixin, generics.ListAPIView):
     serializer_class = CartOrderSerializer
     permission_classes = [AllowAny]
 
@@ -31,7 +32,7 @@ class OrdersAPIView(generics.ListAPIView):
         return orders
 
 
-class OrdersDetailAPIView(generics.RetrieveAPIView):
+class OrdersDetailAPIView(SparseFieldsetViewMixin, generics.RetrieveAPIView):
     serializer_class = CartOrderSerializer
     permission_classes = [AllowAny]
 
@@ -41,7 +42,7 @@ class OrdersDetailAPIView(generics.RetrieveAPIView):
 
         user = User.objects.get(id=user_id)
 
-        order = CartOrder.objects.get(
+        order = self.filter_queryset(CartOrder.objects.all()).get(
             buyer=user, payment_status="paid", oid=order_oid)
         return order
 
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+
+    def ready(self):
+        # Registers the cache invalidation, search index, image derivative,
+        # stored file reference and tax rate signal handlers
+        from store import cache, fuzzy, images, search, storage, suggest, taxes  # noqa: F401
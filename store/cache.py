@@ -0,0 +1,334 @@
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from store.models import CacheVersion, Product, Category, Gallery, Color, Size, Specification, Review, CartOrder, CartOrderItem
+from userauths.models import User
+from vendor.models import Vendor
+
+
+def get_cache():
+    return caches[getattr(settings, "PRODUCT_CACHE_ALIAS", "default")]
+
+
+def get_timeout():
+    return getattr(settings, "PRODUCT_DETAIL_CACHE_TIMEOUT", 60 * 5)
+
+
+def get_check_interval():
+    # Seconds an in-memory copy (the search indexes, the tax rates) goes
+    # without reading its shared version again
+    return getattr(settings, "VERSION_CHECK_INTERVAL", 5)
+
+
+# How long a rebuild may hold the single-flight lock, and how often the
+# requests waiting on it look for the result.
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+# Process-local hit/miss counters, see stats()
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def count(name):
+    count_many(name, 1)
+
+
+def count_many(name, n):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# The version of a resource without a CacheVersion row: rows are only
+# written when something changes, never when a version is read
+INITIAL_VERSION = (0.0, "0")
+
+
+def new_version():
+    return time.time(), uuid.uuid4().hex
+
+
+def new_version_rows(names):
+    rows = []
+    for name in names:
+        timestamp, token = new_version()
+        rows.append(CacheVersion(name=name, timestamp=timestamp, token=token))
+    return rows
+
+
+def get_versions(*names):
+    """
+    Return the current version of each named resource as a
+    `(timestamp, token)` pair.
+
+    A version is replaced whenever the resource changes, so everything
+    derived from the old one (cached payloads, ETags) goes stale at once,
+    including a payload written by a rebuild that raced with the change.
+    The timestamp is when it last changed.
+
+    Versions are CacheVersion rows, read with one query: the cache may be
+    local to a worker, but every worker and management command changes
+    and sees the same rows. A resource that never changed has no row and
+    is at INITIAL_VERSION, so reads (of unknown pids, say) add no rows.
+    """
+    names = list(dict.fromkeys(names))
+    versions = dict.fromkeys(names, INITIAL_VERSION)
+    versions.update(
+        (name, (timestamp, token))
+        for name, timestamp, token in CacheVersion.objects.filter(
+            name__in=names).values_list("name", "timestamp", "token"))
+    return versions
+
+
+def bump_versions(*names):
+    # Sorted, so concurrent bumps lock the rows in the same order
+    CacheVersion.objects.bulk_create(
+        new_version_rows(sorted(set(names))), batch_size=1000, update_conflicts=True,
+        unique_fields=["name"], update_fields=["timestamp", "token"])
+
+
+def advance_version(name, expected):
+    """
+    Replace the version of `name` only if it is still `expected`, and
+    return the new one; None when it changed in the meantime.
+    """
+    timestamp, token = new_version()
+    if expected == INITIAL_VERSION:
+        # No row yet, unless another worker created it meanwhile
+        row, updated = CacheVersion.objects.get_or_create(
+            name=name, defaults={"timestamp": timestamp, "token": token})
+    else:
+        updated = CacheVersion.objects.filter(name=name, token=expected[1]).update(
+            timestamp=timestamp, token=token)
+    return (timestamp, token) if updated else None
+
+
+class SharedIndexMixin:
+    """
+    For in-memory indexes rebuilt when the shared version `version_name`
+    moves. They keep `lock`, `built`, the `version` they were built from
+    and when they last `checked` it.
+    """
+    version_name = None
+    checked = None
+
+    def stale_version(self):
+        """
+        The shared version to build the index from, or None while it is
+        current. A built index reads the version at most once every
+        VERSION_CHECK_INTERVAL seconds, so other workers' changes reach it
+        within that time instead of costing a query per lookup.
+        """
+        now = time.monotonic()
+        if self.built and self.checked is not None and now - self.checked < get_check_interval():
+            return None
+        version = get_versions(self.version_name)[self.version_name]
+        if self.built and self.version == version:
+            self.checked = now
+            return None
+        return version
+
+    def apply(self, change, *args):
+        """
+        Apply a committed change to this worker's index with
+        `change(*args)` and move the shared version, so the other workers
+        rebuild theirs. When nothing else moved it since this index was
+        built, the patched index stays current; otherwise it is rebuilt on
+        next use too.
+        """
+        with self.lock:
+            if self.built:
+                change(*args)
+                version = advance_version(self.version_name, self.version)
+                if version is not None:
+                    self.version = version
+                    return
+                self.built = False
+        bump_versions(self.version_name)
+
+
+def product_versions(pid):
+    # Everything a product detail renders: the product and its children,
+    # plus the category and vendor nested in it
+    return get_versions(f"product:{pid}", "categories", "vendors")
+
+
+def detail_key(pid, request, versions=None):
+    # Serialized payloads contain absolute URLs, so they are kept per host
+    if versions is None:
+        versions = product_versions(pid)
+    tokens = ":".join(token for _, token in sorted(versions.values()))
+    return f"product:{pid}:detail:{tokens}:{request.scheme}://{request.get_host()}"
+
+
+def get_product_detail(pid, request, build, versions=None):
+    """
+    Return the cached detail payload for `pid`, calling `build()` to
+    serialize it on a miss. `versions` are its product_versions(), when
+    the caller already read them.
+
+    Only one caller rebuilds a given payload at a time: the others wait
+    for its result (up to LOCK_TIMEOUT) instead of all hitting the
+    database when a popular product expires.
+    """
+    cache = get_cache()
+    key = detail_key(pid, request, versions)
+
+    data = cache.get(key)
+    if data is not None:
+        count("hits")
+        return data
+    count("misses")
+
+    lock_key = key + ":lock"
+    if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            data = cache.get(key)
+            if data is not None:
+                count("coalesced")
+                return data
+            if cache.get(lock_key) is None:
+                break
+        # The rebuild failed or took too long; do it ourselves
+
+    try:
+        data = build()
+        cache.set(key, data, get_timeout())
+    finally:
+        cache.delete(lock_key)
+    return data
+
+
+def get_product_details(pids, request, build):
+    """
+    Return `{pid: payload}` for the cached detail payloads of `pids`,
+    calling `build(missing_pids)` once for the rest and caching what it
+    returns. Pids `build` doesn't know are left out.
+
+    Versions and payloads are each read with one `get_many`. Misses are
+    rebuilt together without the single-flight lock: one batch query is
+    already cheap next to a stampede of single lookups.
+    """
+    cache = get_cache()
+    versions = get_versions("categories", "vendors", *[f"product:{pid}" for pid in pids])
+    keys = {
+        pid: detail_key(pid, request, {
+            name: versions[name] for name in (f"product:{pid}", "categories", "vendors")
+        })
+        for pid in pids
+    }
+
+    cached = cache.get_many(list(keys.values()))
+    details = {pid: cached[key] for pid, key in keys.items() if key in cached}
+    count_many("hits", len(details))
+
+    missing = [pid for pid in pids if pid not in details]
+    if missing:
+        count_many("misses", len(missing))
+        built = build(missing)
+        cache.set_many({keys[pid]: data for pid, data in built.items()}, get_timeout())
+        details.update(built)
+    return details
+
+
+def invalidate_product_ids(*product_ids):
+    product_ids = {pk for pk in product_ids if pk is not None}
+    if not product_ids:
+        return
+
+    pids = list(Product.objects.filter(
+        pk__in=product_ids).values_list("pid", flat=True))
+    invalidate_soon(*pids)
+
+
+def invalidate_soon(*pids):
+    pids = [pid for pid in pids if pid]
+    if pids:
+        bump_soon("products", *(f"product:{pid}" for pid in pids))
+
+
+def bump_soon(*names):
+    # Once the transaction commits (right away outside of one): other
+    # workers can't see the change before, and bumping inside it would
+    # hold the version rows locked until then
+    transaction.on_commit(lambda: bump_versions(*names))
+
+
+# Signal handlers replacing the versions of what a change affects
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_detail(sender, instance, **kwargs):
+    invalidate_soon(instance.pid)
+
+
+@receiver(post_save, sender=Gallery)
+@receiver(post_delete, sender=Gallery)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+@receiver(post_save, sender=CartOrderItem)
+@receiver(post_delete, sender=CartOrderItem)
+def invalidate_product_child(sender, instance, **kwargs):
+    invalidate_product_ids(instance.product_id)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_product(sender, instance, **kwargs):
+    # The rating counters of the product the review moved away from change too
+    previous = getattr(instance, "_previous_rating", None)
+    invalidate_product_ids(instance.product_id, previous[0] if previous else None)
+
+
+@receiver(post_save, sender=CartOrder)
+def invalidate_order_products(sender, instance, **kwargs):
+    # Paying for (or refunding) an order changes the products' order_count
+    was_paid = getattr(instance, "_previous_payment_status", None) == "paid"
+    if was_paid == (instance.payment_status == "paid"):
+        return
+    invalidate_product_ids(*CartOrderItem.objects.filter(
+        order=instance).values_list("product_id", flat=True))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_categories(sender, instance, **kwargs):
+    bump_soon("categories")
+
+
+@receiver(post_save, sender=Vendor)
+@receiver(post_delete, sender=Vendor)
+def invalidate_vendors(sender, instance, **kwargs):
+    bump_soon("vendors")
+
+
+@receiver(post_save, sender=User)
+def invalidate_vendor_user(sender, instance, created, **kwargs):
+    # Vendors are rendered with their user nested in them
+    if not created and Vendor.objects.filter(user_id=instance.pk).exists():
+        bump_soon("vendors")
@@ -0,0 +1,196 @@
+import hashlib
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from store.models import Cart, CartQuerySet, Product
+
+# Cart columns kept for each cached item, besides its product
+COLUMNS = (
+    "qty", "price", "sub_total", "shipping_amount", "tax_fee", "service_fee", "total",
+    "country", "size", "color", "date", "updated",
+)
+
+
+class CartFull(Exception):
+    pass
+
+
+class CartBusy(APIException):
+    # Another request held the cart's lock for longer than we wait; the
+    # view answers 409 and the client retries
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The cart is being changed by another request, try again."
+    default_code = "cart_busy"
+
+
+def clean(cart):
+    # The cached columns as the table would return them: request strings
+    # converted, amounts rounded to their decimal places (so cached and
+    # saved carts add up to the same totals)
+    for column in COLUMNS:
+        field = Cart._meta.get_field(column)
+        value = field.to_python(getattr(cart, column))
+        if field.get_internal_type() == "DecimalField" and value is not None:
+            value = value.quantize(Decimal(10) ** -field.decimal_places)
+        setattr(cart, column, value)
+
+
+def cart_totals(carts):
+    # CartQuerySet.totals() of cart instances
+    cent = Decimal("0.01")
+    return {
+        key: sum((getattr(cart, column) or Decimal(0) for cart in carts), Decimal(0)).quantize(cent)
+        for key, column in CartQuerySet.TOTALS.items()
+    }
+
+
+class CartStore:
+    """
+    Carts without a user, kept in Django's cache rather than the Cart
+    table until checkout.
+
+    Most anonymous carts are never ordered, so adding to them writes one
+    cache entry per cart, `{product_id: {column: value}}`, instead of a
+    Cart row per product. The entry expires CART_CACHE_TIMEOUT seconds
+    after its last change and holds at most CART_CACHE_MAX_ITEMS products.
+    Cached items are returned as unsaved Cart instances whose id is their
+    product's id. `materialize()` writes a cart to the table when it is
+    ordered.
+
+    Changes to one cart are serialized by a short lived lock entry; a
+    change that can't get it within a second raises CartBusy (a 409). A
+    cart the cache doesn't know starts from its rows in the table, if
+    any, so carts saved before the cache was enabled carry over.
+    """
+
+    def is_enabled(self):
+        return getattr(settings, "CART_CACHE_ENABLED", False)
+
+    def get_cache(self):
+        return caches[getattr(settings, "CART_CACHE_ALIAS", "default")]
+
+    def get_timeout(self):
+        return getattr(settings, "CART_CACHE_TIMEOUT", 60 * 60 * 24 * 7)
+
+    def get_max_items(self):
+        return getattr(settings, "CART_CACHE_MAX_ITEMS", 100)
+
+    def key(self, cart_id):
+        # cart_id is up to 1000 characters, more than cache keys may be
+        return "cart:" + hashlib.sha256(cart_id.encode()).hexdigest()
+
+    @contextmanager
+    def lock(self, cart_id):
+        cache = self.get_cache()
+        key = self.key(cart_id) + ":lock"
+        for attempt in range(100):
+            # Expires on its own if its holder dies
+            if cache.add(key, 1, timeout=5):
+                break
+            time.sleep(0.01)
+        else:
+            raise CartBusy()
+        try:
+            yield
+        finally:
+            cache.delete(key)
+
+    def load(self, cart_id):
+        return self.get_cache().get(self.key(cart_id))
+
+    def save(self, cart_id, items):
+        # An emptied cart stays cached, rather than showing its old rows
+        self.get_cache().set(self.key(cart_id), items, self.get_timeout())
+
+    def clear(self, cart_id):
+        self.get_cache().delete(self.key(cart_id))
+
+    def instances(self, cart_id, items):
+        carts = []
+        for product_id, values in items.items():
+            cart = Cart(cart_id=cart_id, product_id=product_id, **values)
+            cart.pk = product_id
+            carts.append(cart)
+        return carts
+
+    def get(self, cart_id):
+        # The cart's items, None when the cache doesn't have the cart
+        items = self.load(cart_id)
+        if items is None:
+            return None
+        return self.instances(cart_id, items)
+
+    def seed(self, cart_id):
+        return {
+            cart.product_id: {column: getattr(cart, column) for column in COLUMNS}
+            for cart in Cart.objects.filter(cart_id=cart_id, user=None).order_by("pk")
+        }
+
+    def add(self, cart_id, carts):
+        """
+        Save each of `carts` as the cached item for its product, like
+        `Cart.objects.upsert()`: an item already there is replaced but
+        keeps its date. Returns whether each item was created, or raises
+        CartFull without changing anything when the cart would hold too
+        many products.
+        """
+        with self.lock(cart_id):
+            items = self.load(cart_id)
+            if items is None:
+                items = self.seed(cart_id)
+            new = {cart.product_id for cart in carts} - items.keys()
+            if len(items) + len(new) > self.get_max_items():
+                raise CartFull(f"A cart holds at most {self.get_max_items()} products")
+
+            created = []
+            now = timezone.now()
+            for cart in carts:
+                previous = items.get(cart.product_id)
+                cart.date = previous["date"] if previous else now
+                cart.updated = now
+                clean(cart)
+                items[cart.product_id] = {column: getattr(cart, column) for column in COLUMNS}
+                cart.pk = cart.product_id
+                created.append(previous is None)
+            self.save(cart_id, items)
+        return created
+
+    def remove(self, cart_id, product_id):
+        with self.lock(cart_id):
+            items = self.load(cart_id)
+            if items is None or items.pop(product_id, None) is None:
+                return False
+            self.save(cart_id, items)
+        return True
+
+    def materialize(self, cart_id):
+        """
+        Write the cached cart to the Cart table, so the order is built from
+        rows as before: its items are upserted and the cart's other
+        anonymous rows deleted. The cached cart is dropped once the
+        transaction commits. Returns the number of rows written.
+        """
+        with self.lock(cart_id):
+            items = self.load(cart_id)
+            if items is None:
+                return 0
+            # Products deleted since they were added are left out
+            existing = set(Product.objects.filter(pk__in=list(items)).values_list("pk", flat=True))
+            carts = [cart for cart in self.instances(cart_id, items) if cart.product_id in existing]
+            with transaction.atomic():
+                Cart.objects.filter(cart_id=cart_id, user=None).exclude(product_id__in=existing).delete()
+                Cart.objects.upsert(carts)
+                transaction.on_commit(partial(self.clear, cart_id))
+        return len(carts)
+
+
+cart_store = CartStore()
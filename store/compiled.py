@@ -0,0 +1,366 @@
+import copy
+import inspect
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.fields import (
+    Field, DateTimeField, FileField, ReadOnlyField, SkipField, empty, get_attribute, is_simple_callable)
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField, RelatedField
+from rest_framework.settings import api_settings
+
+
+class NotCompilable(Exception):
+    pass
+
+
+# Converters that can be called directly instead of the field's own
+# to_representation, keyed by the method they stand in for.
+DIRECT = {
+    serializers.CharField.to_representation: str,
+    serializers.IntegerField.to_representation: int,
+    serializers.FloatField.to_representation: float,
+    ReadOnlyField.to_representation: None,
+}
+
+# Fields whose to_representation never looks at the serializer context, so
+# a detached copy of the field can be shared between requests.
+CONTEXT_FREE = {
+    serializers.BooleanField.to_representation,
+    serializers.DecimalField.to_representation,
+    serializers.DateField.to_representation,
+    serializers.TimeField.to_representation,
+    serializers.DurationField.to_representation,
+    serializers.ChoiceField.to_representation,
+    serializers.UUIDField.to_representation,
+    serializers.JSONField.to_representation,
+}
+
+# Step modes
+RAW, PLAIN, CONTEXT = range(3)
+
+
+class Node:
+    """
+    The compiled, read-only form of one serializer.
+
+    Holds a flat list of `(name, get, convert, mode)` steps worked out once
+    from the serializer's fields, and renders an instance by running them
+    in order. Mirrors `Serializer.to_representation`: fields whose getter
+    raises `SkipField` are left out and `None` is never converted.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def render(self, instance, renderer):
+        ret = {}
+        for name, get, convert, mode in self.steps:
+            try:
+                value = get(instance)
+            except SkipField:
+                continue
+
+            if value is None or mode == RAW:
+                ret[name] = value
+            elif mode == PLAIN:
+                ret[name] = convert(value)
+            else:
+                ret[name] = convert(value, renderer)
+        return ret
+
+
+class Renderer:
+    """
+    Per-response state for rendering compiled nodes: the request used for
+    absolute file URLs, and the serializers that could not be compiled,
+    bound to this response's context.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.request = context.get('request')
+        self.timezone = timezone.get_current_timezone() if settings.USE_TZ else None
+        self.fallbacks = {}
+
+    def fallback(self, template, selection):
+        serializer = self.fallbacks.get(id(template))
+        if serializer is None:
+            serializer = copy.deepcopy(template)
+            serializer._context = self.context
+            if selection is not None:
+                serializer._selection = selection
+            self.fallbacks[id(template)] = serializer
+        return serializer
+
+
+def compile_serializer(serializer):
+    # Serializer -> Node. Raises NotCompilable for shapes the fast path does
+    # not reproduce exactly (custom to_representation, method fields, ...).
+    if type(serializer).to_representation not in (
+            serializers.Serializer.to_representation,
+            CompiledSerializerMixin.to_representation):
+        raise NotCompilable(type(serializer).__name__)
+
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    columns = {}
+    if model is not None:
+        for model_field in model._meta.concrete_fields:
+            columns[model_field.name] = model_field.attname
+
+    steps = []
+    for field in serializer._readable_fields:
+        get, convert, mode = compile_field(field, model, columns)
+        steps.append((field.field_name, get, convert, mode))
+    return Node(steps)
+
+
+def compile_field(field, model, columns):
+    field_class = type(field)
+    attrs = field.source_attrs
+
+    if isinstance(field, serializers.ListSerializer):
+        if field_class.to_representation is not serializers.ListSerializer.to_representation:
+            raise NotCompilable(field_class.__name__)
+        return make_getter(field, model), compile_many(field.child), CONTEXT
+
+    if isinstance(field, serializers.BaseSerializer):
+        return make_getter(field, model), compile_nested(field), CONTEXT
+
+    if isinstance(field, ManyRelatedField):
+        child = field.child_relation
+        if (type(field).get_attribute is not ManyRelatedField.get_attribute
+                or type(child).to_representation is not PrimaryKeyRelatedField.to_representation
+                or child.pk_field is not None):
+            raise NotCompilable(field_class.__name__)
+        return make_many_getter(field, model), pk_list, PLAIN
+
+    if isinstance(field, RelatedField):
+        if (field_class.to_representation is not PrimaryKeyRelatedField.to_representation
+                or field_class.get_attribute is not RelatedField.get_attribute
+                or not field.use_pk_only_optimization()
+                or field.pk_field is not None
+                or len(attrs) != 1
+                or attrs[0] not in columns):
+            raise NotCompilable(field_class.__name__)
+        return attrgetter(columns[attrs[0]]), None, RAW
+
+    if field_class.get_attribute is not Field.get_attribute:
+        raise NotCompilable(field_class.__name__)
+
+    if len(attrs) == 1 and attrs[0] in columns:
+        get = attrgetter(attrs[0])
+    else:
+        get = make_getter(field, model)
+
+    compiled_converter = getattr(field, 'compiled_converter', None)
+    if compiled_converter is not None:
+        # Fields providing their own `convert(value, renderer)`
+        return get, compiled_converter(), CONTEXT
+
+    representation = field_class.to_representation
+    if representation in DIRECT:
+        convert = DIRECT[representation]
+        return get, convert, RAW if convert is None else PLAIN
+    if representation in CONTEXT_FREE:
+        return get, copy.deepcopy(field).to_representation, PLAIN
+    if representation is FileField.to_representation:
+        return get, file_converter(field), CONTEXT
+    if representation is DateTimeField.to_representation:
+        return get, datetime_converter(field), CONTEXT
+    raise NotCompilable(field_class.__name__)
+
+
+def compile_nested(serializer):
+    try:
+        node = compile_serializer(serializer)
+    except NotCompilable:
+        template, selection = detach(serializer)
+        return lambda value, renderer: renderer.fallback(
+            template, selection).to_representation(value)
+    return lambda value, renderer: node.render(value, renderer)
+
+
+def compile_many(serializer):
+    try:
+        node = compile_serializer(serializer)
+    except NotCompilable:
+        template, selection = detach(serializer)
+
+        def convert(value, renderer):
+            fallback = renderer.fallback(template, selection)
+            return [fallback.to_representation(item) for item in iterate(value)]
+        return convert
+
+    render = node.render
+    return lambda value, renderer: [render(item, renderer) for item in iterate(value)]
+
+
+def detach(serializer):
+    # An unbound copy, so the cached plan does not hold on to the request
+    # the serializer was first built for.
+    return copy.deepcopy(serializer), getattr(serializer, '_selection', None)
+
+
+def iterate(value):
+    return value.all() if isinstance(value, models.manager.BaseManager) else value
+
+
+def make_getter(field, model):
+    # Same as Field.get_attribute for fields without a default
+    if field.default is not empty:
+        raise NotCompilable(type(field).__name__)
+
+    attrs = field.source_attrs
+    allow_null = field.allow_null
+    required = field.required
+
+    def get(instance):
+        try:
+            return get_attribute(instance, attrs)
+        except (KeyError, AttributeError):
+            if allow_null:
+                return None
+            if not required:
+                raise SkipField()
+            raise
+
+    if model is None or len(attrs) != 1:
+        return get
+
+    # get_attribute() inspects the signature of every value it reads to
+    # decide whether to call it. For model fields and methods that can be
+    # decided once here; anything unusual goes through the full path.
+    name = attrs[0]
+    member = inspect.getattr_static(model, name, None)
+    if inspect.isfunction(member):
+        if not is_simple_callable(member.__get__(model)):
+            return get
+
+        def get_fast(instance):
+            try:
+                return getattr(instance, name)()
+            except (KeyError, AttributeError, ObjectDoesNotExist):
+                return get(instance)
+    elif name in model_field_names(model):
+        def get_fast(instance):
+            try:
+                return getattr(instance, name)
+            except (KeyError, AttributeError, ObjectDoesNotExist):
+                return get(instance)
+    else:
+        return get
+    return get_fast
+
+
+def model_field_names(model):
+    return {
+        model_field.name for model_field in model._meta.get_fields()
+        if model_field.concrete or not model_field.auto_created
+    }
+
+
+def make_many_getter(field, model):
+    get = make_getter(field, model)
+
+    def get_many(instance):
+        if getattr(instance, 'pk', empty) is None:
+            return []
+        relationship = get(instance)
+        return relationship.all() if hasattr(relationship, 'all') else relationship
+    return get_many
+
+
+def pk_list(iterable):
+    return [value.pk for value in iterable]
+
+
+def file_converter(field):
+    use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+
+    def convert(value, renderer):
+        if not value:
+            return None
+        if not use_url:
+            return value.name
+        try:
+            url = value.url
+        except AttributeError:
+            return None
+        if renderer.request is not None:
+            return renderer.request.build_absolute_uri(url)
+        return url
+    return convert
+
+
+def datetime_converter(field):
+    # DateTimeField.to_representation with the current timezone looked up
+    # once per response instead of once per value.
+    fallback = copy.deepcopy(field).to_representation
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if hasattr(field, 'timezone') or output_format is None or output_format.lower() != ISO_8601:
+        return lambda value, renderer: fallback(value)
+
+    def convert(value, renderer):
+        if renderer.timezone is None or isinstance(value, str) or value.utcoffset() is None:
+            return fallback(value)
+        value = value.astimezone(renderer.timezone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return convert
+
+
+# Compiled nodes for the default shape of each serializer class, keyed by
+# SparseFieldsetMixin.get_shape_key(). None marks a shape that could not be
+# compiled.
+compiled_nodes = {}
+
+
+class CompiledSerializerMixin:
+    """
+    Renders model instances through a compiled Node instead of walking the
+    DRF fields for every row.
+
+    The node for a serializer's default shape is built once per process and
+    reused by every later response, so those responses never build the
+    serializer's fields at all. Shapes picked with `?fields=`/`?expand=`
+    are compiled once per response. The output is the same data the plain
+    ModelSerializer produces; anything the compiler does not recognise is
+    handed back to DRF.
+    """
+    # Set to False on an instance to force the plain DRF path
+    compiled = True
+
+    def to_representation(self, instance):
+        try:
+            render = self._compiled_render
+        except AttributeError:
+            render = self._compiled_render = self.get_compiled_render()
+
+        if render is None or not isinstance(instance, models.Model):
+            return super().to_representation(instance)
+        return render(instance)
+
+    def get_compiled_render(self):
+        if not self.compiled:
+            return None
+
+        key = self.get_shape_key()
+        if key is not None and key in compiled_nodes:
+            node = compiled_nodes[key]
+        else:
+            try:
+                node = compile_serializer(self)
+            except NotCompilable:
+                node = None
+            if key is not None:
+                compiled_nodes[key] = node
+
+        if node is None:
+            return None
+        renderer = Renderer(self.context)
+        return lambda instance: node.render(instance, renderer)
@@ -0,0 +1,54 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from store import cache as product_cache
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET/HEAD with `304 Not Modified` while the client's
+    If-None-Match / If-Modified-Since are still current.
+
+    The ETag and Last-Modified come from the version of each resource the
+    view renders (see store.cache.get_versions), so a repeat request is
+    answered with one query for the versions, which every worker shares,
+    without serializing the body. The versions are kept on the view as
+    `self.versions` for the rest of the request.
+    """
+    # Names of the versions the response depends on
+    version_names = ()
+
+    def get_versions(self):
+        return product_cache.get_versions(*self.version_names)
+
+    def get_etag(self, request, versions):
+        # The body also depends on the query string, the host (absolute
+        # URLs) and the negotiated format
+        parts = [token for name, (timestamp, token) in sorted(versions.items())]
+        parts += [
+            request.scheme,
+            request.get_host(),
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', ''),
+        ]
+        return quote_etag(hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        versions = self.versions = self.get_versions()
+        etag = self.get_etag(request, versions)
+        last_modified = int(max(timestamp for timestamp, token in versions.values()))
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        # 0 while none of the resources has changed since versions were kept
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
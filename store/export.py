@@ -0,0 +1,92 @@
+import csv
+from datetime import datetime, time
+from itertools import islice
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+
+# Columns of the CSV export, read straight off the product row
+CSV_COLUMNS = [
+    ("pid", lambda product: product.pid),
+    ("title", lambda product: product.title),
+    ("slug", lambda product: product.slug),
+    ("status", lambda product: product.status),
+    ("category", lambda product: product.category.title if product.category else ""),
+    ("vendor", lambda product: product.vendor.name if product.vendor else ""),
+    ("price", lambda product: product.price),
+    ("old_price", lambda product: product.old_price),
+    ("shipping_amount", lambda product: product.shipping_amount),
+    ("stock_qty", lambda product: product.stock_qty),
+    ("in_stock", lambda product: product.in_stock),
+    ("featured", lambda product: product.featured),
+    ("image", lambda product: product.image.name if product.image else ""),
+    ("views", lambda product: product.views),
+    ("rating_avg", lambda product: product.rating_avg),
+    ("rating_count", lambda product: product.rating_count),
+    ("order_count", lambda product: product.order_count),
+    ("date", lambda product: product.date.isoformat()),
+    ("updated", lambda product: product.updated.isoformat()),
+]
+
+FORMATS = ("ndjson", "csv")
+
+
+def parse_since(value):
+    # ISO date or datetime; naive values are in the current time zone
+    since = parse_datetime(value)
+    if since is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Not a date or datetime: {value!r}")
+        since = datetime.combine(day, time.min)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def export_queryset(queryset, updated_since=None):
+    # Oldest change first, so a pull can resume from the last `updated` it saw
+    if updated_since is not None:
+        queryset = queryset.filter(updated__gte=updated_since)
+    return queryset.order_by("updated", "id")
+
+
+def chunks(queryset, chunk_size):
+    """
+    Yield lists of at most `chunk_size` products.
+
+    `iterator(chunk_size)` streams rows from the database cursor and runs
+    the queryset's prefetches once per chunk, so only one chunk of
+    products (and their galleries, sizes, ...) is in memory at a time.
+    """
+    products = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(products, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ndjson_lines(queryset, serialize, chunk_size=500):
+    # `serialize(products)` returns the list of payloads for a chunk
+    encoder = JSONEncoder()
+    for chunk in chunks(queryset, chunk_size):
+        yield "".join(encoder.encode(item) + "\n" for item in serialize(chunk))
+
+
+class Echo:
+    # csv.writer target that hands each row back instead of buffering it
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset, chunk_size=500):
+    writer = csv.writer(Echo())
+    yield writer.writerow([name for name, value in CSV_COLUMNS])
+    queryset = queryset.select_related("category", "vendor")
+    for chunk in chunks(queryset, chunk_size):
+        yield "".join(
+            writer.writerow([value(product) for name, value in CSV_COLUMNS])
+            for product in chunk)
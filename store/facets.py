@@ -0,0 +1,202 @@
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models import CharField
+from rest_framework.response import Response
+
+
+class Facet:
+    """
+    One facet of a product list: either a column (`category`, `vendor`,
+    `in_stock`) or a set of `(low, high)` ranges over a column (`price`,
+    `rating`). The same query parameter selects values of the facet.
+    Products not matching `where` fall in no range.
+    """
+
+    def __init__(self, name, field, label=None, buckets=None, parse=int, where=None):
+        self.name = name
+        self.field = field
+        self.label = label
+        self.buckets = buckets
+        self.parse = parse
+        self.where = where
+
+    @property
+    def alias(self):
+        return f"facet_{self.name}"
+
+    def bucket_key(self, low, high):
+        return f"{low}-{high}" if high is not None else f"{low}+"
+
+    def bucket_q(self, low, high):
+        q = Q(**{f"{self.field}__gte": low})
+        if high is not None:
+            q &= Q(**{f"{self.field}__lt": high})
+        if self.where is not None:
+            q &= self.where
+        return q
+
+    def expression(self):
+        if self.buckets is None:
+            return F(self.field)
+        return Case(
+            *[When(self.bucket_q(low, high), then=Value(self.bucket_key(low, high)))
+              for low, high in self.buckets],
+            default=Value(None),
+            output_field=CharField())
+
+    def parse_values(self, raw):
+        # "3,7" -> {3, 7}; values that don't parse are dropped
+        values = set()
+        for value in raw.split(","):
+            try:
+                values.add(self.parse(value.strip()))
+            except (TypeError, ValueError):
+                pass
+        return values
+
+    def filter(self, queryset, values):
+        if self.buckets is None:
+            return queryset.filter(**{f"{self.field}__in": values})
+
+        q = Q()
+        for low, high in self.buckets:
+            if self.bucket_key(low, high) in values:
+                q |= self.bucket_q(low, high)
+        return queryset.filter(q) if q else queryset.none()
+
+    def initial_counts(self):
+        # Ranges are always listed, in order, even when empty
+        if self.buckets is None:
+            return {}
+        return {self.bucket_key(low, high): [None, 0] for low, high in self.buckets}
+
+
+def parse_bool(value):
+    value = value.lower()
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise ValueError(value)
+
+
+def parse_bucket(value):
+    if not value:
+        raise ValueError(value)
+    return value
+
+
+FACETS = {
+    facet.name: facet for facet in [
+        Facet("category", "category_id", label="category__title"),
+        Facet("vendor", "vendor_id", label="vendor__name"),
+        Facet("price", "price", parse=parse_bucket,
+              buckets=[(0, 25), (25, 50), (50, 100), (100, 250), (250, None)]),
+        Facet("in_stock", "in_stock", parse=parse_bool),
+        # Unrated products have a rating_avg of 0, not a low rating
+        Facet("rating", "rating_avg", parse=parse_bucket,
+              buckets=[(4, None), (3, 4), (2, 3), (1, 2)], where=Q(rating_count__gt=0)),
+    ]
+}
+
+
+def get_selections(request):
+    # {facet name: selected values} for every facet the request filters on
+    selections = {}
+    for name, facet in FACETS.items():
+        raw = request.query_params.get(name)
+        if raw:
+            selections[name] = facet.parse_values(raw)
+    return selections
+
+
+def apply_selections(queryset, selections):
+    for name, values in selections.items():
+        queryset = FACETS[name].filter(queryset, values)
+    return queryset
+
+
+def count_facets(queryset, names, selections):
+    """
+    Facet counts for `queryset` (the results before any facet selection).
+
+    Runs one grouped query over every facet at once, then a single pass
+    over its rows. Each facet is counted with all selections applied
+    except its own, so the other values of a facet stay visible (and
+    selectable) after one is picked.
+    """
+    facets = list(FACETS.values())
+    labels = [facet.label for facet in facets if facet.label]
+    rows = (
+        queryset.order_by()
+        .annotate(**{facet.alias: facet.expression() for facet in facets})
+        .values(*[facet.alias for facet in facets], *labels)
+        .annotate(count=Count("pk"))
+    )
+
+    counts = {name: FACETS[name].initial_counts() for name in names}
+    for row in rows:
+        matches = {
+            name: row[FACETS[name].alias] in values
+            for name, values in selections.items()
+        }
+        for name in names:
+            if not all(match for other, match in matches.items() if other != name):
+                continue
+            facet = FACETS[name]
+            value = row[facet.alias]
+            if facet.buckets is not None and value is None:
+                continue
+            entry = counts[name].setdefault(value, [None, 0])
+            if facet.label:
+                entry[0] = row[facet.label]
+            entry[1] += row["count"]
+
+    result = {}
+    for name in names:
+        facet = FACETS[name]
+        selected = selections.get(name, set())
+        entries = [
+            {"value": value, "label": label, "count": count, "selected": value in selected}
+            for value, (label, count) in counts[name].items()
+        ]
+        if facet.buckets is None:
+            entries.sort(key=lambda entry: (-entry["count"], str(entry["label"])))
+        result[name] = entries
+    return result
+
+
+class FacetedListMixin:
+    """
+    Product list views: `?category=`, `?vendor=`, `?price=`, `?in_stock=`
+    and `?rating=` filter the results, and `?facets=category,price,...`
+    adds counts for the listed facets. With facets the response becomes an
+    object: `{"results": [...], "facets": {...}}`, or the paginated object
+    with a `facets` key.
+    """
+
+    def get_requested_facets(self):
+        raw = self.request.query_params.get("facets", "")
+        return [name for name in FACETS if name in raw.split(",")]
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return apply_selections(queryset, get_selections(self.request))
+
+    def list(self, request, *args, **kwargs):
+        names = self.get_requested_facets()
+        if not names:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.get_queryset()
+        facets = count_facets(queryset, names, get_selections(request))
+
+        queryset = self.filter_queryset(queryset)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+            response.data["facets"] = facets
+            return response
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response({"results": serializer.data, "facets": facets})
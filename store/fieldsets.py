@@ -0,0 +1,219 @@
+from collections import OrderedDict
+
+from django.db.models import prefetch_related_objects
+from rest_framework import serializers
+from rest_framework.utils import model_meta
+from rest_framework.utils.field_mapping import get_nested_relation_kwargs
+
+
+def parse_paths(value):
+    # "title,vendor.name,vendor.user" -> {"title": {}, "vendor": {"name": {}, "user": {}}}
+    if value is None:
+        return None
+
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in path.strip().split('.'):
+            if part:
+                node = node.setdefault(part, {})
+    return tree
+
+
+class SparseFieldsetMixin:
+    """
+    Lets GET clients pick the shape of a ModelSerializer response.
+
+    `?fields=title,price,vendor.name` keeps only the listed fields (dotted
+    paths select inside nested objects). `?expand=vendor,vendor.user` nests
+    only the listed relations and renders every other relation as its
+    primary key; without `expand` relations are nested up to Meta.depth as
+    before. Names the serializer doesn't have are a 400, not ignored.
+
+    The depth is worked out per instance (0 for POST, Meta.depth otherwise)
+    instead of being written to the shared Meta class.
+    """
+    # Model methods rendered as nested lists, mapped to the lookups that
+    # prefetch them, e.g. {"gallery": ["gallery_set"]}
+    related_sources = {}
+    # Model methods rendered as values, mapped to the columns they read
+    source_columns = {}
+
+    def get_depth(self):
+        request = self.context.get('request')
+        if request and request.method == 'POST':
+            return 0
+        return getattr(self.Meta, 'depth', 0)
+
+    def get_selection(self):
+        if hasattr(self, '_selection'):
+            return self._selection
+
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        request = self.context.get('request')
+        if parent is not None or request is None or request.method != 'GET':
+            return None, None
+
+        fields = request.query_params.get('fields') or None
+        return parse_paths(fields), parse_paths(request.query_params.get('expand'))
+
+    def get_shape_key(self):
+        # Identifies the default rendered shape so work derived from it can
+        # be cached per process; None when the client picked its own shape.
+        only, expand = self.get_selection()
+        if only is not None or expand is not None:
+            return None
+        return type(self), self.get_depth()
+
+    def get_fields(self):
+        self.Meta = type('Meta', (self.__class__.Meta,), {'depth': self.get_depth()})
+        try:
+            fields = super().get_fields()
+        finally:
+            del self.Meta
+        return self.apply_selection(fields)
+
+    def build_nested_field(self, field_name, relation_info, nested_depth):
+        class NestedSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+            class Meta:
+                model = relation_info.related_model
+                depth = nested_depth - 1
+                fields = '__all__'
+
+        return NestedSerializer, get_nested_relation_kwargs(relation_info)
+
+    def apply_selection(self, fields):
+        only, expand = self.get_selection()
+        if only is None and expand is None:
+            return fields
+
+        for param, names in (('fields', only), ('expand', expand)):
+            unknown = sorted(set(names or ()) - set(fields))
+            if unknown:
+                raise serializers.ValidationError(
+                    {param: [f"Unknown field {name!r}." for name in unknown]})
+
+        relations = model_meta.get_field_info(self.Meta.model).relations
+        selected = OrderedDict()
+        for name, field in fields.items():
+            if only is not None and name not in only:
+                continue
+
+            source = field.source or name
+            child = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(child, SparseFieldsetMixin):
+                if expand is not None and name not in expand and source in relations:
+                    field = serializers.PrimaryKeyRelatedField(
+                        read_only=True,
+                        many=relations[source].to_many,
+                        source=None if source == name else source)
+                else:
+                    child._selection = (
+                        (only or {}).get(name) or None,
+                        None if expand is None else expand.get(name, {}),
+                    )
+            selected[name] = field
+        return selected
+
+
+# (select, prefetch) lookups for the default shape of each serializer,
+# keyed by SparseFieldsetMixin.get_shape_key()
+related_lookups = {}
+
+
+def get_related_lookups(serializer):
+    key = serializer.get_shape_key()
+    if key in related_lookups:
+        return related_lookups[key]
+    select, prefetch = set(), set()
+    collect_related(serializer, '', False, select, prefetch)
+    if key is not None:
+        related_lookups[key] = select, prefetch
+    return select, prefetch
+
+
+def optimize_queryset(queryset, serializer):
+    # Derive select_related / prefetch_related (and only() when the client
+    # asked for specific fields) from the shape the serializer will render,
+    # so unrequested relations and collections are never loaded.
+    select, prefetch = get_related_lookups(serializer)
+    if select:
+        queryset = queryset.select_related(*sorted(select))
+    if prefetch:
+        queryset = queryset.prefetch_related(*sorted(prefetch))
+
+    only, expand = serializer.get_selection()
+    columns = selected_columns(serializer, select) if only is not None else None
+    if columns is not None:
+        queryset = queryset.only(*columns)
+    return queryset
+
+
+def optimize_instances(instances, serializer):
+    # The same relations for model instances that didn't come from a
+    # queryset, loaded with a query per lookup
+    select, prefetch = get_related_lookups(serializer)
+    prefetch_related_objects(instances, *sorted(select | prefetch))
+    return instances
+
+
+def collect_related(serializer, prefix, through_many, select, prefetch):
+    relations = model_meta.get_field_info(serializer.Meta.model).relations
+    sources = getattr(serializer, 'related_sources', {})
+
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        source = field.source
+        child = field.child if isinstance(field, serializers.ListSerializer) else field
+        nested = isinstance(child, serializers.ModelSerializer)
+
+        if source in sources:
+            lookups = [prefix + lookup for lookup in sources[source]]
+            prefetch.update(lookups)
+            if nested:
+                collect_related(child, lookups[0] + '__', True, select, prefetch)
+        elif source in relations:
+            lookup = prefix + source
+            many = through_many or relations[source].to_many
+            if nested:
+                (prefetch if many else select).add(lookup)
+                collect_related(child, lookup + '__', many, select, prefetch)
+            elif isinstance(field, serializers.ManyRelatedField):
+                prefetch.add(lookup)
+
+
+def selected_columns(serializer, select):
+    info = model_meta.get_field_info(serializer.Meta.model)
+    columns = {info.pk.name}
+    sources = getattr(serializer, 'related_sources', {})
+    source_columns = getattr(serializer, 'source_columns', {})
+
+    for name, field in serializer.fields.items():
+        source = field.source
+        if source == info.pk.name or source in sources:
+            continue
+        if source in info.fields:
+            columns.add(source)
+        elif source in info.forward_relations:
+            if not info.forward_relations[source].to_many:
+                columns.add(source)
+        elif source in source_columns:
+            columns.update(source_columns[source])
+        elif source not in info.relations:
+            # A computed field we know nothing about; load every column
+            # rather than risk a query per row for deferred attributes.
+            return None
+
+    columns.update(lookup for lookup in select if '__' not in lookup)
+    return sorted(columns)
+
+
+class SparseFieldsetViewMixin:
+    # For generic views: shape the queryset after the serializer's selection
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return optimize_queryset(queryset, self.get_serializer())
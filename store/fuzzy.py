@@ -0,0 +1,244 @@
+import heapq
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from store.cache import SharedIndexMixin
+from store.models import Product
+from store.suggest import normalize
+
+logger = logging.getLogger(__name__)
+
+
+def trigrams(word):
+    # Padded like pg_trgm, so the start of a word weighs more than its end
+    padded = f"  {word} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class TrigramIndex(SharedIndexMixin):
+    """
+    Typo-tolerant matching of product titles, in the worker's memory.
+
+    Each distinct title word is listed under its trigrams. A query word
+    only looks at the posting lists of its own trigrams, so the work grows
+    with the number of words sharing a trigram with it (the candidates),
+    not with the catalog. Candidates are kept when their trigram
+    similarity (shared / all distinct trigrams, as pg_trgm computes it)
+    reaches `threshold`. A product scores the average, over the query
+    words, of its best matching title word.
+
+    Like the suggestion index, it is built on first use (or at startup),
+    follows product saves and deletes once they commit, and is rebuilt
+    when the shared "trigrams" version moves, which those saves and
+    deletes do for the other workers. Lookups check that version every
+    VERSION_CHECK_INTERVAL seconds; once built, the index is rebuilt on a
+    background thread while lookups keep using the current one.
+    """
+    threshold = 0.4
+    version_name = "trigrams"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuilding = False
+        self.reset()
+
+    def is_available(self):
+        return True
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+            self.version = None
+            self.checked = None
+
+    def _clear(self):
+        self.built = False
+        self.postings = defaultdict(set)
+        self.sizes = {}
+        self.word_products = defaultdict(set)
+        self.product_words = {}
+
+    def warm(self):
+        # Called at worker startup; a missing database leaves it to first use
+        try:
+            if get_fuzzy_backend() is self:
+                self.ensure_built()
+        except DatabaseError:
+            logger.warning("Could not build the trigram index at startup", exc_info=True)
+
+    def ensure_built(self):
+        version = self.stale_version()
+        if version is None:
+            return
+        if self.built:
+            self.start_rebuild(version)
+        else:
+            self.build(version)
+
+    def build(self, version):
+        # Into a fresh index, swapped in at the end
+        rows = list(Product.objects.filter(status="published").values_list("id", "title"))
+        fresh = TrigramIndex()
+        for id, title in rows:
+            fresh._add(id, title)
+        with self.lock:
+            self.postings, self.sizes = fresh.postings, fresh.sizes
+            self.word_products, self.product_words = fresh.word_products, fresh.product_words
+            self.built = True
+            self.version = version
+            self.checked = time.monotonic()
+
+    def start_rebuild(self, version):
+        with self.lock:
+            # Lookups stop checking the version until it's done (or, if it
+            # fails, for another interval)
+            self.checked = time.monotonic()
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild, args=(version,), name="trigram-rebuild", daemon=True).start()
+
+    def rebuild(self, version):
+        try:
+            self.build(version)
+        except Exception:
+            logger.exception("Could not rebuild the trigram index")
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    # Changes, made with the lock held
+
+    def _add(self, id, title):
+        self._remove(id)
+        words = set(normalize(title).split())
+        self.product_words[id] = words
+        for word in words:
+            if word not in self.sizes:
+                grams = trigrams(word)
+                self.sizes[word] = len(grams)
+                for gram in grams:
+                    self.postings[gram].add(word)
+            self.word_products[word].add(id)
+
+    def _remove(self, id):
+        for word in self.product_words.pop(id, ()):
+            products = self.word_products[word]
+            products.discard(id)
+            if products:
+                continue
+            # Last product using this word
+            del self.word_products[word]
+            del self.sizes[word]
+            for gram in trigrams(word):
+                words = self.postings[gram]
+                words.discard(word)
+                if not words:
+                    del self.postings[gram]
+
+    # Signal entry points, called once the change commits
+
+    def update_product(self, product):
+        if product.status == "published":
+            self.apply(self._add, product.pk, product.title)
+        else:
+            self.apply(self._remove, product.pk)
+
+    def remove_product(self, product_id):
+        self.apply(self._remove, product_id)
+
+    # Lookups
+
+    def similar_words(self, word):
+        grams = trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        similar = {}
+        for other, count in shared.items():
+            score = count / (len(grams) + self.sizes[other] - count)
+            if score >= self.threshold:
+                similar[other] = score
+        return similar
+
+    def search(self, terms, limit):
+        # Product ids, most similar first
+        words = normalize(" ".join(terms)).split()
+        if not words:
+            return []
+
+        self.ensure_built()
+        scores = defaultdict(float)
+        with self.lock:
+            for word in words:
+                best = {}
+                for other, score in self.similar_words(word).items():
+                    for id in self.word_products[other]:
+                        if score > best.get(id, 0):
+                            best[id] = score
+                for id, score in best.items():
+                    scores[id] += score
+
+        minimum = self.threshold * len(words)
+        ranked = heapq.nlargest(
+            limit, [(score, -id) for id, score in scores.items() if score >= minimum])
+        return [-id for score, id in ranked]
+
+
+class PostgresTrigramSearch:
+    """
+    pg_trgm word similarity over `Product.title`, answered from the GIN
+    index migration 0013 creates when the extension is available.
+    """
+    index = "store_product_title_trgm"
+
+    def is_available(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [self.index])
+            return cursor.fetchone() is not None
+
+    def search(self, terms, limit):
+        query = " ".join(terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id FROM {Product._meta.db_table} "
+                f"WHERE status = 'published' AND %s <%% title "
+                f"ORDER BY word_similarity(%s, title) DESC, id LIMIT %s",
+                [query, query, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+trigram_index = TrigramIndex()
+
+_backends = {}
+
+
+def get_fuzzy_backend():
+    # pg_trgm when its index exists, otherwise the in-process trigram index
+    vendor = connection.vendor
+    if vendor not in _backends:
+        backend = PostgresTrigramSearch() if vendor == "postgresql" else trigram_index
+        _backends[vendor] = backend if backend.is_available() else trigram_index
+    return _backends[vendor]
+
+
+# Signal handlers keeping the in-process trigram index in step with the
+# catalog, once the change commits
+
+
+@receiver(post_save, sender=Product)
+def index_product_trigrams(sender, instance, **kwargs):
+    transaction.on_commit(partial(trigram_index.update_product, instance))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product_trigrams(sender, instance, **kwargs):
+    transaction.on_commit(partial(trigram_index.remove_product, instance.pk))
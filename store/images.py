@@ -0,0 +1,189 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import serializers
+
+from store import imaging
+from store.cache import invalidate_product_ids
+from store.models import Product, Gallery
+
+logger = logging.getLogger(__name__)
+
+# Models with derivatives, and the column pointing at their product
+MODELS = {
+    Product: "id",
+    Gallery: "product_id",
+}
+
+
+def is_enabled():
+    return getattr(settings, "IMAGE_DERIVATIVES_ENABLED", True)
+
+
+def get_formats():
+    return imaging.supported_formats(getattr(settings, "IMAGE_DERIVATIVE_FORMATS", ["webp"]))
+
+
+def get_workers():
+    return getattr(settings, "IMAGE_DERIVATIVE_WORKERS", 2)
+
+
+class Pipeline:
+    """
+    Renders the derivatives of saved images away from the request.
+
+    A saved image is handed to a small thread pool once its transaction
+    commits. The thread reads the original from storage, sends the bytes
+    to a process pool for the CPU heavy decoding, resizing and encoding
+    (`imaging.render`), saves what comes back under content hash names
+    and records the names on the row. Both pools start on first use; the
+    processes are spawned rather than forked, as they only need Pillow.
+    With no worker processes configured the rendering happens in the
+    thread itself.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = None
+        self.processes = None
+
+    def get_threads(self):
+        with self.lock:
+            if self.threads is None:
+                self.threads = ThreadPoolExecutor(
+                    max_workers=max(get_workers(), 1), thread_name_prefix="image-derivatives")
+            return self.threads
+
+    def get_processes(self):
+        with self.lock:
+            if self.processes is None:
+                self.processes = ProcessPoolExecutor(
+                    max_workers=get_workers(), mp_context=multiprocessing.get_context("spawn"))
+            return self.processes
+
+    def schedule(self, model, pk):
+        self.get_threads().submit(self.run, model, pk)
+
+    def run(self, model, pk):
+        try:
+            self.generate(model, pk)
+        except Exception:
+            logger.exception("Could not render the image derivatives of %s %s", model.__name__, pk)
+        finally:
+            # Pool threads outlive the job, their connection shouldn't
+            connections.close_all()
+
+    def render(self, data, jobs):
+        if get_workers() <= 0:
+            return imaging.render(data, jobs)
+        try:
+            return self.get_processes().submit(imaging.render, data, jobs).result()
+        except BrokenProcessPool:
+            # A worker died (out of memory on a huge image, ...): start a
+            # fresh pool for the next job
+            with self.lock:
+                self.processes = None
+            raise
+
+    def generate(self, model, pk):
+        """
+        Make sure the current image of row `pk` has its derivatives and
+        return them, `None` when the row is gone.
+        """
+        row = model.objects.filter(pk=pk).values_list("image", "image_derivatives", MODELS[model]).first()
+        if row is None:
+            return None
+        name, derivatives, product_id = row
+        if not name or derivatives.get("source") == name:
+            return derivatives
+
+        storage = model._meta.get_field("image").storage
+        with storage.open(name, "rb") as file:
+            data = file.read()
+
+        formats = get_formats()
+        names = imaging.derivative_names(imaging.derivative_key(data, formats), formats)
+        jobs = [
+            (size, format)
+            for size, by_format in names.items()
+            for format, derivative in by_format.items()
+            if not storage.exists(derivative)
+        ]
+        if jobs:
+            for (size, format), content in self.render(data, jobs).items():
+                names[size][format] = storage.save(names[size][format], ContentFile(content))
+
+        derivatives = {"source": name, **names}
+        # Unless the image was replaced in the meantime
+        if model.objects.filter(pk=pk, image=name).update(image_derivatives=derivatives):
+            # Exported with the product
+            Product.objects.filter(pk=product_id).update(updated=timezone.now())
+            invalidate_product_ids(product_id)
+        return derivatives
+
+
+pipeline = Pipeline()
+
+
+def derivative_urls(derivatives, request=None):
+    # {size: {format: url}} from the names stored on a row, with URLs made
+    # absolute like DRF's FileField does
+    urls = {}
+    for size, by_format in derivatives.items():
+        if size not in imaging.SIZES:
+            continue
+        urls[size] = {}
+        for format, name in by_format.items():
+            url = default_storage.url(name)
+            urls[size][format] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+class ImageDerivativesField(serializers.Field):
+    """
+    URLs of the resized copies of the row's image, by size then format.
+    Empty until they have been rendered, which happens shortly after the
+    image is saved.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return derivative_urls(value, self.context.get("request"))
+
+    def compiled_converter(self):
+        # Used by store.compiled in place of to_representation
+        return lambda value, renderer: derivative_urls(value, renderer.request)
+
+
+# Signal handlers queueing the derivatives of new images
+
+
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=Gallery)
+def forget_stale_derivatives(sender, instance, **kwargs):
+    # Saved together with a new image, so the old one's derivatives are
+    # never served for it
+    derivatives = instance.image_derivatives
+    if derivatives and derivatives.get("source") != (instance.image.name or None):
+        instance.image_derivatives = {}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Gallery)
+def queue_derivatives(sender, instance, **kwargs):
+    if instance.image and not instance.image_derivatives and is_enabled():
+        transaction.on_commit(partial(pipeline.schedule, sender, instance.pk))
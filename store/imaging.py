@@ -0,0 +1,82 @@
+import hashlib
+import io
+
+from PIL import Image, ImageOps, features
+
+# Derivatives rendered from each product and gallery image, by the longest
+# side they are scaled down to (smaller images are never scaled up)
+SIZES = {
+    "thumbnail": 160,
+    "card": 480,
+    "zoom": 1600,
+}
+
+QUALITY = {
+    "webp": 80,
+    "avif": 60,
+}
+
+# Part of every derivative's hash: bump it when the output of render()
+# changes, so clients and CDNs get new names instead of stale files
+VERSION = 1
+
+LOCATION = "derivatives"
+
+
+def supported_formats(formats):
+    # The configured formats this Pillow build can encode
+    supported = []
+    for format in formats:
+        try:
+            if format in QUALITY and features.check(format):
+                supported.append(format)
+        except ValueError:
+            pass
+    return supported
+
+
+def derivative_key(data, formats):
+    # Same bytes and settings, same key: re-uploads of an image reuse the
+    # derivatives already stored instead of rendering them again
+    digest = hashlib.sha256(data)
+    digest.update(repr((VERSION, sorted(SIZES.items()), sorted(QUALITY.items()), sorted(formats))).encode())
+    return digest.hexdigest()[:32]
+
+
+def derivative_names(key, formats):
+    # {size: {format: storage name}}
+    return {
+        size: {format: f"{LOCATION}/{key[:2]}/{key}-{size}.{format}" for format in formats}
+        for size in SIZES
+    }
+
+
+def render(data, jobs):
+    """
+    Encode the `(size, format)` pairs of `jobs` from the image in `data`,
+    returning `{(size, format): bytes}`.
+
+    Runs in the derivative process pool, so it only takes and returns
+    plain bytes. The image is decoded once, at the smallest scale that
+    still covers the largest size asked for (JPEGs decode straight to a
+    fraction of their resolution), then scaled down from one size to the
+    next.
+    """
+    sizes = sorted({size for size, format in jobs}, key=SIZES.get, reverse=True)
+    largest = SIZES[sizes[0]]
+
+    output = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+        for size in sizes:
+            bound = SIZES[size]
+            image.thumbnail((bound, bound), Image.Resampling.LANCZOS)
+            for format in [format for other, format in jobs if other == size]:
+                buffer = io.BytesIO()
+                image.save(buffer, format.upper(), quality=QUALITY[format])
+                output[size, format] = buffer.getvalue()
+    return output
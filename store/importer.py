@@ -0,0 +1,248 @@
+import csv
+import json
+import time
+
+import shortuuid
+from django.db import transaction
+from django.utils.text import slugify
+from rest_framework import serializers
+
+from store import cache as product_cache
+from store.fuzzy import trigram_index
+from store.models import Product, Category, Specification, Color, Size, Gallery
+from store.search import get_backend
+from store.storage import adjust_references
+from store.suggest import suggest_index
+
+FORMATS = ("csv", "jsonl")
+
+# Columns holding lists of child rows; in CSV files they are JSON arrays
+NESTED = ("specifications", "colors", "sizes", "gallery")
+
+
+class SpecificationImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Specification
+        fields = ["title", "content"]
+
+
+class ColorImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Color
+        fields = ["name", "color_code"]
+
+
+class SizeImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Size
+        fields = ["name", "price"]
+
+
+class GalleryImportSerializer(serializers.ModelSerializer):
+    # A path in the media storage, the file itself is uploaded separately
+    image = serializers.CharField(max_length=100)
+
+    class Meta:
+        model = Gallery
+        fields = ["image"]
+
+
+class ProductImportSerializer(serializers.ModelSerializer):
+    # One row of an import file. Categories are given by slug and resolved
+    # for a whole chunk at once.
+    image = serializers.CharField(max_length=100, required=False)
+    category = serializers.SlugField(required=False, allow_null=True)
+    specifications = SpecificationImportSerializer(many=True, required=False)
+    colors = ColorImportSerializer(many=True, required=False)
+    sizes = SizeImportSerializer(many=True, required=False)
+    gallery = GalleryImportSerializer(many=True, required=False)
+
+    class Meta:
+        model = Product
+        fields = [
+            "title",
+            "image",
+            "description",
+            "category",
+            "price",
+            "old_price",
+            "shipping_amount",
+            "stock_qty",
+            "in_stock",
+            "status",
+            "featured",
+            "slug",
+            "specifications",
+            "colors",
+            "sizes",
+            "gallery",
+        ]
+
+
+def read_rows(lines, format):
+    """
+    Yield `(line_number, data, error)` for each row of a CSV or JSONL file,
+    with `error` set (and `data` None) for rows that can't be parsed.
+    Empty CSV cells are left out so model defaults apply.
+    """
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            data = {key: value for key, value in row.items() if key and value not in ("", None)}
+            try:
+                for key in NESTED:
+                    if key in data:
+                        data[key] = json.loads(data[key])
+            except ValueError as e:
+                yield reader.line_num, None, {key: [f"Invalid JSON: {e}"]}
+                continue
+            yield reader.line_num, data, None
+    else:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                yield number, None, {"non_field_errors": [f"Invalid JSON: {e}"]}
+                continue
+            if not isinstance(data, dict):
+                yield number, None, {"non_field_errors": ["Expected a JSON object"]}
+                continue
+            yield number, data, None
+
+
+class ProductImporter:
+    """
+    Create a vendor's products from parsed import rows.
+
+    Rows are validated one by one against `ProductImportSerializer` (built
+    once, so its fields aren't rebuilt per row), then inserted
+    `chunk_size` at a time: one transaction per chunk with a `bulk_create`
+    for the products and one for each kind of child row. Product pids are
+    generated up front, so children can be linked and the search index
+    updated without a query per product. Invalid rows are reported, and
+    the valid rows around them are still imported.
+
+    `bulk_create` sends no signals: the full-text index is updated per
+    chunk here, and at the end the shared versions of the product lists
+    and of the in-memory search indexes are bumped, so every worker
+    rebuilds them, not just this process.
+    """
+
+    def __init__(self, vendor, chunk_size=1000, progress=None):
+        self.vendor = vendor
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.serializer = ProductImportSerializer()
+        self.categories = {}
+        self.created = 0
+        self.errors = []
+
+    def run(self, rows):
+        self.started = time.perf_counter()
+        chunk = []
+        for number, data, error in rows:
+            if error is not None:
+                self.errors.append({"row": number, "errors": error})
+                continue
+            chunk.append((number, data))
+            if len(chunk) >= self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.import_chunk(chunk)
+        self.finish()
+        return {"created": self.created, "errors": self.errors}
+
+    def rate(self):
+        return self.created / max(time.perf_counter() - self.started, 1e-9)
+
+    def validate(self, chunk):
+        valid = []
+        for number, data in chunk:
+            try:
+                valid.append((number, self.serializer.run_validation(data)))
+            except serializers.ValidationError as e:
+                self.errors.append({"row": number, "errors": e.detail})
+
+        slugs = {data["category"] for number, data in valid if data.get("category")}
+        missing = slugs - self.categories.keys()
+        if missing:
+            self.categories.update(Category.objects.filter(slug__in=missing).in_bulk(field_name="slug"))
+
+        rows = []
+        for number, data in valid:
+            slug = data.get("category")
+            if slug and slug not in self.categories:
+                self.errors.append({"row": number, "errors": {"category": [f"Unknown category {slug!r}"]}})
+                continue
+            data["category"] = self.categories.get(slug)
+            rows.append(data)
+        return rows
+
+    def new_pids(self, count):
+        # Fresh pids in Product.pid's format, checked against the table
+        field = Product._meta.get_field("pid")
+        generator = shortuuid.ShortUUID(alphabet=field.alphabet)
+        pids = set()
+        while len(pids) < count:
+            candidates = {field.prefix + generator.random(length=field.length)
+                          for _ in range(count - len(pids))}
+            candidates -= pids
+            taken = set(Product.objects.filter(pid__in=candidates).values_list("pid", flat=True))
+            pids |= candidates - taken
+        return list(pids)
+
+    def import_chunk(self, chunk):
+        rows = self.validate(chunk)
+        if not rows:
+            return
+
+        products = []
+        children = []
+        for data, pid in zip(rows, self.new_pids(len(rows))):
+            nested = {key: data.pop(key, []) for key in NESTED}
+            if not data.get("slug"):
+                data["slug"] = slugify(data["title"])
+            product = Product(vendor=self.vendor, pid=pid, **data)
+            products.append(product)
+            children.append(nested)
+
+        with transaction.atomic():
+            Product.objects.bulk_create(products)
+            if any(product.pk is None for product in products):
+                # Databases that can't return ids from a bulk insert
+                ids = dict(Product.objects.filter(
+                    pid__in=[product.pid for product in products]).values_list("pid", "id"))
+                for product in products:
+                    product.pk = ids[product.pid]
+
+            images = [product.image.name for product in products if product.image]
+            for model, key in [(Specification, "specifications"), (Color, "colors"),
+                               (Size, "sizes"), (Gallery, "gallery")]:
+                created = model.objects.bulk_create([
+                    model(product=product, **item)
+                    for product, nested in zip(products, children)
+                    for item in nested[key]
+                ], batch_size=self.chunk_size)
+                if model is Gallery:
+                    images += [gallery.image.name for gallery in created if gallery.image]
+
+            # bulk_create sends no signals: count the stored files the new
+            # rows point at, so collect_media keeps them
+            adjust_references(images, 1)
+
+            get_backend().index_products([product.pk for product in products])
+
+        self.created += len(products)
+        if self.progress:
+            self.progress(self)
+
+    def finish(self):
+        if not self.created:
+            return
+        # The indexes are rebuilt from the table on their next use rather
+        # than patched row by row
+        product_cache.bump_versions(
+            "products", suggest_index.version_name, trigram_index.version_name)
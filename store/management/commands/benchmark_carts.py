@@ -0,0 +1,100 @@
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, OperationalError, connection
+
+from store.models import Product, Cart
+
+
+class Command(BaseCommand):
+    help = "Compare adds/second of Cart.objects.upsert() against the old get-then-save on one shared cart."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=8,
+            help="Number of threads adding to the cart at once.")
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=50,
+            help="Number of times each thread adds every product.")
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=2,
+            help="Number of existing products added to the cart.")
+
+    def handle(self, *args, **options):
+        products = list(Product.objects.order_by("pk")[:options["products"]])
+        if not products:
+            raise CommandError("No products to add, import some first")
+
+        results = {}
+        for label, add in (("upsert", self.upsert), ("get-then-save", self.get_then_save)):
+            cart_id = f"benchmark-{uuid.uuid4().hex}"
+            try:
+                results[label] = self.add_concurrently(add, cart_id, products, options["threads"], options["rounds"])
+            finally:
+                Cart.objects.filter(cart_id=cart_id).delete()
+
+        for label, (rate, races, errors) in results.items():
+            self.stdout.write(
+                f"{label}: {rate:,.0f} adds/s with {options['threads']} threads, "
+                f"{races} inserts raced another thread, {errors} adds gave up")
+
+    def add_concurrently(self, add, cart_id, products, threads, rounds):
+        barrier = threading.Barrier(threads)
+        lock = threading.Lock()
+        counts = {"races": 0, "errors": 0}
+
+        def run(qty):
+            try:
+                barrier.wait()
+                for _ in range(rounds):
+                    for product in products:
+                        cart = Cart(cart_id=cart_id, product=product)
+                        cart.set_amounts(qty, Decimal("10.00"), Decimal("0.00"), 0)
+                        outcome = self.retry(add, cart)
+                        if outcome:
+                            with lock:
+                                counts[outcome] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=run, args=(qty,)) for qty in range(1, threads + 1)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        return threads * rounds * len(products) / elapsed, counts["races"], counts["errors"]
+
+    def retry(self, add, cart):
+        for _ in range(50):
+            try:
+                return add(cart)
+            except OperationalError:
+                # SQLite locks the whole database while another thread writes
+                time.sleep(0.01)
+        return "errors"
+
+    def upsert(self, cart):
+        Cart.objects.upsert([cart])
+
+    def get_then_save(self, cart):
+        # How CartAPIView added items before upsert()
+        existing = Cart.objects.filter(cart_id=cart.cart_id, product=cart.product).first()
+        if existing:
+            cart.pk, cart.date = existing.pk, existing.date
+        try:
+            cart.save()
+        except IntegrityError:
+            # Another thread inserted the row after our lookup: without the
+            # unique constraint this was a duplicate row
+            return "races"
@@ -0,0 +1,144 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from store.models import Product
+from store.fuzzy import get_fuzzy_backend, trigram_index
+from store.search import get_backend, get_max_results, parse_terms
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ("Measure search latency against synthetic catalogs of growing size. "
+            "Everything is created inside a transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[10000, 100000, 1000000],
+            help="Catalog sizes to measure, in increasing order.")
+        parser.add_argument(
+            "--queries",
+            type=int,
+            default=200,
+            help="Searches timed per catalog size.")
+        parser.add_argument(
+            "--legacy-queries",
+            type=int,
+            default=20,
+            help="Searches timed with the old icontains filter, for comparison.")
+        parser.add_argument(
+            "--fuzzy-queries",
+            type=int,
+            default=200,
+            help="Misspelled searches timed against the trigram index.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        sizes = options["sizes"]
+        if sizes != sorted(sizes):
+            raise CommandError("--sizes must be increasing")
+
+        backend = get_backend()
+        fuzzy = get_fuzzy_backend()
+        self.stdout.write(f"Backend: {type(backend).__name__}, fuzzy: {type(fuzzy).__name__}")
+        self.random = random.Random(options["seed"])
+        self.words = [self.make_word() for _ in range(5000)]
+
+        try:
+            with transaction.atomic():
+                created = 0
+                for size in sizes:
+                    started = time.perf_counter()
+                    ids = self.create_products(size - created)
+                    backend.index_products(ids)
+                    created = size
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(
+                        f"{size} products: added and indexed {len(ids)} in {elapsed:.1f}s")
+
+                    self.measure("index", options["queries"], lambda terms, query: backend.search(
+                        terms, get_max_results()))
+                    self.measure("legacy", options["legacy_queries"], lambda terms, query: list(
+                        Product.objects.filter(
+                            Q(status="published"),
+                            Q(title__icontains=query) | Q(category__title__iexact=query),
+                        ).values_list("pk", flat=True)[:get_max_results()]))
+
+                    if fuzzy is trigram_index:
+                        # Bulk inserts send no signals, so rebuild from the table
+                        started = time.perf_counter()
+                        trigram_index.reset()
+                        trigram_index.ensure_built()
+                        self.stdout.write(
+                            f"  trigram index built in {time.perf_counter() - started:.1f}s")
+                    self.measure("fuzzy", options["fuzzy_queries"], lambda terms, query: fuzzy.search(
+                        terms, get_max_results()), self.make_typo)
+                raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            trigram_index.reset()
+
+    def make_word(self):
+        return "".join(self.random.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(self.random.randint(4, 9)))
+
+    def make_text(self, words):
+        return " ".join(self.random.choice(self.words) for _ in range(words))
+
+    def create_products(self, count, batch_size=5000):
+        ids = []
+        for start in range(0, count, batch_size):
+            products = [
+                Product(
+                    title=self.make_text(self.random.randint(2, 5)),
+                    description=self.make_text(30),
+                    status="published",
+                )
+                for _ in range(min(batch_size, count - start))
+            ]
+            ids += [product.pk for product in Product.objects.bulk_create(products)]
+        return ids
+
+    def make_query(self):
+        # One or two words, the last one cut short like a user still typing
+        words = [self.random.choice(self.words) for _ in range(self.random.randint(1, 2))]
+        words[-1] = words[-1][:self.random.randint(3, len(words[-1]))]
+        return " ".join(words)
+
+    def make_typo(self):
+        # A whole word with one letter dropped, as when typing too fast
+        word = self.random.choice(self.words)
+        index = self.random.randrange(len(word))
+        return word[:index] + word[index + 1:]
+
+    def measure(self, label, count, search, make_query=None):
+        if not count:
+            return
+
+        samples = []
+        for _ in range(count):
+            query = (make_query or self.make_query)()
+            terms = parse_terms(query)
+            started = time.perf_counter()
+            search(terms, query)
+            samples.append((time.perf_counter() - started) * 1000)
+
+        self.stdout.write(
+            f"  {label}: p50 {percentile(samples, 0.5):.2f}ms "
+            f"p95 {percentile(samples, 0.95):.2f}ms "
+            f"p99 {percentile(samples, 0.99):.2f}ms over {count} searches")
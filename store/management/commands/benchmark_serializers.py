@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from store.fieldsets import optimize_queryset
+from store.models import Product, Cart, CartOrder, Review
+from store.serializer import ProductSerializer, CartSerializer, CartOrderSerializer, ReviewSerializer
+
+
+SHAPES = {
+    "product": (Product, ProductSerializer),
+    "cart": (Cart, CartSerializer),
+    "order": (CartOrder, CartOrderSerializer),
+    "review": (Review, ReviewSerializer),
+}
+
+
+class Command(BaseCommand):
+    help = "Compare rows/second of the compiled serializers against the plain DRF path on existing rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "shapes",
+            nargs="*",
+            help="Serializers to benchmark: %s (default: all)." % ", ".join(sorted(SHAPES)))
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=100,
+            help="Number of rows serialized per response.")
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Number of responses rendered per path.")
+
+    def handle(self, *args, **options):
+        request = Request(RequestFactory().get("/"))
+
+        for name in options["shapes"] or sorted(SHAPES):
+            if name not in SHAPES:
+                raise CommandError(f"Unknown shape {name!r}")
+            model, serializer_class = SHAPES[name]
+            context = {"request": request}
+
+            queryset = optimize_queryset(
+                model.objects.order_by("pk"), serializer_class(context=context))
+            rows = list(queryset[:options["rows"]])
+            if not rows:
+                self.stdout.write(f"{name}: no rows, skipped")
+                continue
+
+            results = {}
+            for compiled in (False, True):
+                content = None
+                started = time.perf_counter()
+                for _ in range(options["repeat"]):
+                    serializer = serializer_class(rows, many=True, context=context)
+                    serializer.child.compiled = compiled
+                    content = JSONRenderer().render(serializer.data)
+                elapsed = time.perf_counter() - started
+                results[compiled] = (len(rows) * options["repeat"] / elapsed, content)
+
+            (drf_rate, drf_content), (fast_rate, fast_content) = results[False], results[True]
+            if drf_content != fast_content:
+                raise CommandError(f"{name}: compiled output differs from {serializer_class.__name__}")
+
+            self.stdout.write(
+                f"{name}: {len(rows)} rows, drf {drf_rate:,.0f} rows/s, "
+                f"compiled {fast_rate:,.0f} rows/s ({fast_rate / drf_rate:.1f}x), output identical")
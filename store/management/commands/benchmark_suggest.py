@@ -0,0 +1,87 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.suggest import SuggestIndex, DEFAULT_LIMIT
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ("Measure suggestion latency on an in-memory index of synthetic titles. "
+            "The database is not touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--titles",
+            type=int,
+            default=100000,
+            help="Product titles in the index.")
+        parser.add_argument(
+            "--queries",
+            type=int,
+            default=10000,
+            help="Lookups timed.")
+        parser.add_argument(
+            "--target-ms",
+            type=float,
+            default=1.0,
+            help="p99 latency the index should stay under.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        self.words = [self.make_word() for _ in range(5000)]
+
+        index = SuggestIndex()
+        started = time.perf_counter()
+        with index.lock:
+            for id in range(1, options["titles"] + 1):
+                title = " ".join(self.random.choice(self.words)
+                                 for _ in range(self.random.randint(2, 5)))
+                index._add_product(id, str(id), str(id), title, id % 50,
+                                   self.random.randint(0, 500), self.random.randint(0, 10000),
+                                   sort=False)
+            for id in range(50):
+                index._add_category(id, str(id), self.make_word(), sort=False)
+            index.products.sort()
+            index.categories.sort()
+            index.built = True
+        self.stdout.write(
+            f"Indexed {options['titles']} titles ({len(index.products.keys)} keys) "
+            f"in {time.perf_counter() - started:.2f}s")
+
+        # lookup() rather than suggest(): the hand-built index has no shared
+        # version to check
+        samples = []
+        matched = 0
+        for _ in range(options["queries"]):
+            query = self.make_query()
+            started = time.perf_counter()
+            result = index.lookup(query, DEFAULT_LIMIT)
+            samples.append((time.perf_counter() - started) * 1000)
+            matched += bool(result["products"])
+
+        p99 = percentile(samples, 0.99)
+        self.stdout.write(
+            f"p50 {percentile(samples, 0.5):.3f}ms "
+            f"p95 {percentile(samples, 0.95):.3f}ms "
+            f"p99 {p99:.3f}ms over {options['queries']} lookups, {matched} with matches")
+        if p99 < options["target_ms"]:
+            self.stdout.write(self.style.SUCCESS(f"p99 is under {options['target_ms']}ms"))
+        else:
+            self.stdout.write(self.style.WARNING(f"p99 is over {options['target_ms']}ms"))
+
+    def make_word(self):
+        return "".join(self.random.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(self.random.randint(4, 9)))
+
+    def make_query(self):
+        # What someone has typed so far: one to two words, the last cut short
+        words = [self.random.choice(self.words) for _ in range(self.random.randint(1, 2))]
+        words[-1] = words[-1][:self.random.randint(1, len(words[-1]))]
+        return " ".join(words)
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from store.images import MODELS, get_workers, pipeline
+
+
+class Command(BaseCommand):
+    help = ("Render the missing image derivatives of products and gallery images, "
+            "e.g. for rows created before the pipeline existed or by an import.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of rows read at a time.")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        # One job per worker process in flight; each thread waits on its own
+        with ThreadPoolExecutor(max_workers=max(get_workers(), 1)) as threads:
+            for model in MODELS:
+                total = 0
+                failed = 0
+                last_id = 0
+                while True:
+                    rows = list(
+                        model.objects.filter(pk__gt=last_id)
+                        .order_by("pk")
+                        .values_list("pk", "image", "image_derivatives")[:chunk_size]
+                    )
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+
+                    pks = [pk for pk, image, derivatives in rows
+                           if image and derivatives.get("source") != image]
+                    for pk, error in zip(pks, threads.map(self.generate, [model] * len(pks), pks)):
+                        if error is not None:
+                            failed += 1
+                            self.stderr.write(f"{model.__name__} {pk}: {error}")
+                    total += len(pks)
+                    self.stdout.write(f"Rendered {model.__name__} derivatives of {total} rows")
+
+                style = self.style.WARNING if failed else self.style.SUCCESS
+                self.stdout.write(style(
+                    f"{model.__name__}: {total - failed} rows rendered, {failed} failed"))
+
+    def generate(self, model, pk):
+        try:
+            pipeline.generate(model, pk)
+        except Exception as e:
+            return e
+        return None
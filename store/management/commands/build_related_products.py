@@ -0,0 +1,154 @@
+from collections import Counter, defaultdict
+from itertools import combinations
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from store.models import CartOrder, CartOrderItem, ProductPair, ProductPairOrder, RelatedProduct
+
+
+class Command(BaseCommand):
+    help = ("Count which products are bought together in paid orders and keep the "
+            "top neighbours of each product for the related products endpoint. "
+            "Only orders paid (or refunded) since the last run are read.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of orders counted per transaction.")
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="Neighbours kept per product.")
+        parser.add_argument(
+            "--max-order-products",
+            type=int,
+            default=50,
+            help="Orders with more distinct products only pair their first ones.")
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Forget every count and start over from all paid orders.")
+
+    def handle(self, *args, **options):
+        self.chunk_size = options["chunk_size"]
+        self.max_order_products = options["max_order_products"]
+
+        if options["rebuild"]:
+            with transaction.atomic():
+                ProductPair.objects.all().delete()
+                RelatedProduct.objects.all().delete()
+                ProductPairOrder.objects.all().delete()
+
+        # Newly paid orders add their pairs, counted orders no longer paid
+        # (refunds, cancellations) take theirs back
+        touched = set()
+        added = self.count_orders(
+            CartOrder.objects.filter(payment_status="paid", productpairorder__isnull=True), 1, touched)
+        removed = self.count_orders(
+            CartOrder.objects.exclude(payment_status="paid").filter(productpairorder__isnull=False), -1, touched)
+
+        self.rank(touched, options["top"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Counted {added} orders, uncounted {removed}, "
+            f"ranked neighbours of {len(touched)} products"))
+
+    def count_orders(self, orders, delta, touched):
+        total = 0
+        last_id = 0
+        while True:
+            ids = list(
+                orders.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:self.chunk_size]
+            )
+            if not ids:
+                break
+
+            pairs = self.pairs(ids)
+            with transaction.atomic():
+                self.apply(pairs, delta)
+                if delta > 0:
+                    ProductPairOrder.objects.bulk_create([ProductPairOrder(order_id=pk) for pk in ids])
+                else:
+                    ProductPairOrder.objects.filter(order_id__in=ids).delete()
+
+            touched.update(product_id for product_id, other_id in pairs)
+            last_id = ids[-1]
+            total += len(ids)
+            self.stdout.write(f"{'Counted' if delta > 0 else 'Uncounted'} {total} orders")
+        return total
+
+    def pairs(self, order_ids):
+        # Counter of (product, other) over the orders, both directions
+        products = defaultdict(list)
+        items = (
+            CartOrderItem.objects.filter(order_id__in=order_ids)
+            .order_by("order_id", "id")
+            .values_list("order_id", "product_id")
+        )
+        for order_id, product_id in items.iterator(chunk_size=2000):
+            order_products = products[order_id]
+            if product_id not in order_products and len(order_products) < self.max_order_products:
+                order_products.append(product_id)
+
+        pairs = Counter()
+        for order_products in products.values():
+            for product_id, other_id in combinations(order_products, 2):
+                pairs[product_id, other_id] += 1
+                pairs[other_id, product_id] += 1
+        return pairs
+
+    def apply(self, pairs, delta):
+        if not pairs:
+            return
+        product_ids = {product_id for product_id, other_id in pairs}
+        existing = {
+            (pair.product_id, pair.other_id): pair
+            for pair in ProductPair.objects.filter(
+                product_id__in=product_ids, other_id__in=product_ids)
+        }
+
+        changed = []
+        emptied = []
+        created = []
+        for key, count in pairs.items():
+            pair = existing.get(key)
+            if pair is None:
+                if delta > 0:
+                    created.append(ProductPair(product_id=key[0], other_id=key[1], count=count))
+                continue
+            pair.count += delta * count
+            if pair.count > 0:
+                changed.append(pair)
+            else:
+                emptied.append(pair.pk)
+
+        ProductPair.objects.bulk_update(changed, ["count"], batch_size=1000)
+        ProductPair.objects.bulk_create(created, batch_size=1000)
+        ProductPair.objects.filter(pk__in=emptied).delete()
+
+    def rank(self, product_ids, top):
+        product_ids = sorted(product_ids)
+        for start in range(0, len(product_ids), self.chunk_size):
+            ids = product_ids[start:start + self.chunk_size]
+            neighbours = (
+                ProductPair.objects.filter(product_id__in=ids)
+                .annotate(rank=Window(
+                    RowNumber(),
+                    partition_by=F("product_id"),
+                    order_by=[F("count").desc(), F("other_id").asc()]))
+                .filter(rank__lte=top)
+                .values_list("product_id", "other_id", "count", "rank")
+            )
+            with transaction.atomic():
+                RelatedProduct.objects.filter(product_id__in=ids).delete()
+                RelatedProduct.objects.bulk_create([
+                    RelatedProduct(product_id=product_id, related_id=other_id, count=count, rank=rank)
+                    for product_id, other_id, count, rank in neighbours
+                ], batch_size=1000)
@@ -0,0 +1,103 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from store.models import StoredFile
+from store.storage import CONTENT_LOCATION, FILE_FIELDS, content_addressed_fields
+
+
+class Command(BaseCommand):
+    help = ("Delete the content addressed media files no product, gallery image, "
+            "category, vendor or profile points at anymore.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=24,
+            help="Keep unreferenced files younger than this, e.g. uploads whose row isn't saved yet.")
+        parser.add_argument(
+            "--recount",
+            action="store_true",
+            help="Recount the references from the tables first, after bulk changes that send no signals.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of files deleted at a time.")
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        storages = {
+            model._meta.get_field(field).storage
+            for model in FILE_FIELDS
+            for field in content_addressed_fields(model)
+        }
+        if not storages:
+            raise CommandError("No file field uses a content addressed storage")
+        storage = storages.pop()
+
+        if options["recount"]:
+            self.recount()
+
+        cutoff = timezone.now() - timedelta(hours=options["grace_hours"])
+        orphans = StoredFile.objects.filter(references=0, date__lt=cutoff)
+        if options["dry_run"]:
+            self.stdout.write(f"Would delete {orphans.count()} files")
+            return
+
+        deleted = 0
+        freed = 0
+        last_id = 0
+        while True:
+            files = list(
+                orphans.filter(pk__gt=last_id).order_by("pk")
+                .values_list("pk", "name", "size")[:options["chunk_size"]]
+            )
+            if not files:
+                break
+            last_id = files[-1][0]
+
+            for pk, name, size in files:
+                with transaction.atomic():
+                    # Only if nothing started pointing at the file (or
+                    # uploaded it again) in the meantime. The row stays
+                    # locked until the file is gone, so an upload of the
+                    # same bytes waits and then stores them again.
+                    stored = orphans.select_for_update().filter(pk=pk).first()
+                    if stored is None:
+                        continue
+                    storage.delete(name)
+                    stored.delete()
+                deleted += 1
+                freed += size
+            self.stdout.write(f"Deleted {deleted} files")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} unreferenced files, {freed / 1024 / 1024:.1f} MiB freed"))
+
+    def recount(self):
+        references = Counter()
+        for model in FILE_FIELDS:
+            for field in content_addressed_fields(model):
+                names = (
+                    model.objects.filter(**{f"{field}__startswith": CONTENT_LOCATION + "/"})
+                    .values_list(field, flat=True)
+                )
+                references.update(names.iterator(chunk_size=2000))
+
+        changed = []
+        for stored in StoredFile.objects.only("pk", "name", "references").iterator(chunk_size=2000):
+            count = references.get(stored.name, 0)
+            if stored.references != count:
+                stored.references = count
+                changed.append(stored)
+        with transaction.atomic():
+            StoredFile.objects.bulk_update(changed, ["references"], batch_size=1000)
+        self.stdout.write(f"Recounted references, {len(changed)} files corrected")
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.export import FORMATS, csv_lines, export_queryset, ndjson_lines, parse_since
+from store.fieldsets import optimize_queryset
+from store.models import Product
+from store.serializer import ProductSerializer
+
+
+class Command(BaseCommand):
+    help = ("Write the product catalog as NDJSON (the API product payloads) or CSV, "
+            "streaming it in chunks so memory stays flat.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=FORMATS, default="ndjson")
+        parser.add_argument(
+            "--updated-since",
+            help="Only products saved since this ISO date or datetime.")
+        parser.add_argument(
+            "--output",
+            help="File to write, standard output by default.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of products read and serialized at a time.")
+
+    def handle(self, *args, **options):
+        updated_since = None
+        if options["updated_since"]:
+            try:
+                updated_since = parse_since(options["updated_since"])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        if options["format"] == "csv":
+            lines = csv_lines(export_queryset(Product.objects.all(), updated_since), options["chunk_size"])
+        else:
+            serializer = ProductSerializer()
+            queryset = optimize_queryset(Product.objects.all(), serializer)
+            lines = ndjson_lines(
+                export_queryset(queryset, updated_since),
+                lambda products: ProductSerializer(products, many=True).data,
+                options["chunk_size"])
+
+        if options["output"]:
+            with open(options["output"], "w", newline="", encoding="utf-8") as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
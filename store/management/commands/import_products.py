@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.importer import FORMATS, ProductImporter, read_rows
+from vendor.models import Vendor
+
+
+class Command(BaseCommand):
+    help = ("Create a vendor's products, with their specifications, colors, sizes "
+            "and gallery, from a CSV or JSONL file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSONL file to import.")
+        parser.add_argument("--vendor", type=int, required=True, help="Vendor id.")
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="File format, guessed from the file extension by default.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of rows inserted per transaction.")
+
+    def handle(self, *args, **options):
+        try:
+            vendor = Vendor.objects.get(pk=options["vendor"])
+        except Vendor.DoesNotExist:
+            raise CommandError(f"No vendor with id {options['vendor']}")
+
+        format = options["format"] or ("csv" if options["path"].endswith(".csv") else "jsonl")
+        importer = ProductImporter(vendor, options["chunk_size"], progress=self.progress)
+        with open(options["path"], newline="", encoding="utf-8-sig") as lines:
+            result = importer.run(read_rows(lines, format))
+
+        for error in result["errors"]:
+            self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+        style = self.style.WARNING if result["errors"] else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Imported {result['created']} products at {importer.rate():.0f}/s, "
+            f"{len(result['errors'])} rows rejected"))
+
+    def progress(self, importer):
+        self.stdout.write(f"Imported {importer.created} products ({importer.rate():.0f}/s)")
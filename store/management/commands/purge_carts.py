@@ -0,0 +1,92 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
+from store.models import Cart
+
+
+class Command(BaseCommand):
+    help = ("Delete the anonymous carts left untouched for more than --days, a chunk "
+            "at a time, once or every --every seconds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=float,
+            default=getattr(settings, "CART_MAX_AGE_DAYS", 30),
+            help="Days since a cart's last change after which it is deleted.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of carts deleted per statement.")
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to wait between chunks, to spread the load.")
+        parser.add_argument(
+            "--every",
+            type=float,
+            help="Keep running, purging again every this many seconds (e.g. as a clock process).")
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        while True:
+            self.purge(options)
+            if not options["every"]:
+                break
+            # Idle connections would time out between runs
+            connections.close_all()
+            time.sleep(options["every"])
+
+    def purge(self, options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        # Carts of signed-in users are kept; an anonymous cart goes when its
+        # newest item is older than the cutoff, all of its items at once
+        anonymous = Cart.objects.filter(user=None).exclude(cart_id=None)
+        stale = (
+            anonymous.values("cart_id")
+            .annotate(last=Max("updated"))
+            .filter(last__lt=cutoff)
+            .order_by("cart_id")
+        )
+        if options["dry_run"]:
+            self.stdout.write(f"Would delete {stale.count()} carts")
+            return
+
+        started = time.perf_counter()
+        carts = deleted = 0
+        after = None
+        while True:
+            # Along the (cart_id, product) index from where the last chunk
+            # ended; each chunk is its own short statement, so no lock is
+            # held for long
+            chunk = stale if after is None else stale.filter(cart_id__gt=after)
+            ids = [row["cart_id"] for row in chunk[:options["chunk_size"]]]
+            if not ids:
+                break
+            after = ids[-1]
+            # A cart changed since it was read is no longer stale
+            changed = anonymous.filter(cart_id__in=ids, updated__gte=cutoff).values("cart_id")
+            deleted += anonymous.filter(cart_id__in=ids).exclude(cart_id__in=changed).delete()[0]
+            carts += len(ids)
+            rate = carts / max(time.perf_counter() - started, 1e-9)
+            self.stdout.write(f"Deleted {carts} carts, {deleted} items ({rate:.0f} carts/s)")
+            if options["pause"]:
+                time.sleep(options["pause"])
+
+        rate = carts / max(time.perf_counter() - started, 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {carts} carts ({deleted} items) idle for more than {options['days']:g} days "
+            f"at {rate:.0f} carts/s"))
@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from store.cache import bump_versions, invalidate_soon
+from store.models import Product, Review, CartOrderItem, RATING
+from store.suggest import suggest_index
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored product rating and sales counters from reviews and paid order items."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of products recomputed per transaction.")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        fields = ["rating_avg", "rating_count", "order_count"] + [
+            f"rating_{value}_count" for value, label in RATING
+        ]
+
+        last_id = 0
+        total = 0
+        while True:
+            rows = {
+                pk: (pid, values) for pk, pid, *values in
+                Product.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", "pid", *fields)[:chunk_size]
+            }
+            if not rows:
+                break
+            ids = list(rows)
+
+            with transaction.atomic():
+                # Only the products whose stats were off are written, and
+                # marked updated for incremental exports
+                now = timezone.now()
+                changed = []
+                for product in self.compute(ids):
+                    if [getattr(product, field) for field in fields] != rows[product.pk][1]:
+                        product.updated = now
+                        changed.append(product)
+                Product.objects.bulk_update(changed, fields + ["updated"])
+                # bulk_update sends no signals: replace the cached details
+                # and ETags of those products once it commits
+                invalidate_soon(*[rows[product.pk][0] for product in changed])
+
+            last_id = ids[-1]
+            total += len(ids)
+            self.stdout.write(f"Rebuilt {total} products")
+
+        # Suggestions are ranked by order_count
+        bump_versions(suggest_index.version_name)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt stats for {total} products"))
+
+    def compute(self, ids):
+        products = {pk: Product(pk=pk) for pk in ids}
+        for product in products.values():
+            product.rating_avg = 0
+            product.rating_count = 0
+            product.order_count = 0
+            for value, label in RATING:
+                setattr(product, f"rating_{value}_count", 0)
+
+        reviews = (
+            Review.objects.filter(product_id__in=ids, rating__in=dict(RATING))
+            .values("product_id", "rating")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        )
+        for row in reviews:
+            product = products[row["product_id"]]
+            setattr(product, f"rating_{row['rating']}_count", row["count"])
+            product.rating_count += row["count"]
+            product.rating_avg += row["rating"] * row["count"]
+
+        for product in products.values():
+            if product.rating_count:
+                product.rating_avg = product.rating_avg / product.rating_count
+
+        orders = (
+            CartOrderItem.objects.filter(
+                product_id__in=ids, order__payment_status="paid")
+            .values("product_id")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        )
+        for row in orders:
+            products[row["product_id"]].order_count = row["count"]
+
+        return list(products.values())
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.models import Product
+from store.search import get_backend
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the product full-text search index from the catalog, "
+            "replacing its rows a range of products at a time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of products indexed per transaction.")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        backend = get_backend()
+        if backend.table is None:
+            self.stdout.write(self.style.WARNING(
+                "This database has no full-text index, nothing to rebuild"))
+            return
+
+        # Rather than emptying the index first, each chunk's rows are
+        # replaced in one transaction, so searches keep finding every
+        # product while the rebuild runs
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(
+                Product.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+
+            with transaction.atomic():
+                backend.index_range(last_id, ids[-1])
+
+            last_id = ids[-1]
+            total += len(ids)
+            self.stdout.write(f"Indexed {total} products")
+
+        # Rows of deleted products past the last one
+        with transaction.atomic():
+            backend.index_range(last_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt the {backend.table} index for {total} products"))
@@ -3,6 +3,22 @@
 from django.db import migrations
 
 
+class RenameField(migrations.RenameField):
+    # SQLite table names are case-insensitive, so the many-to-many table
+    # for "Coupon" already is the table for "coupon" and renaming it fails.
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            return
+        super().database_forwards(
+            app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            return
+        super().database_backwards(
+            app_label, schema_editor, from_state, to_state)
+
+
 class Migration(migrations.Migration):
 
     dependencies = [
@@ -10,7 +26,7 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.RenameField(
+        RenameField(
             model_name='cartorderitem',
             old_name='Coupon',
             new_name='coupon',
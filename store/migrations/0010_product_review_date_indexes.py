@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_alter_cartorder_order_status_alter_color_color_code_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['date', 'id'], name='store_produ_date_cc041d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['date', 'id'], name='store_revie_date_2e567d_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+from django.db import migrations
+
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE store_product_fts USING fts5(
+        title, category, specification, description,
+        tokenize = 'porter unicode61'
+    )
+    """,
+    """
+    INSERT INTO store_product_fts (rowid, title, category, specification, description)
+    SELECT p.id, p.title, COALESCE(c.title, ''),
+           COALESCE((
+               SELECT group_concat(COALESCE(s.title, '') || ' ' || COALESCE(s.content, ''), ' ')
+               FROM store_specification s WHERE s.product_id = p.id
+           ), ''),
+           COALESCE(p.description, '')
+    FROM store_product p
+    LEFT JOIN store_category c ON c.id = p.category_id
+    WHERE p.status = 'published'
+    """,
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TABLE IF EXISTS store_product_fts",
+]
+
+POSTGRES_FORWARDS = [
+    """
+    CREATE TABLE store_product_search (
+        product_id bigint PRIMARY KEY REFERENCES store_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX store_product_search_document ON store_product_search USING GIN (document)",
+    """
+    INSERT INTO store_product_search (product_id, document)
+    SELECT p.id,
+           setweight(to_tsvector('english', COALESCE(p.title, '')), 'A') ||
+           setweight(to_tsvector('english', COALESCE(c.title, '')), 'B') ||
+           setweight(to_tsvector('english', COALESCE((
+               SELECT string_agg(COALESCE(s.title, '') || ' ' || COALESCE(s.content, ''), ' ')
+               FROM store_specification s WHERE s.product_id = p.id
+           ), '')), 'C') ||
+           setweight(to_tsvector('english', COALESCE(p.description, '')), 'D')
+    FROM store_product p
+    LEFT JOIN store_category c ON c.id = p.category_id
+    WHERE p.status = 'published'
+    """,
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP TABLE IF EXISTS store_product_search",
+]
+
+
+def run(statements):
+    # Each database gets its own full-text index; others search unindexed
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_product_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARDS, "postgresql": POSTGRES_FORWARDS}),
+            run({"sqlite": SQLITE_BACKWARDS, "postgresql": POSTGRES_BACKWARDS}),
+        ),
+    ]
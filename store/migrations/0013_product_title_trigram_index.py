@@ -0,0 +1,51 @@
+from django.db import migrations
+
+
+POSTGRES_FORWARDS = [
+    # Installing an extension needs privileges the app role may not have;
+    # without pg_trgm fuzzy search uses the in-process trigram index
+    """
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'pg_trgm is not available, skipping the title trigram index';
+    END
+    $$
+    """,
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX IF NOT EXISTS store_product_title_trgm
+                ON store_product USING GIN (title gin_trgm_ops);
+        END IF;
+    END
+    $$
+    """,
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS store_product_title_trgm",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_product_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"postgresql": POSTGRES_FORWARDS}),
+            run({"postgresql": POSTGRES_BACKWARDS}),
+        ),
+    ]
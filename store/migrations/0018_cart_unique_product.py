@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 13:50
+
+from django.db import migrations, models
+
+
+def remove_duplicate_carts(apps, schema_editor):
+    # Keep the row CartAPIView used to update (the first one) of each
+    # product in a cart
+    Cart = apps.get_model("store", "Cart")
+    duplicates = (
+        Cart.objects.exclude(cart_id=None)
+        .values("cart_id", "product_id")
+        .annotate(keep=models.Min("id"), rows=models.Count("id"))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for group in duplicates.iterator():
+        Cart.objects.filter(
+            cart_id=group["cart_id"], product_id=group["product_id"]
+        ).exclude(pk=group["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0017_stored_file'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('cart_id', 'product'), name='unique_cart_product'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_cart_unique_product'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['date', 'id'], name='store_cart_date_4ccf3f_idx'),
+        ),
+    ]
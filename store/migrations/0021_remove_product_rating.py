@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 14:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_cache_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='product',
+            name='rating',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-18 14:43
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def copy_dates(apps, schema_editor):
+    # Existing items start out as old as they were added, so purge_carts
+    # doesn't keep abandoned carts for another --days
+    Cart = apps.get_model("store", "Cart")
+    Cart.objects.update(updated=models.F("date"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_remove_product_rating'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='cart',
+            name='store_cart_date_4ccf3f_idx',
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_dates, migrations.RunPython.noop),
+    ]
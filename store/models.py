@@ -1,8 +1,12 @@
-from django.db import models
+from decimal import Decimal
 
+from django.db import connections, models
+
+from django.utils import timezone
 from django.utils.text import slugify
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.functions import Cast, Coalesce, Greatest, NullIf
+from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
 
 from userauths.models import User, Profile
 from vendor.models import Vendor
@@ -36,6 +40,21 @@ class Category(models.Model):
         ordering = ['title']
 
 
+class ProductQuerySet(models.QuerySet):
+
+    SORTS = {
+        "newest": ("-date", "-id"),
+        "rating": ("-rating_avg", "-id"),
+        "popular": ("-order_count", "-id"),
+    }
+
+    # Sort on the stored counters, unknown keys leave the queryset unchanged
+    def sorted_by(self, sort):
+        if sort in self.SORTS:
+            return self.order_by(*self.SORTS[sort])
+        return self
+
+
 class Product(models.Model):
 
     STATUS = (
@@ -51,6 +70,8 @@ class Product(models.Model):
         null=True,
         blank=True,
         default='product.jpg')
+    # Names of the resized copies of `image`, written by store.images
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     description = models.TextField(null=True, blank=True)
     category = models.ForeignKey(
         Category,
@@ -70,7 +91,6 @@ class Product(models.Model):
         default="published")
     featured = models.BooleanField(default=False)
     views = models.PositiveIntegerField(default=0, null=True, blank=True)
-    rating = models.IntegerField(default=0, null=True, blank=True)
     vendor = models.ForeignKey(
         Vendor,
         on_delete=models.SET_NULL,
@@ -84,10 +104,35 @@ class Product(models.Model):
         alphabet="abcdefghijklmnopqrstuvxyz")
     slug = models.SlugField(null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
+    # Last save of the product row (counter updates don't touch it), for
+    # incremental catalog exports
+    updated = models.DateTimeField(auto_now=True)
+
+    # Denormalized review and sales counters, kept up to date by the signal
+    # handlers at the bottom of this module and rebuilt by the
+    # rebuild_product_stats management command.
+    rating_avg = models.FloatField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+    order_count = models.PositiveIntegerField(default=0)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["date", "id"]),
+            models.Index(fields=["rating_avg", "id"]),
+            models.Index(fields=["order_count", "id"]),
+            models.Index(fields=["updated", "id"]),
+        ]
 
     def save(self, *args, **kwargs):
         if self.slug == "" or self.slug is None:
-            self.slug = slugify(self.name)
+            self.slug = slugify(self.title)
 
         super(Product, self).save(*args, **kwargs)
 
@@ -95,40 +140,35 @@ class Product(models.Model):
         return self.title
 
     def product_rating(self):
-        product_rating = Review.objects.filter(
-            product=self).aggregate(
-            avg_rating=models.Avg("rating"))
-        return product_rating["avg_rating"]
+        if not self.rating_count:
+            return None
+        return self.rating_avg
 
-    def rating_count(self):
-        return Review.objects.filter(product=self).count()
-
-    def save(self, *args, **kwargs):
-        self.rating = self.product_rating()
-        super(Product, self).save(*args, **kwargs)
+    def rating_histogram(self):
+        return {
+            rating: getattr(self, f"rating_{rating}_count")
+            for rating, label in RATING
+        }
 
     # Returns the gallery images linked to this product
     def gallery(self):
-        gallery = Gallery.objects.filter(product=self)
-        return gallery
+        return self.gallery_set.all()
 
     def specification(self):
-        return Specification.objects.filter(product=self)
+        return self.specification_set.all()
 
     def color(self):
-        return Color.objects.filter(product=self)
-
-    def order_count(self):
-        return CartOrderItem.objects.filter(product=self).count()
+        return self.color_set.all()
 
     def size(self):
-        return Size.objects.filter(product=self)
+        return self.size_set.all()
 
 
 class Gallery(models.Model):
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True)
     image = models.FileField(upload_to="products",
                              default="product.jpg", null=True, blank=True)
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     active = models.BooleanField(default=True)
     gid = ShortUUIDField(
         unique=True,
@@ -170,6 +210,95 @@ class Color(models.Model):
         return self.name
 
 
+class CartQuerySet(models.QuerySet):
+
+    # Summary key -> Cart column it sums
+    TOTALS = {
+        "shipping": "shipping_amount",
+        "tax": "tax_fee",
+        "service_fee": "service_fee",
+        "sub_total": "sub_total",
+        "total": "total",
+    }
+
+    # Columns an upsert leaves alone on the row it updates
+    UPSERT_KEEP = ("id", "cart_id", "product", "date")
+
+    def upsert(self, carts):
+        """
+        Save each of `carts` as the row for its (cart_id, product): insert
+        it, or update the row already there, in a single
+        `INSERT ... ON CONFLICT ... DO UPDATE ... RETURNING` statement.
+        Sets the primary keys and returns whether each row was created.
+
+        The statement is atomic, so concurrent adds of the same product
+        can't create duplicate rows, and the inserted `date` (which an
+        update keeps) tells created rows from updated ones. Each product
+        may appear once.
+        """
+        if not carts:
+            return []
+        connection = connections[self.db]
+        if not (connection.vendor in ("postgresql", "sqlite")
+                and connection.features.can_return_rows_from_bulk_insert):
+            return self._upsert_each(carts)
+
+        model = self.model
+        quote = connection.ops.quote_name
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        updated = [field for field in fields if field.name not in self.UPSERT_KEEP]
+        date_field = model._meta.get_field("date")
+
+        params = []
+        for cart in carts:
+            params.extend(field.get_db_prep_save(field.pre_save(cart, True), connection) for field in fields)
+        row = "(%s)" % ", ".join(["%s"] * len(fields))
+        sql = (
+            f"INSERT INTO {quote(model._meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) "
+            f"VALUES {', '.join([row] * len(carts))} "
+            f"ON CONFLICT ({quote('cart_id')}, {quote('product_id')}) DO UPDATE SET "
+            f"{', '.join(f'{quote(field.column)} = EXCLUDED.{quote(field.column)}' for field in updated)} "
+            f"RETURNING {quote('id')}, {quote('product_id')}, {quote(date_field.column)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            returned = {product_id: (pk, date) for pk, product_id, date in cursor.fetchall()}
+
+        created = []
+        for cart in carts:
+            pk, date = returned[cart.product_id]
+            cart.pk = pk
+            # Compared as the backend's plain values (strings on SQLite)
+            inserted = date_field.get_db_prep_save(cart.date, connection)
+            created.append(date_field.to_python(date) == date_field.to_python(inserted))
+            cart._state.adding = False
+            cart._state.db = self.db
+        return created
+
+    def _upsert_each(self, carts):
+        # Databases without ON CONFLICT ... RETURNING
+        created = []
+        for cart in carts:
+            defaults = {
+                field.attname: getattr(cart, field.attname)
+                for field in self.model._meta.concrete_fields if field.name not in self.UPSERT_KEEP
+            }
+            row, was_created = self.update_or_create(
+                cart_id=cart.cart_id, product_id=cart.product_id, defaults=defaults)
+            cart.pk, cart.date = row.pk, row.date
+            created.append(was_created)
+        return created
+
+    # The cart summary in one aggregate query, as exact Decimals (0.00 for
+    # an empty cart)
+    def totals(self):
+        output_field = models.DecimalField(max_digits=14, decimal_places=2)
+        return self.order_by().aggregate(**{
+            key: Coalesce(models.Sum(column), models.Value(Decimal("0.00")), output_field=output_field)
+            for key, column in self.TOTALS.items()
+        })
+
+
 class Cart(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     user = models.ForeignKey(
@@ -219,10 +348,37 @@ class Cart(models.Model):
     color = models.CharField(max_length=100, null=True, blank=True)
     cart_id = models.CharField(max_length=1000, null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
+    # Last add or update of the item (upserts refresh it, unlike `date`);
+    # purge_carts ages carts by their newest item
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # One row per product in a cart, which CartQuerySet.upsert()
+            # relies on; also serves the lookups by cart_id and the
+            # per-cart scan of purge_carts
+            models.UniqueConstraint(fields=["cart_id", "product"], name="unique_cart_product"),
+        ]
 
     def __str__(self):
         return f'{self.cart_id} - {self.product.title}'
 
+    # Amounts of `qty` items at `price`; `tax_rate` is the fraction charged
+    # per item and the service fee is 10% of the sub total
+    def set_amounts(self, qty, price, shipping_amount, tax_rate):
+        self.qty = qty
+        self.price = price
+        self.sub_total = Decimal(price) * int(qty)
+        self.shipping_amount = Decimal(shipping_amount) * int(qty)
+        self.tax_fee = int(qty) * Decimal(tax_rate)
+
+        service_fee_percentage = 10 / 100
+        self.service_fee = Decimal(service_fee_percentage) * self.sub_total
+
+        self.total = self.sub_total + self.shipping_amount + self.service_fee + self.tax_fee
+
 
 class CartOrder(models.Model):
     PAYMENT_STATUS = (
@@ -304,7 +460,7 @@ class CartOrder(models.Model):
         return self.oid
 
     def orderitem(self):
-        return CartOrderItem.objects.filter(order=self)
+        return self.cartorderitem_set.all()
 
 
 class CartOrderItem(models.Model):
@@ -416,25 +572,171 @@ class Review(models.Model):
     class Meta:
         verbose_name_plural = "Reviews & Rating"
         ordering = ["-date"]
+        indexes = [
+            models.Index(fields=["date", "id"]),
+        ]
 
     # Method to get the rating value
     def get_rating(self):
         return self.rating
 
     def profile(self):
-        return Profile.objects.get(user=self.user)
+        return self.user.profile
 
 # Signal handler to update the product rating when a review is saved
 
 
+def counter_delta(field, delta):
+    # Never let a counter go negative, e.g. when deleting rows that were
+    # created before the counters were rebuilt.
+    return Greatest(models.F(field) + delta, 0)
+
+
+def adjust_product_rating(product_id, rating, delta):
+    # One UPDATE that moves the histogram bucket, the count and the average
+    # together. Every F() reads the pre-update row, so the new average is
+    # computed from the old buckets plus the delta.
+    if product_id is None or rating not in dict(RATING):
+        return
+
+    buckets = {
+        value: models.F(f"rating_{value}_count") for value, label in RATING
+    }
+    buckets[rating] = counter_delta(f"rating_{rating}_count", delta)
+    rating_count = counter_delta("rating_count", delta)
+    rating_sum = sum(value * bucket for value, bucket in buckets.items())
+
+    Product.objects.filter(pk=product_id).update(
+        rating_count=rating_count,
+        rating_avg=Coalesce(
+            Cast(rating_sum, models.FloatField()) / NullIf(rating_count, 0),
+            0.0,
+            output_field=models.FloatField()),
+        updated=timezone.now(),
+        **{f"rating_{rating}_count": buckets[rating]},
+    )
+
+
+def adjust_product_order_count(counts, delta):
+    # counts maps product_id -> number of paid order items
+    for product_id, count in counts.items():
+        Product.objects.filter(pk=product_id).update(
+            order_count=counter_delta("order_count", delta * count), updated=timezone.now())
+
+
+# Signal handlers keeping the Product review counters up to date
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    instance._previous_rating = None
+    if instance.pk:
+        instance._previous_rating = Review.objects.filter(
+            pk=instance.pk).values_list("product_id", "rating").first()
+
+
 @receiver(post_save, sender=Review)
-def update_product_rating(sender, instance, **kwargs):
-    if instance.product:
-        instance.product.save()
+def update_product_rating(sender, instance, created, **kwargs):
+    previous = getattr(instance, "_previous_rating", None)
+    current = (instance.product_id, instance.rating)
+    if previous == current:
+        return
+    if previous:
+        adjust_product_rating(previous[0], previous[1], -1)
+    adjust_product_rating(current[0], current[1], 1)
+
+
+@receiver(post_delete, sender=Review)
+def remove_product_rating(sender, instance, **kwargs):
+    adjust_product_rating(instance.product_id, instance.rating, -1)
+
+# Signal handlers keeping Product.order_count equal to its paid order items
+
+
+@receiver(pre_save, sender=CartOrder)
+def remember_payment_status(sender, instance, **kwargs):
+    instance._previous_payment_status = None
+    if instance.pk:
+        instance._previous_payment_status = CartOrder.objects.filter(
+            pk=instance.pk).values_list("payment_status", flat=True).first()
+
+
+@receiver(post_save, sender=CartOrder)
+def update_order_counts(sender, instance, **kwargs):
+    was_paid = getattr(instance, "_previous_payment_status", None) == "paid"
+    is_paid = instance.payment_status == "paid"
+    if was_paid == is_paid:
+        return
+
+    counts = dict(
+        CartOrderItem.objects.filter(order=instance)
+        .values("product_id")
+        .annotate(count=models.Count("id"))
+        .values_list("product_id", "count")
+    )
+    adjust_product_order_count(counts, 1 if is_paid else -1)
+
+
+@receiver(pre_save, sender=CartOrderItem)
+def remember_order_item_product(sender, instance, **kwargs):
+    instance._previous_product_id = None
+    if instance.pk:
+        instance._previous_product_id = CartOrderItem.objects.filter(
+            pk=instance.pk).values_list("product_id", flat=True).first()
+
+
+@receiver(post_save, sender=CartOrderItem)
+def update_order_item_count(sender, instance, created, **kwargs):
+    previous = getattr(instance, "_previous_product_id", None)
+    if not created and previous == instance.product_id:
+        return
+    if instance.order.payment_status != "paid":
+        return
+    if previous:
+        adjust_product_order_count({previous: 1}, -1)
+    adjust_product_order_count({instance.product_id: 1}, 1)
+
+
+@receiver(post_delete, sender=CartOrderItem)
+def remove_order_item_count(sender, instance, **kwargs):
+    if instance.order.payment_status == "paid":
+        adjust_product_order_count({instance.product_id: 1}, -1)
 
 # Define a model for Wishlist
 
 
+# Signal handlers moving Product.updated for changes that don't save the
+# product row but show in its exports, so ?updated_since= pulls see them
+
+
+def touch_products(**lookup):
+    Product.objects.filter(**lookup).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=Gallery)
+@receiver(post_delete, sender=Gallery)
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+def touch_child_product(sender, instance, **kwargs):
+    if instance.product_id:
+        touch_products(pk=instance.product_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def touch_category_products(sender, instance, **kwargs):
+    touch_products(category=instance)
+
+
+@receiver(post_save, sender=Vendor)
+def touch_vendor_products(sender, instance, **kwargs):
+    touch_products(vendor=instance)
+
+
 class Wishlist(models.Model):
     # A foreign key relationship to the User model with CASCADE deletion
     user = models.ForeignKey(
@@ -532,6 +834,78 @@ class Coupon(models.Model):
         return self.code
 
 
+class ProductPair(models.Model):
+    # Number of paid orders containing both products; each pair is stored
+    # in both directions so a product's neighbours share an index prefix
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "other"], name="unique_product_pair"),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} - {self.other_id}: {self.count}'
+
+
+class ProductPairOrder(models.Model):
+    # Orders whose products are in the ProductPair counts, so each run of
+    # build_related_products only reads orders paid or refunded since
+    order = models.OneToOneField(CartOrder, on_delete=models.CASCADE, primary_key=True)
+
+    def __str__(self):
+        return str(self.order_id)
+
+
+class RelatedProduct(models.Model):
+    # The products most often bought with `product`, best first, kept by
+    # the build_related_products command from ProductPair
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="related_products")
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="related_to")
+    rank = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["product", "rank"]
+        constraints = [
+            models.UniqueConstraint(fields=["product", "rank"], name="unique_related_product_rank"),
+        ]
+
+    def __str__(self):
+        return f'{self.product.title} - {self.related.title}'
+
+
+class StoredFile(models.Model):
+    # A file kept by the content addressed media storage (store/storage.py),
+    # with the number of file fields pointing at it. Files nothing points
+    # at are removed by the collect_media command.
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["references", "date"]),
+        ]
+
+    def __str__(self):
+        return f'{self.name}: {self.references}'
+
+
+class CacheVersion(models.Model):
+    # The current version of a cached resource (store.cache.get_versions),
+    # in the database so every worker and management command shares it
+    name = models.CharField(max_length=255, unique=True)
+    timestamp = models.FloatField()
+    token = models.CharField(max_length=32)
+
+    def __str__(self):
+        return f'{self.name}: {self.token}'
+
+
 class Tax(models.Model):
     country = models.CharField(max_length=100)
     rate = models.IntegerField(
@@ -0,0 +1,194 @@
+import base64
+import binascii
+import json
+import math
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opt-in keyset (cursor) pagination.
+
+    A list is only paginated when the client sends `cursor` or `page_size`,
+    so existing clients keep receiving plain lists. Pages are fetched with a
+    `WHERE (ordering) < (last row)` filter instead of an OFFSET, which keeps
+    every page O(page_size) no matter how deep the client pages.
+
+    The ordering is taken from the queryset's `order_by()`, then the view's
+    `keyset_ordering`, then the model's Meta ordering, and always ends with
+    the primary key so cursors are stable.
+    """
+    page_size = api_settings.PAGE_SIZE or 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    default_ordering = ('-id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset, view)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor['reverse']
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [self.invert(field) for field in ordering]
+
+        queryset = queryset.order_by(*ordering)
+        if cursor is not None:
+            try:
+                queryset = queryset.filter(
+                    self.build_filter(ordering, cursor['position']))
+            except (ValueError, TypeError, OverflowError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset, view):
+        candidates = (
+            queryset.query.order_by,
+            getattr(view, 'keyset_ordering', None),
+            queryset.model._meta.ordering,
+            self.default_ordering,
+        )
+        for ordering in candidates:
+            if ordering and all(self.is_plain_field(field) for field in ordering):
+                break
+
+        ordering = list(ordering)
+        pk_name = queryset.model._meta.pk.attname
+        if ordering[-1].lstrip('-') not in (pk_name, 'pk'):
+            descending = ordering[0].startswith('-')
+            ordering.append('-' + pk_name if descending else pk_name)
+        return ordering
+
+    def is_plain_field(self, field):
+        return isinstance(field, str) and field not in ('?', '-?') and '__' not in field
+
+    def invert(self, field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    def build_filter(self, ordering, position):
+        # (a, b, c) > (x, y, z) expanded as
+        # a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_link(self.page[0], reverse=True)
+
+    def encode_link(self, instance, reverse):
+        position = [
+            self.encode_value(getattr(instance, field.lstrip('-')))
+            for field in self.ordering
+        ]
+        payload = json.dumps({'p': position, 'r': int(reverse)})
+        token = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def encode_value(self, value):
+        # Keep full precision: the values are fed straight back into filters.
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            position = payload['p']
+            reverse = bool(payload['r'])
+        except (TypeError, ValueError, KeyError, binascii.Error, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        # encode_value() only writes scalars, and numbers columns can hold
+        if not all(self.is_valid_value(value) for value in position):
+            raise NotFound(self.invalid_cursor_message)
+        return {'position': position, 'reverse': reverse}
+
+    def is_valid_value(self, value):
+        if isinstance(value, int):
+            return -2 ** 63 <= value < 2 ** 63
+        if isinstance(value, float):
+            return math.isfinite(value)
+        return value is None or isinstance(value, str)
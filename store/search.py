@@ -0,0 +1,286 @@
+import re
+
+from django.conf import settings
+from django.db import connection, models
+from django.db.models import Case, Q, Value, When
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from store.models import Product, Category, Specification
+from store.fuzzy import get_fuzzy_backend
+
+
+TERM = re.compile(r"\w+")
+
+# Most query terms looked at, and most ids fetched from the index, per search
+MAX_TERMS = 8
+
+
+def get_max_results():
+    return getattr(settings, "SEARCH_MAX_RESULTS", 1000)
+
+
+def get_fuzzy_min_results():
+    # Searches matching fewer products also get typo-tolerant matches; 0 never does
+    return getattr(settings, "SEARCH_FUZZY_MIN_RESULTS", 3)
+
+
+def parse_terms(query):
+    return [term.lower() for term in TERM.findall(query or "")][:MAX_TERMS]
+
+
+def chunked(ids, size=500):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+class SearchBackend:
+    """
+    Matches products without an index, the way the search view always did:
+    `title` contains the query or the category title equals it. Used on
+    databases without a full-text backend below.
+    """
+    table = None
+
+    def is_available(self):
+        return True
+
+    def search(self, terms, limit):
+        # Ranked product ids, or None to filter the queryset instead
+        return None
+
+    def filter(self, queryset, query):
+        return queryset.filter(
+            Q(title__icontains=query) | Q(category__title__iexact=query))
+
+    def index_products(self, product_ids):
+        pass
+
+    def remove_products(self, product_ids):
+        pass
+
+    def index_range(self, after, until=None):
+        pass
+
+    def clear(self):
+        pass
+
+
+class IndexedSearchBackend(SearchBackend):
+    # Shared by the full-text backends: one index row per published product
+
+    def is_available(self):
+        return self.table in connection.introspection.table_names()
+
+    def execute(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def fetch_ids(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    # delete_sql() and insert_sql() take a condition on the product id,
+    # such as "IN (%s, %s)"
+
+    def index_products(self, product_ids):
+        for ids in chunked(product_ids):
+            condition = f"IN ({placeholders(ids)})"
+            self.execute(self.delete_sql(condition), ids)
+            self.execute(self.insert_sql(condition), ids)
+
+    def remove_products(self, product_ids):
+        for ids in chunked(product_ids):
+            self.execute(self.delete_sql(f"IN ({placeholders(ids)})"), ids)
+
+    def index_range(self, after, until=None):
+        """
+        Replace the index rows of the product ids in (after, until], or of
+        every id after `after` without `until`. Rows of products deleted or
+        unpublished since they were indexed go too. Run in a transaction,
+        searches see the old rows until it commits.
+        """
+        if until is None:
+            condition, params = "> %s", [after]
+        else:
+            condition, params = "BETWEEN %s AND %s", [after + 1, until]
+        self.execute(self.delete_sql(condition), params)
+        self.execute(self.insert_sql(condition), params)
+
+    def clear(self):
+        self.execute(f"DELETE FROM {self.table}")
+
+    def tables(self):
+        return {
+            "product": Product._meta.db_table,
+            "category": Category._meta.db_table,
+            "specification": Specification._meta.db_table,
+        }
+
+
+class SQLiteSearchBackend(IndexedSearchBackend):
+    """
+    SQLite FTS5 with the porter stemmer. Every term is a prefix match and
+    results are ranked by bm25, weighting title over category, then
+    specifications, then description.
+    """
+    table = "store_product_fts"
+    weights = (10.0, 4.0, 2.0, 1.0)
+
+    def delete_sql(self, condition):
+        return f"DELETE FROM {self.table} WHERE rowid {condition}"
+
+    def insert_sql(self, condition):
+        return """
+            INSERT INTO {fts} (rowid, title, category, specification, description)
+            SELECT p.id, p.title, COALESCE(c.title, ''),
+                   COALESCE((
+                       SELECT group_concat(COALESCE(s.title, '') || ' ' || COALESCE(s.content, ''), ' ')
+                       FROM {specification} s WHERE s.product_id = p.id
+                   ), ''),
+                   COALESCE(p.description, '')
+            FROM {product} p
+            LEFT JOIN {category} c ON c.id = p.category_id
+            WHERE p.id {condition} AND p.status = 'published'
+        """.format(fts=self.table, condition=condition, **self.tables())
+
+    def search(self, terms, limit):
+        match = " ".join(f'"{term}"*' for term in terms)
+        weights = ", ".join(str(weight) for weight in self.weights)
+        return self.fetch_ids(
+            f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s "
+            f"ORDER BY bm25({self.table}, {weights}) LIMIT %s",
+            [match, limit])
+
+
+class PostgresSearchBackend(IndexedSearchBackend):
+    """
+    Postgres tsvector documents behind a GIN index. Every term is a prefix
+    match and results are ranked by ts_rank_cd over the weighted document
+    (title A, category B, specifications C, description D).
+    """
+    table = "store_product_search"
+    config = "english"
+
+    def delete_sql(self, condition):
+        return f"DELETE FROM {self.table} WHERE product_id {condition}"
+
+    def insert_sql(self, condition):
+        return """
+            INSERT INTO {search} (product_id, document)
+            SELECT p.id,
+                   setweight(to_tsvector('{config}', COALESCE(p.title, '')), 'A') ||
+                   setweight(to_tsvector('{config}', COALESCE(c.title, '')), 'B') ||
+                   setweight(to_tsvector('{config}', COALESCE((
+                       SELECT string_agg(COALESCE(s.title, '') || ' ' || COALESCE(s.content, ''), ' ')
+                       FROM {specification} s WHERE s.product_id = p.id
+                   ), '')), 'C') ||
+                   setweight(to_tsvector('{config}', COALESCE(p.description, '')), 'D')
+            FROM {product} p
+            LEFT JOIN {category} c ON c.id = p.category_id
+            WHERE p.id {condition} AND p.status = 'published'
+        """.format(search=self.table, config=self.config, condition=condition, **self.tables())
+
+    def search(self, terms, limit):
+        query = " & ".join(f"{term}:*" for term in terms)
+        return self.fetch_ids(
+            f"SELECT product_id FROM {self.table}, to_tsquery('{self.config}', %s) query "
+            f"WHERE document @@ query "
+            f"ORDER BY ts_rank_cd(document, query) DESC, product_id DESC LIMIT %s",
+            [query, limit])
+
+
+BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+_backends = {}
+
+
+def get_backend():
+    # The full-text backend for this database once its index table exists
+    # (see migration 0012), otherwise the unindexed fallback
+    vendor = connection.vendor
+    if vendor not in _backends:
+        backend = BACKENDS.get(vendor, SearchBackend)()
+        _backends[vendor] = backend if backend.is_available() else SearchBackend()
+    return _backends[vendor]
+
+
+def search_products(queryset, query):
+    """
+    Narrow a Product queryset to the matches for `query`, best first.
+
+    The order is exposed as a `search_rank` annotation so keyset
+    pagination can page through it. When there are fewer than
+    SEARCH_FUZZY_MIN_RESULTS matches, titles spelled like the query follow
+    them, most similar first.
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return queryset
+
+    backend = get_backend()
+    ids = backend.search(terms, get_max_results())
+    min_results = get_fuzzy_min_results()
+    if ids is None:
+        matches = backend.filter(queryset, query)
+        if not min_results or matches.count() >= min_results:
+            return matches
+        ids = list(matches.values_list("pk", flat=True))
+
+    if len(ids) < min_results:
+        seen = set(ids)
+        ids += [pk for pk in get_fuzzy_backend().search(terms, get_max_results()) if pk not in seen]
+    if not ids:
+        return queryset.none()
+
+    rank = Case(
+        *[When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)],
+        output_field=models.IntegerField())
+    return queryset.filter(pk__in=ids).annotate(search_rank=rank).order_by("search_rank", "id")
+
+
+# Signal handlers keeping the search index in step with the catalog
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    get_backend().index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    get_backend().remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+def index_specification_product(sender, instance, **kwargs):
+    if instance.product_id:
+        get_backend().index_products([instance.product_id])
+
+
+@receiver(post_save, sender=Category)
+def index_category_products(sender, instance, created, **kwargs):
+    if not created:
+        get_backend().index_products(
+            Product.objects.filter(category=instance).values_list("pk", flat=True))
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    instance._search_product_ids = list(
+        Product.objects.filter(category=instance).values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def index_uncategorized_products(sender, instance, **kwargs):
+    get_backend().index_products(getattr(instance, "_search_product_ids", []))
@@ -1,7 +1,10 @@
 from rest_framework import serializers
 from userauths.serializer import ProfileSerializer
+from store.fieldsets import SparseFieldsetMixin
+from store.compiled import CompiledSerializerMixin
+from store.images import ImageDerivativesField
 
-from store.models import Cart, CartOrderItem, Notification, Product, Category, CartOrder, Gallery, ProductFaq, Review, Specification, Coupon, Color, Size, Wishlist, Vendor, Gallery
+from store.models import RATING, Cart, CartOrderItem, Notification, Product, Category, CartOrder, Gallery, ProductFaq, Review, Specification, Coupon, Color, Size, Wishlist, Vendor, Gallery
 from vendor.models import Vendor
 
 # Define a serializer for the Category model
@@ -17,6 +20,7 @@ class CategorySerializer(serializers.ModelSerializer):
 
 class GallerySerializer(serializers.ModelSerializer):
     # Serialize the related Product model
+    image_derivatives = ImageDerivativesField()
 
     class Meta:
         model = Gallery
@@ -52,19 +56,34 @@ class ColorSerializer(serializers.ModelSerializer):
 # Define a serializer for the Product model
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(CompiledSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
 
     gallery = GallerySerializer(many=True, read_only=True)
     color = ColorSerializer(many=True, read_only=True)
     size = SizeSerializer(many=True, read_only=True)
     specification = SpecificationSerializer(many=True, read_only=True)
+    image_derivatives = ImageDerivativesField()
+
+    related_sources = {
+        "gallery": ["gallery_set"],
+        "color": ["color_set"],
+        "size": ["size_set"],
+        "specification": ["specification_set"],
+    }
+    source_columns = {
+        "product_rating": ["rating_avg", "rating_count"],
+        "rating_histogram": [f"rating_{rating}_count" for rating, label in RATING],
+    }
 
     class Meta:
         model = Product
+        # Nesting depth for reads, POST requests always use depth 0
+        depth = 3
         fields = [
             "id",
             "title",
             "image",
+            "image_derivatives",
             "description",
             "category",
             "price",
@@ -75,206 +94,142 @@ class ProductSerializer(serializers.ModelSerializer):
             "status",
             "featured",
             "views",
-            # "rating",
             "vendor",
             "pid",
             "slug",
             "date",
+            "updated",
             "gallery",
             "specification",
             "size",
             "color",
             "product_rating",
+            "rating_histogram",
             "rating_count",
             "order_count",
         ]
-
-    def __init__(self, *args, **kwargs):
-        super(ProductSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        read_only_fields = ["rating_count", "order_count"]
 
 # Define a serializer for the Cart model
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(CompiledSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     # Serialize the related Product model
     product = ProductSerializer()
 
     class Meta:
         model = Cart
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(CartSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 # Define a serializer for the CartOrderItem model
 
 
-class CartOrderItemSerializer(serializers.ModelSerializer):
+class CartOrderItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = CartOrderItem
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(CartOrderItemSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 # Define a serializer for the CartOrder model
 
 
-class CartOrderSerializer(serializers.ModelSerializer):
+class CartOrderSerializer(CompiledSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     orderitem = CartOrderItemSerializer(many=True, read_only=True)
 
+    related_sources = {
+        "orderitem": ["cartorderitem_set"],
+    }
+
     class Meta:
         model = CartOrder
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(CartOrderSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 # Define a serializer for the ProductFaq model
 
 
-class ProductFaqSerializer(serializers.ModelSerializer):
+class ProductFaqSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = ProductFaq
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(ProductFaqSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 
-class VendorSerializer(serializers.ModelSerializer):
+class VendorSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Vendor
         fields = '__all__'
+        depth = 3
 
-    def __init__(self, *args, **kwargs):
-        super(VendorSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
 
-
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(CompiledSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     # Serialize the related Product model
     product = ProductSerializer()
     profile = ProfileSerializer()
 
+    related_sources = {
+        "profile": ["user__profile", "user__groups", "user__user_permissions"],
+    }
+
     class Meta:
         model = Review
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(ReviewSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Wishlist
         fields = '__all__'
+        depth = 3
 
-    def __init__(self, *args, **kwargs):
-        super(WishlistSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
 
-
-class CouponSerializer(serializers.ModelSerializer):
+class CouponSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Coupon
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(CouponSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
 
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Notification
         fields = '__all__'
-
-    def __init__(self, *args, **kwargs):
-        super(NotificationSerializer, self).__init__(*args, **kwargs)
-        # Customize serialization depth based on the request method.
-        request = self.context.get('request')
-        if request and request.method == 'POST':
-            # When creating a new product FAQ, set serialization depth to 0.
-            self.Meta.depth = 0
-        else:
-            # For other methods, set serialization depth to 3.
-            self.Meta.depth = 3
+        depth = 3
+
+
+class CartBatchItemSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    qty = serializers.IntegerField(min_value=1)
+    price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    shipping_amount = serializers.DecimalField(max_digits=12, decimal_places=2, default=0)
+    size = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    color = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+
+
+class CartBatchSerializer(serializers.Serializer):
+    # Input of CartBatchAPIView; user_id may be "undefined" like CartAPIView's
+    max_items = 100
+
+    cart_id = serializers.CharField(max_length=1000)
+    user_id = serializers.CharField(required=False, allow_null=True)
+    country = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    items = CartBatchItemSerializer(many=True, allow_empty=False, max_length=max_items)
+
+    def validate_user_id(self, value):
+        if value in (None, "", "undefined"):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise serializers.ValidationError("A valid integer is required.")
 
 
 class SummarySerializer(serializers.Serializer):
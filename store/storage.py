@@ -0,0 +1,259 @@
+import hashlib
+import posixpath
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.functional import cached_property
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from store.imaging import LOCATION as DERIVATIVES_LOCATION
+from store.models import Category, Gallery, Product, StoredFile
+from userauths.models import Profile
+from vendor.models import Vendor
+
+CONTENT_LOCATION = "content"
+
+
+def content_digest(content):
+    # sha256 of a file read in chunks, and its size
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in content.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class ContentAddressedMixin:
+    """
+    Storage mixin saving files under the hash of their bytes.
+
+    Whatever name an upload asks for, it is stored as
+    `content/<ab>/<sha256><ext>`: uploading bytes the storage already has
+    skips the upload and returns the existing name, so the same picture
+    used by several products, or sent again on every product edit, is kept
+    once. Each stored file has a StoredFile row counting the file fields
+    pointing at it (see the signal handlers below); collect_media removes
+    the files nothing points at anymore.
+
+    Image derivatives already carry their source's hash and are saved as
+    named.
+    """
+
+    def is_content_addressed(self, name):
+        return not name.startswith(DERIVATIVES_LOCATION + "/")
+
+    def content_name(self, digest, name):
+        extension = posixpath.splitext(name)[1].lower()
+        return f"{CONTENT_LOCATION}/{digest[:2]}/{digest}{extension}"
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        if not self.is_content_addressed(name):
+            return super().save(name, content, max_length=max_length)
+
+        digest, size = content_digest(content)
+        name = self.content_name(digest, name)
+        validate_file_name(name, allow_relative_path=True)
+        with transaction.atomic():
+            # Touching the row locks it until the upload commits, so
+            # collect_media (which deletes files under that lock) can't
+            # remove the file between the check below and its use, and the
+            # new date restarts the grace period until a row points at it
+            if not StoredFile.objects.filter(name=name).update(date=timezone.now()):
+                StoredFile.objects.get_or_create(name=name, defaults={"size": size})
+            if not self.exists(name):
+                name = self._save(name, content)
+        return name
+
+    def delete(self, name):
+        # Other rows may share the file: only unreferenced ones go
+        if StoredFile.objects.filter(name=name, references__gt=0).exists():
+            return
+        super().delete(name)
+
+
+class URLCache:
+    # Least recently used bounded map of storage name -> URL
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.urls = OrderedDict()
+
+    def get(self, name):
+        with self.lock:
+            url = self.urls.get(name)
+            if url is not None:
+                self.urls.move_to_end(name)
+            return url
+
+    def set(self, name, url):
+        with self.lock:
+            self.urls[name] = url
+            self.urls.move_to_end(name)
+            while len(self.urls) > self.maxsize:
+                self.urls.popitem(last=False)
+
+    def discard(self, name):
+        with self.lock:
+            self.urls.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.urls.clear()
+
+
+class CachedURLMixin:
+    """
+    Storage mixin remembering the URL built for each name, so serializing
+    the same images over and over (a product list renders dozens of file
+    fields per row) doesn't rebuild the URL every time.
+
+    The MEDIA_URL_CACHE_SIZE most recently used URLs are kept per process.
+    A name's URL is forgotten when a file is saved under it or deleted.
+    Storages whose URLs expire (signed ones) are never cached.
+    """
+
+    @cached_property
+    def url_cache(self):
+        return URLCache(getattr(settings, "MEDIA_URL_CACHE_SIZE", 10000))
+
+    def has_stable_urls(self):
+        return True
+
+    def url(self, name, *args, **kwargs):
+        if args or kwargs or not self.has_stable_urls():
+            return super().url(name, *args, **kwargs)
+        url = self.url_cache.get(name)
+        if url is None:
+            url = super().url(name)
+            self.url_cache.set(name, url)
+        return url
+
+    def _save(self, name, content):
+        name = super()._save(name, content)
+        self.url_cache.discard(name)
+        return name
+
+    def delete(self, name):
+        super().delete(name)
+        self.url_cache.discard(name)
+
+
+class MediaStorage(ContentAddressedMixin, CachedURLMixin, S3Boto3Storage):
+    """
+    The S3 bucket media files are uploaded to. Uploads and image
+    derivatives are named after a hash of their content, so a name never
+    points to other bytes and clients may keep them for a year.
+    """
+    immutable_cache_control = "public, max-age=31536000, immutable"
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        # `name` includes the bucket location
+        location = self.location.strip("/")
+        if location and name.startswith(location + "/"):
+            name = name[len(location) + 1:]
+        if name.startswith((CONTENT_LOCATION + "/", DERIVATIVES_LOCATION + "/")):
+            params["CacheControl"] = self.immutable_cache_control
+        if name.startswith(DERIVATIVES_LOCATION + "/"):
+            # Not every Python's mimetypes knows .webp/.avif
+            params["ContentType"] = "image/" + posixpath.splitext(name)[1][1:]
+        return params
+
+    def has_stable_urls(self):
+        # Plain custom domain or unsigned URLs, not presigned ones
+        if self.custom_domain:
+            return not (self.querystring_auth and self.cloudfront_signer)
+        return not self.querystring_auth
+
+
+class LocalMediaStorage(ContentAddressedMixin, CachedURLMixin, FileSystemStorage):
+    # MediaStorage's naming on the local MEDIA_ROOT, for development and tests
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        # MEDIA_URL and friends changed
+        super()._clear_cached_properties(setting, **kwargs)
+        self.url_cache.clear()
+
+
+# Models whose file fields may point at stored files
+FILE_FIELDS = {
+    Category: ["image"],
+    Product: ["image"],
+    Gallery: ["image"],
+    Vendor: ["image"],
+    Profile: ["image"],
+}
+
+
+def content_addressed_fields(model):
+    return [
+        name for name in FILE_FIELDS[model]
+        if isinstance(model._meta.get_field(name).storage, ContentAddressedMixin)
+    ]
+
+
+def adjust_references(names, delta):
+    # Add `delta` references for each time a stored name appears in `names`
+    by_count = defaultdict(list)
+    stored = Counter(name for name in names if name and name.startswith(CONTENT_LOCATION + "/"))
+    for name, count in stored.items():
+        by_count[count].append(name)
+    for count, batch in by_count.items():
+        StoredFile.objects.filter(name__in=batch).update(
+            references=Greatest(F("references") + delta * count, 0))
+
+
+# Signal handlers keeping StoredFile.references up to date
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=Gallery)
+@receiver(pre_save, sender=Vendor)
+@receiver(pre_save, sender=Profile)
+def remember_stored_files(sender, instance, **kwargs):
+    instance._previous_files = []
+    fields = content_addressed_fields(sender)
+    if fields and instance.pk and not instance._state.adding:
+        row = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+        instance._previous_files = list(row or [])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Gallery)
+@receiver(post_save, sender=Vendor)
+@receiver(post_save, sender=Profile)
+def count_stored_files(sender, instance, **kwargs):
+    fields = content_addressed_fields(sender)
+    if not fields:
+        return
+    previous = Counter(name for name in getattr(instance, "_previous_files", []) if name)
+    current = Counter(getattr(instance, field).name for field in fields if getattr(instance, field))
+    adjust_references((current - previous).elements(), 1)
+    adjust_references((previous - current).elements(), -1)
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Gallery)
+@receiver(post_delete, sender=Vendor)
+@receiver(post_delete, sender=Profile)
+def release_stored_files(sender, instance, **kwargs):
+    fields = content_addressed_fields(sender)
+    adjust_references([getattr(instance, field).name for field in fields if getattr(instance, field)], -1)
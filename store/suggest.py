@@ -0,0 +1,312 @@
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from functools import partial
+from operator import attrgetter
+
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from store.cache import SharedIndexMixin
+from store.models import Product, Category, CartOrder, CartOrderItem
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+
+# Sorts after every character, closing the range of keys sharing a prefix
+END = "\U0010ffff"
+
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+
+
+def normalize(text):
+    # Lowercase, without accents, words separated by single spaces
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(WORD.findall(text.casefold()))
+
+
+def word_keys(text):
+    # "wireless headphones" -> ["wireless headphones", "headphones"], so a
+    # prefix of any word matches the title from there on
+    text = normalize(text)
+    return [text[match.start():] for match in WORD.finditer(text)]
+
+
+class Entry:
+    __slots__ = ("id", "score", "payload", "keys")
+
+    def __init__(self, id, score, payload, keys):
+        self.id = id
+        self.score = score
+        self.payload = payload
+        self.keys = keys
+
+
+class PrefixList:
+    """
+    Entries under every word of their title, in one sorted array of keys
+    with a parallel array of entries. All the entries with a word starting
+    with a prefix sit in the contiguous range found by two bisects.
+
+    Ranges longer than `memo_threshold` keys (one or two letters typed) are
+    ranked once and remembered; changing an entry forgets only the
+    prefixes of its own keys.
+    """
+    memo_threshold = 256
+
+    def __init__(self):
+        self.keys = []
+        self.entries = []
+        self.by_id = {}
+        self.memo = {}
+
+    def set(self, id, title, score, payload, sort=True):
+        self.remove(id)
+        entry = Entry(id, score, payload, word_keys(title))
+        self.by_id[id] = entry
+        for key in entry.keys:
+            if sort:
+                index = bisect_right(self.keys, key)
+                self.keys.insert(index, key)
+                self.entries.insert(index, entry)
+            else:
+                self.keys.append(key)
+                self.entries.append(entry)
+        self.forget(entry)
+
+    def sort(self):
+        # After adding with sort=False
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.keys = [self.keys[index] for index in order]
+        self.entries = [self.entries[index] for index in order]
+        self.memo = {}
+
+    def remove(self, id):
+        entry = self.by_id.pop(id, None)
+        if entry is None:
+            return
+        for key in entry.keys:
+            index = bisect_left(self.keys, key)
+            while index < len(self.keys) and self.keys[index] == key:
+                if self.entries[index] is entry:
+                    del self.keys[index]
+                    del self.entries[index]
+                    break
+                index += 1
+        self.forget(entry)
+
+    def rescore(self, id, score):
+        entry = self.by_id.get(id)
+        if entry is not None and entry.score != score:
+            entry.score = score
+            self.forget(entry)
+
+    def forget(self, entry):
+        if not self.memo:
+            return
+        for key in entry.keys:
+            for length in range(1, len(key) + 1):
+                self.memo.pop(key[:length], None)
+
+    def lookup(self, prefix, limit):
+        memo = self.memo.get(prefix)
+        if memo is not None and limit in memo:
+            return memo[limit]
+
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + END, start)
+        best = heapq.nlargest(limit, set(self.entries[start:end]), key=attrgetter("score"))
+        result = [entry.payload for entry in best]
+        if end - start > self.memo_threshold:
+            self.memo.setdefault(prefix, {})[limit] = result
+        return result
+
+
+class SuggestIndex(SharedIndexMixin):
+    """
+    Search-as-you-type over published product titles and category titles,
+    each in a `PrefixList`. Matches are ranked by popularity: paid orders
+    then views for products, published products for categories.
+
+    The index lives in the worker's memory. It is built on first use (or at
+    startup through `warm()`) and rebuilt when the shared "suggestions"
+    version moved, which lookups check every VERSION_CHECK_INTERVAL
+    seconds. Catalog changes reported by signals are applied to the saving
+    worker's index once they commit and move that version, so the other
+    workers rebuild theirs (see `apply()`); imports bump it directly.
+    """
+    version_name = "suggestions"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+            self.version = None
+            self.checked = None
+
+    def _clear(self):
+        self.built = False
+        self.products = PrefixList()
+        self.categories = PrefixList()
+        self.product_categories = {}
+        self.category_counts = Counter()
+
+    def warm(self):
+        # Called at worker startup; a missing database leaves it to first use
+        try:
+            self.ensure_built()
+        except DatabaseError:
+            logger.warning("Could not build the suggestion index at startup", exc_info=True)
+
+    def ensure_built(self):
+        # Read first, so a change made during the build triggers another
+        version = self.stale_version()
+        if version is None:
+            return
+        products = list(
+            Product.objects.filter(status="published")
+            .values_list("id", "pid", "slug", "title", "category_id", "order_count", "views"))
+        categories = list(Category.objects.values_list("id", "slug", "title"))
+        with self.lock:
+            if self.built and self.version == version:
+                return
+            self._clear()
+            for row in products:
+                self._add_product(*row, sort=False)
+            for row in categories:
+                self._add_category(*row, sort=False)
+            self.products.sort()
+            self.categories.sort()
+            self.built = True
+            self.version = version
+            self.checked = time.monotonic()
+
+    # Changes, made with the lock held
+
+    def _add_product(self, id, pid, slug, title, category_id, order_count, views, sort=True):
+        self._remove_product(id)
+        self.products.set(id, title, product_score(id, order_count, views),
+                          {"pid": pid, "slug": slug, "title": title}, sort=sort)
+        if category_id is not None:
+            self.product_categories[id] = category_id
+            self._count_category(category_id, 1)
+
+    def _remove_product(self, id):
+        self.products.remove(id)
+        category_id = self.product_categories.pop(id, None)
+        if category_id is not None:
+            self._count_category(category_id, -1)
+
+    def _add_category(self, id, slug, title, sort=True):
+        self.categories.set(id, title, (self.category_counts[id], -id),
+                            {"id": id, "slug": slug, "title": title}, sort=sort)
+
+    def _count_category(self, id, delta):
+        self.category_counts[id] += delta
+        self.categories.rescore(id, (self.category_counts[id], -id))
+
+    def _rescore(self, rows):
+        for id, order_count, views in rows:
+            self.products.rescore(id, product_score(id, order_count, views))
+
+    # Signal entry points, called once the change commits
+
+    def update_product(self, product):
+        if product.status == "published":
+            self.apply(self._add_product, product.pk, product.pid, product.slug, product.title,
+                       product.category_id, product.order_count, product.views)
+        else:
+            self.apply(self._remove_product, product.pk)
+
+    def remove_product(self, product_id):
+        self.apply(self._remove_product, product_id)
+
+    def update_category(self, category):
+        self.apply(self._add_category, category.pk, category.slug, category.title)
+
+    def remove_category(self, category_id):
+        self.apply(self.categories.remove, category_id)
+
+    def update_scores(self, product_ids):
+        # Products whose counters moved
+        rows = []
+        if self.built:
+            rows = list(Product.objects.filter(pk__in=product_ids).values_list("id", "order_count", "views"))
+        self.apply(self._rescore, rows)
+
+    # Lookups
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """
+        `{"products": [...], "categories": [...]}`, at most `limit` of each,
+        most popular first, whose titles have a word starting with `query`.
+        """
+        if normalize(query):
+            self.ensure_built()
+        return self.lookup(query, limit)
+
+    def lookup(self, query, limit=DEFAULT_LIMIT):
+        # suggest() on the index as it is, without looking for changes
+        prefix = normalize(query)
+        if not prefix:
+            return {"products": [], "categories": []}
+
+        with self.lock:
+            return {
+                "products": self.products.lookup(prefix, limit),
+                "categories": self.categories.lookup(prefix, limit),
+            }
+
+
+def product_score(id, order_count, views):
+    # Older products win ties so the order is stable
+    return (order_count or 0, views or 0, -id)
+
+
+suggest_index = SuggestIndex()
+
+
+# Signal handlers keeping the suggestion index in step with the catalog,
+# once the change commits (a rolled back save changes nothing)
+
+
+@receiver(post_save, sender=Product)
+def suggest_product(sender, instance, **kwargs):
+    transaction.on_commit(partial(suggest_index.update_product, instance))
+
+
+@receiver(post_delete, sender=Product)
+def unsuggest_product(sender, instance, **kwargs):
+    transaction.on_commit(partial(suggest_index.remove_product, instance.pk))
+
+
+@receiver(post_save, sender=Category)
+def suggest_category(sender, instance, **kwargs):
+    transaction.on_commit(partial(suggest_index.update_category, instance))
+
+
+@receiver(post_delete, sender=Category)
+def unsuggest_category(sender, instance, **kwargs):
+    transaction.on_commit(partial(suggest_index.remove_category, instance.pk))
+
+
+@receiver(post_save, sender=CartOrder)
+def rescore_order_products(sender, instance, **kwargs):
+    # Paying for (or refunding) an order changes the products' order_count
+    was_paid = getattr(instance, "_previous_payment_status", None) == "paid"
+    if was_paid == (instance.payment_status == "paid"):
+        return
+    product_ids = list(CartOrderItem.objects.filter(order=instance).values_list("product_id", flat=True))
+    transaction.on_commit(partial(suggest_index.update_scores, product_ids))
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from store.cache import bump_soon, get_check_interval, get_versions
+from store.models import Tax
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_country(country):
+    if not isinstance(country, str):
+        return None
+    return " ".join(country.split()).casefold()
+
+
+class TaxRates:
+    """
+    The Tax table as a country -> rate map, in the worker's memory.
+
+    Loaded at startup (or on first use) and reloaded when the "taxes"
+    version changes, which saves and deletes of Tax rows bump once they
+    commit. The version is a CacheVersion row shared by every worker and
+    read at most once every VERSION_CHECK_INTERVAL seconds, so most cart
+    updates make no query for their rate. A change reaches the worker that
+    saved it at once and the others within that interval.
+
+    Countries match regardless of case and surrounding or repeated
+    whitespace; when several rows match, the first by country and id wins,
+    as `Tax.objects.filter(country=...).first()` picked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rates = None
+        self.version = None
+        self.checked = None
+
+    def warm(self):
+        # Called at worker startup; a missing database leaves it to first use
+        try:
+            self.get_rate("")
+        except DatabaseError:
+            logger.warning("Could not load the tax rates at startup", exc_info=True)
+
+    def load(self, version):
+        rates = {}
+        for country, rate in Tax.objects.order_by("country", "pk").values_list("country", "rate"):
+            rates.setdefault(normalize_country(country), rate)
+        with self.lock:
+            self.rates = rates
+            self.version = version
+
+    def get_rate(self, country):
+        # The percentage for `country`, None when it has no Tax row
+        now = time.monotonic()
+        if self.rates is None or self.checked is None or now - self.checked >= get_check_interval():
+            version = get_versions("taxes")["taxes"]
+            if self.rates is None or self.version != version:
+                self.load(version)
+            self.checked = now
+        return self.rates.get(normalize_country(country))
+
+    def expire(self):
+        # Check the version on next use
+        self.checked = None
+
+    def reset(self):
+        with self.lock:
+            self.rates = None
+            self.version = None
+            self.checked = None
+
+
+tax_rates = TaxRates()
+
+
+# Signal handlers replacing the tax rates version
+
+
+@receiver(post_save, sender=Tax)
+@receiver(post_delete, sender=Tax)
+def invalidate_tax_rates(sender, instance, **kwargs):
+    bump_soon("taxes")
+    # This worker reloads right away, the others within VERSION_CHECK_INTERVAL
+    transaction.on_commit(tax_rates.expire)
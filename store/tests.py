@@ -1,3 +1,1607 @@
-from django.test import TestCase
+import base64
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from PIL import Image
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from userauths.models import User
+from vendor.models import Vendor
+from store.pagination import KeysetPagination
+from store.management.commands import benchmark_carts
+from store.models import Product, Category, Gallery, Specification, Size, Color, Review, CacheVersion, Cart, CartOrder, CartOrderItem, ProductPair, RelatedProduct, StoredFile, Tax
+from store import cache as product_cache
+from store.viewcounts import ViewCounter, view_counter
+from store.search import get_backend, search_products
+from store.suggest import SuggestIndex, suggest_index
+from store.fuzzy import TrigramIndex, trigram_index
+from store.images import Pipeline, pipeline
+from store.storage import LocalMediaStorage, MediaStorage
+from store.carts import cart_store
+from store.taxes import TaxRates, tax_rates
+from store.serializer import ProductSerializer, CartSerializer, CartOrderSerializer, ReviewSerializer
+from store.views import ProductListAPIView, SearchProductsAPIView
+
+
+def create_vendor(email="vendor@example.com"):
+    user = User.objects.create_user(
+        username=email.split('@')[0], email=email, password="password")
+    return Vendor.objects.create(user=user, name="Shop", slug=email.split('@')[0])
+
+
+def create_product(vendor, category, title="Product", buyer=None):
+    product = Product.objects.create(
+        title=title, category=category, vendor=vendor, price=10)
+
+    Gallery.objects.create(product=product)
+    Specification.objects.create(
+        product=product, title="Material", content="Cotton")
+    Size.objects.create(product=product, name="M", price=1)
+    Color.objects.create(product=product, name="Red", color_code="#f00")
+
+    if buyer is not None:
+        Review.objects.create(
+            user=buyer, product=product, rating=4, review="Nice")
+        order = CartOrder.objects.create(buyer=buyer)
+        CartOrderItem.objects.create(
+            order=order, vendor=vendor, product=product, qty=1)
+    return product
+
+
+class ProductListQueryTests(TestCase):
+
+    def setUp(self):
+        self.vendor = create_vendor()
+        self.category = Category.objects.create(title="Toys", slug="toys")
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@example.com", password="password")
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_product_list_query_count_does_not_depend_on_page_size(self):
+        for i in range(2):
+            create_product(self.vendor, self.category,
+                           f"Product {i}", self.buyer)
+        small_count, small_data = self.count_queries('/api/v1/products/')
+
+        for i in range(2, 8):
+            create_product(self.vendor, self.category,
+                           f"Product {i}", self.buyer)
+        large_count, large_data = self.count_queries('/api/v1/products/')
+
+        self.assertEqual(len(small_data), 2)
+        self.assertEqual(len(large_data), 8)
+        self.assertEqual(small_count, large_count)
+
+    def test_sparse_fields_skip_unrequested_relations(self):
+        create_product(self.vendor, self.category, "Only", self.buyer)
+        count, data = self.count_queries(
+            '/api/v1/products/?fields=title,price,vendor.name')
+
+        self.assertEqual(data, [
+            {"title": "Only", "price": "10.00", "vendor": {"name": "Shop"}}])
+        # The versions for the ETag, then the products
+        self.assertEqual(count, 2)
+
+    def test_expand_nests_only_listed_relations(self):
+        product = create_product(self.vendor, self.category, "Only", self.buyer)
+        count, data = self.count_queries(
+            '/api/v1/products/?fields=title,category,vendor,gallery&expand=vendor,gallery')
+
+        self.assertEqual(data[0]["category"], self.category.pk)
+        self.assertEqual(data[0]["vendor"]["name"], "Shop")
+        # vendor.user wasn't expanded
+        self.assertEqual(data[0]["vendor"]["user"], self.vendor.user.pk)
+        self.assertEqual([g["id"] for g in data[0]["gallery"]],
+                         list(product.gallery_set.values_list("id", flat=True)))
+        # The versions, the products with their vendors, the galleries
+        self.assertEqual(count, 3)
+
+        for i in range(4):
+            create_product(self.vendor, self.category, f"Product {i}", self.buyer)
+        more_count, more_data = self.count_queries(
+            '/api/v1/products/?fields=title,category,vendor,gallery&expand=vendor,gallery')
+        self.assertEqual(len(more_data), 5)
+        self.assertEqual(more_count, count)
+
+    def test_dotted_fields_select_inside_nested_objects(self):
+        create_product(self.vendor, self.category, "Only", self.buyer)
+        count, data = self.count_queries(
+            '/api/v1/products/?fields=title,vendor.name,vendor.user.username&expand=vendor.user')
+
+        self.assertEqual(data, [
+            {"title": "Only", "vendor": {"name": "Shop", "user": {"username": "vendor"}}}])
+        self.assertEqual(count, 2)
+
+    def test_unknown_field_names_are_rejected(self):
+        product = create_product(self.vendor, self.category, "Only")
+        for url, errors in (
+            ('/api/v1/products/?fields=title,nope', {"fields": ["Unknown field 'nope'."]}),
+            ('/api/v1/products/?fields=vendor.nope', {"fields": ["Unknown field 'nope'."]}),
+            ('/api/v1/products/?expand=vendor,nope', {"expand": ["Unknown field 'nope'."]}),
+            (f'/api/v1/products/{product.pid}/?fields=nope', {"fields": ["Unknown field 'nope'."]}),
+        ):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 400, url)
+            self.assertEqual(response.json(), errors)
+
+    def test_list_sorts_on_stored_counters(self):
+        low = create_product(self.vendor, self.category, "Low", self.buyer)
+        high = create_product(self.vendor, self.category, "High")
+        Review.objects.create(product=high, rating=5, review="Great")
+        Review.objects.filter(product=low).update(rating=1)
+        call_command("rebuild_product_stats", stdout=StringIO())
+
+        response = self.client.get('/api/v1/products/?sort=rating')
+        self.assertEqual([p["id"] for p in response.json()], [high.id, low.id])
+
+
+@override_settings(SEARCH_FUZZY_MIN_RESULTS=0)
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        self.products = [
+            Product.objects.create(title=f"Robot {i}", vendor=vendor, status="published")
+            for i in range(5)
+        ]
+        # The three oldest share a date, so the pk breaks their tie
+        now = timezone.now()
+        Product.objects.filter(pk__in=[p.pk for p in self.products[:3]]).update(date=now - timedelta(days=1))
+
+    def walk(self, url, params=None, link="next"):
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            data = response.json()
+            pages.append([product["id"] for product in data["results"]])
+            if data[link] is None:
+                return pages, data
+            response = self.client.get(data[link])
+
+    def cursor(self, payload):
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    def test_pages_forward_and_back_through_ties(self):
+        ids = [p.id for p in reversed(self.products)]
+        pages, last = self.walk('/api/v1/products/', {'page_size': 2})
+        self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:]])
+
+        back, first = self.walk(last["previous"], link="previous")
+        self.assertEqual(back, [ids[2:4], ids[0:2]])
+        self.assertIsNotNone(first["next"])
+
+    def test_invalid_cursors_are_not_found(self):
+        date = timezone.now().isoformat()
+        for cursor in ["garbage!!", self.cursor([]), self.cursor({"p": [1], "r": 0}),
+                       self.cursor({"p": ["yesterday", 1], "r": 0}),
+                       self.cursor({"p": [[1], {"id": 2}], "r": 0}),
+                       self.cursor({"p": [date, [2]], "r": 0}),
+                       self.cursor({"p": [date, "two"], "r": 0}),
+                       self.cursor({"p": [date, 1e400], "r": 0}),
+                       self.cursor({"p": [date, 10 ** 30], "r": 0})]:
+            response = self.client.get('/api/v1/products/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_ordering_follows_sort_and_falls_back_to_keyset_ordering(self):
+        pagination = KeysetPagination()
+        view = ProductListAPIView()
+        products = Product.objects.all()
+        self.assertEqual(pagination.get_ordering(products.sorted_by("rating"), view), ["-rating_avg", "-id"])
+        self.assertEqual(pagination.get_ordering(products, view), ["-date", "-id"])
+        self.assertEqual(pagination.get_ordering(products.order_by(F("title").desc()), view), ["-date", "-id"])
+        self.assertEqual(pagination.get_ordering(search_products(products, ""), view), ["-date", "-id"])
+        self.assertEqual(pagination.get_ordering(search_products(products, "robot"), SearchProductsAPIView()),
+                         ["search_rank", "id"])
+
+        Product.objects.filter(pk=self.products[1].pk).update(rating_avg=5)
+        Product.objects.filter(pk=self.products[3].pk).update(rating_avg=4)
+        pages, _ = self.walk('/api/v1/products/', {'page_size': 2, 'sort': 'rating'})
+        self.assertEqual(sum(pages, []), [self.products[i].id for i in (1, 3, 4, 2, 0)])
+
+    def test_pages_through_search_ranks(self):
+        ranked = [p["id"] for p in self.client.get('/api/v1/search/', {'query': 'robot'}).json()]
+        self.assertEqual(len(ranked), 5)
+        pages, _ = self.walk('/api/v1/search/', {'query': 'robot', 'page_size': 2})
+        self.assertEqual(sum(pages, []), ranked)
+
+
+class ProductCounterTests(TestCase):
+
+    def setUp(self):
+        self.vendor = create_vendor()
+        self.product = create_product(self.vendor, None)
+
+    def assertCounters(self, rating_avg, rating_count, order_count):
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertAlmostEqual(product.rating_avg, rating_avg)
+        self.assertEqual(product.rating_count, rating_count)
+        self.assertEqual(product.order_count, order_count)
+        return product
+
+    def test_review_changes_update_rating_incrementally(self):
+        first = Review.objects.create(
+            product=self.product, rating=5, review="Great")
+        second = Review.objects.create(
+            product=self.product, rating=2, review="Meh")
+        self.assertCounters(3.5, 2, 0)
+
+        second.rating = 4
+        second.save()
+        product = self.assertCounters(4.5, 2, 0)
+        self.assertEqual(product.rating_histogram(), {
+                         1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+        first.delete()
+        second.delete()
+        product = self.assertCounters(0, 0, 0)
+        self.assertIsNone(product.product_rating())
+
+    def test_only_paid_order_items_are_counted(self):
+        order = CartOrder.objects.create()
+        item = CartOrderItem.objects.create(
+            order=order, vendor=self.vendor, product=self.product, qty=1)
+        self.assertCounters(0, 0, 0)
+
+        order.payment_status = "paid"
+        order.save()
+        self.assertCounters(0, 0, 1)
+
+        CartOrderItem.objects.create(
+            order=order, vendor=self.vendor, product=self.product, qty=1)
+        self.assertCounters(0, 0, 2)
+
+        item.delete()
+        self.assertCounters(0, 0, 1)
+
+    def test_rebuild_matches_incremental_counters(self):
+        Review.objects.create(product=self.product, rating=3, review="Ok")
+        order = CartOrder.objects.create(payment_status="paid")
+        CartOrderItem.objects.create(
+            order=order, vendor=self.vendor, product=self.product, qty=1)
+        expected = self.assertCounters(3, 1, 1)
+
+        Product.objects.update(rating_avg=0, rating_count=0, order_count=0)
+        call_command("rebuild_product_stats", stdout=StringIO())
+
+        product = self.assertCounters(3, 1, 1)
+        self.assertEqual(product.rating_histogram(),
+                         expected.rating_histogram())
+
+    @override_settings(IMAGE_DERIVATIVES_ENABLED=False, PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+    def test_rebuild_replaces_cached_details_and_etags(self):
+        self.addCleanup(view_counter.flush)
+        Review.objects.create(product=self.product, rating=4, review="Good")
+        url = f'/api/v1/products/{self.product.pid}/'
+        response = self.client.get(url)
+        self.assertEqual(response.json()["rating_count"], 1)
+        etag = response["ETag"]
+
+        Product.objects.update(rating_count=0)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("rebuild_product_stats", stdout=StringIO())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["rating_count"], 1)
+        self.assertEqual(response.json()["rating_histogram"], {"1": 0, "2": 0, "3": 0, "4": 1, "5": 0})
+
+
+class CompiledSerializerTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        buyer = User.objects.create_user(
+            username="buyer", email="buyer@example.com", password="password")
+        for i in range(3):
+            product = create_product(vendor, category, f"Product {i}", buyer)
+            Cart.objects.create(product=product, user=buyer, cart_id="cart", qty=2, price=10)
+        self.context = {"request": Request(RequestFactory().get("/"))}
+
+    def render(self, serializer_class, queryset, compiled):
+        serializer = serializer_class(queryset, many=True, context=self.context)
+        serializer.child.compiled = compiled
+        return JSONRenderer().render(serializer.data)
+
+    def test_compiled_output_is_byte_identical(self):
+        shapes = [
+            (ProductSerializer, Product.objects.all()),
+            (CartSerializer, Cart.objects.all()),
+            (CartOrderSerializer, CartOrder.objects.all()),
+            (ReviewSerializer, Review.objects.all()),
+        ]
+        for serializer_class, queryset in shapes:
+            with self.subTest(serializer_class.__name__):
+                self.assertEqual(
+                    self.render(serializer_class, queryset, compiled=True),
+                    self.render(serializer_class, queryset, compiled=False))
+
+
+@override_settings(IMAGE_DERIVATIVES_ENABLED=False, PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+class ProductDetailCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        product_cache.reset_stats()
+        self.product = create_product(create_vendor(), None)
+        self.url = f'/api/v1/products/{self.product.pid}/'
+
+    def get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_second_request_is_served_from_cache(self):
+        first = self.get()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get()
+
+        self.assertEqual(first, second)
+        # Only the shared versions are read
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(product_cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_related_changes_invalidate_the_payload(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            Color.objects.create(product=self.product, name="Blue")
+        self.assertEqual(len(self.get()["color"]), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=self.product, rating=5, review="Great")
+        self.assertEqual(self.get()["rating_count"], 1)
+
+        self.product.title = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.get()["title"], "Renamed")
+
+    def test_batch_keeps_order_reuses_the_cache_and_reports_missing(self):
+        detail = self.get()
+        other = create_product(self.product.vendor, None, title="Other")
+
+        response = self.client.get('/api/v1/products/batch/', {
+            'pids': f"{other.pid},unknown,{self.product.pid},{other.pid}"})
+        data = response.json()
+        self.assertEqual([product["pid"] for product in data["results"]], [other.pid, self.product.pid])
+        self.assertEqual(data["results"][1], detail)
+        self.assertEqual(data["missing"], ["unknown"])
+        self.assertEqual(product_cache.stats(), {"hits": 1, "misses": 3})
+
+        with self.assertNumQueries(1):
+            self.client.get('/api/v1/products/batch/', {'pids': f"{self.product.pid},{other.pid}"})
+        self.assertEqual(self.client.get(f'/api/v1/products/{other.pid}/').json(), data["results"][0])
+
+    def test_concurrent_misses_build_once(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def build():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"title": "built"}
+
+        request = Request(RequestFactory().get(self.url))
+        # Read here, the test database can't be shared with the threads
+        versions = product_cache.product_versions(self.product.pid)
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+            product_cache.get_product_detail(self.product.pid, request, build, versions)))
+        first.start()
+        started.wait(5)
+
+        waiter = threading.Thread(target=lambda: results.append(
+            product_cache.get_product_detail(self.product.pid, request, build, versions)))
+        waiter.start()
+        release.set()
+        first.join()
+        waiter.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"title": "built"}] * 2)
+
+
+@override_settings(IMAGE_DERIVATIVES_ENABLED=False, PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vendor = create_vendor()
+            self.category = Category.objects.create(title="Toys", slug="toys")
+            self.product = create_product(self.vendor, self.category)
+
+    def test_unchanged_resources_answer_not_modified(self):
+        urls = [
+            '/api/v1/category/',
+            '/api/v1/products/',
+            f'/api/v1/products/{self.product.pid}/',
+            f'/api/v1/shop/{self.vendor.slug}/',
+        ]
+        for url in urls:
+            with self.subTest(url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+                with CaptureQueriesContext(connection) as queries:
+                    etag = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                    modified = self.client.get(
+                        url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                self.assertEqual(etag.status_code, 304)
+                self.assertEqual(modified.status_code, 304)
+                # Only the versions are read
+                self.assertEqual(len(queries), 2)
+
+    def test_changes_replace_the_etag(self):
+        url = f'/api/v1/products/{self.product.pid}/'
+        etag = self.client.get(url)['ETag']
+        list_etag = self.client.get('/api/v1/products/')['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Size.objects.create(product=self.product, name="L", price=2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()["size"]), 2)
+        self.assertEqual(self.client.get(
+            '/api/v1/products/', HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+
+        etag = response['ETag']
+        self.category.title = "Games"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.json()["category"]["title"], "Games")
+
+    def test_versions_are_shared_between_workers(self):
+        list_etag = self.client.get('/api/v1/products/')['ETag']
+        # Another worker or a management command bumps the version: nothing
+        # in this process' cache knows about it
+        CacheVersion.objects.filter(name="products").update(token="bumped elsewhere")
+        cache.clear()
+        self.assertEqual(self.client.get(
+            '/api/v1/products/', HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+
+    def test_reads_add_no_versions(self):
+        rows = CacheVersion.objects.count()
+        for i in range(3):
+            self.assertEqual(self.client.get(f'/api/v1/products/nonexistent{i}/').status_code, 404)
+        self.client.get('/api/v1/products/batch/', {'pids': ",".join(f"junk{i}" for i in range(100))})
+        self.client.get('/api/v1/products/')
+        self.assertEqual(CacheVersion.objects.count(), rows)
+
+
+@override_settings(PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+class ViewCounterTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        self.first = create_product(vendor, None, "First")
+        self.second = create_product(vendor, None, "Second")
+
+    def views(self, product):
+        return Product.objects.get(pk=product.pk).views
+
+    def test_flush_adds_buffered_views_in_one_statement_per_count(self):
+        counter = ViewCounter()
+        for i in range(3):
+            counter.record(self.first.pid)
+            counter.record(self.second.pid)
+        counter.record(self.first.pid)
+        self.assertEqual(self.views(self.first), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(counter.flush(), 7)
+        updates = [q for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(self.views(self.first), 4)
+        self.assertEqual(self.views(self.second), 3)
+        self.assertEqual(counter.flush(), 0)
+
+    @override_settings(PRODUCT_VIEWS_MAX_PENDING=2)
+    def test_buffer_is_flushed_when_full(self):
+        counter = ViewCounter()
+        counter.record(self.first.pid)
+        counter.record(self.second.pid)
+        self.assertEqual(len(counter.pending), 0)
+        self.assertEqual(self.views(self.second), 1)
+
+    @override_settings(PRODUCT_VIEWS_DEDUPE_SECONDS=60)
+    def test_repeat_views_inside_the_window_count_once(self):
+        counter = ViewCounter()
+        counter.record(self.first.pid, "user:1")
+        counter.record(self.first.pid, "user:1")
+        counter.record(self.first.pid, "user:2")
+        counter.flush()
+        self.assertEqual(self.views(self.first), 2)
+
+    def test_flush_keeps_cache_versions(self):
+        counter = ViewCounter()
+        counter.record(self.first.pid)
+        names = (f"product:{self.first.pid}", "products")
+        before = product_cache.get_versions(*names)
+        with self.captureOnCommitCallbacks(execute=True):
+            counter.flush()
+        self.assertEqual(product_cache.get_versions(*names), before)
+
+    @override_settings(PRODUCT_VIEWS_FLUSH_INTERVAL=10)
+    def test_recording_does_not_start_the_flush_thread(self):
+        counter = ViewCounter()
+        counter.record(self.first.pid)
+        self.assertIsNone(counter.thread)
+
+    def test_detail_view_records_views(self):
+        view_counter.flush()
+        self.client.get(f'/api/v1/products/{self.first.pid}/')
+        self.client.get(f'/api/v1/products/{self.first.pid}/')
+        view_counter.flush()
+        self.assertEqual(self.views(self.first), 2)
+
+
+@override_settings(SEARCH_FUZZY_MIN_RESULTS=0)
+class SearchTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        self.category = Category.objects.create(title="Audio", slug="audio")
+        self.headphones = Product.objects.create(
+            title="Wireless Headphones", category=self.category, vendor=vendor, status="published")
+        self.case = Product.objects.create(
+            title="Phone case", description="Fits most headphones", vendor=vendor, status="published")
+        Product.objects.create(title="Draft headphones", vendor=vendor, status="draft")
+
+    def search(self, query):
+        response = self.client.get('/api/v1/search/', {'query': query})
+        return [product["title"] for product in response.json()]
+
+    def test_ranks_title_matches_first_and_skips_unpublished(self):
+        self.assertEqual(self.search("headphone"), ["Wireless Headphones", "Phone case"])
+        self.assertEqual(self.search("wirel head"), ["Wireless Headphones"])
+        self.assertEqual(self.search("audio"), ["Wireless Headphones"])
+
+    def test_index_follows_saves(self):
+        Specification.objects.create(product=self.case, title="Material", content="Silicone")
+        self.assertEqual(self.search("silicone"), ["Phone case"])
+
+        self.category.title = "Sound"
+        self.category.save()
+        self.assertEqual(self.search("sound"), ["Wireless Headphones"])
+
+        self.headphones.delete()
+        self.assertEqual(self.search("headphones"), ["Phone case"])
+
+    def test_rebuild_restores_the_index(self):
+        get_backend().clear()
+        self.assertEqual(self.search("case"), [])
+
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search("case"), ["Phone case"])
+
+    def test_rebuild_keeps_searches_working_and_drops_stale_rows(self):
+        backend = get_backend()
+        Product.objects.filter(pk=self.headphones.pk).update(status="draft")
+        # Deleted, newest product still in the index
+        ghost = Product.objects.create(title="Ghost", vendor=self.case.vendor, status="published")
+        with mock.patch.object(backend, "remove_products"):
+            ghost.delete()
+        self.assertEqual(len(backend.search(["ghost"], 10)), 1)
+
+        index_range = backend.index_range
+        seen = []
+
+        def index_and_search(*args):
+            index_range(*args)
+            seen.append(self.search("case"))
+
+        with mock.patch.object(backend, "index_range", side_effect=index_and_search):
+            call_command("rebuild_search_index", "--chunk-size=1", stdout=StringIO())
+        self.assertEqual(seen, [["Phone case"]] * 4)
+        self.assertEqual(self.search("headphones"), ["Phone case"])
+        self.assertEqual(backend.search(["ghost"], 10), [])
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        self.vendor = create_vendor()
+        self.other_vendor = create_vendor("other@example.com")
+        self.toys = Category.objects.create(title="Toys", slug="toys")
+        self.books = Category.objects.create(title="Books", slug="books")
+        Product.objects.create(title="Robot", category=self.toys, vendor=self.vendor, price=30)
+        Product.objects.create(title="Kite", category=self.toys, vendor=self.other_vendor, price=10,
+                               in_stock=False, rating_avg=4.5, rating_count=2)
+        Product.objects.create(title="Novel", category=self.books, vendor=self.vendor, price=300)
+
+    def counts(self, facet):
+        return {entry["value"]: entry["count"] for entry in facet}
+
+    def test_counts_every_facet_in_one_query(self):
+        # The versions, the facets and the page
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/products/', {
+                'facets': 'category,vendor,price,in_stock,rating', 'fields': 'title'})
+        data = response.json()
+        facets = data["facets"]
+
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(self.counts(facets["category"]), {self.toys.pk: 2, self.books.pk: 1})
+        self.assertEqual(facets["category"][0]["label"], "Toys")
+        self.assertEqual(self.counts(facets["vendor"]), {self.vendor.pk: 2, self.other_vendor.pk: 1})
+        self.assertEqual(self.counts(facets["price"]),
+                         {"0-25": 1, "25-50": 1, "50-100": 0, "100-250": 0, "250+": 1})
+        self.assertEqual(self.counts(facets["in_stock"]), {True: 2, False: 1})
+        # The two products without reviews are in no rating bucket
+        self.assertEqual(self.counts(facets["rating"]), {"4+": 1, "3-4": 0, "2-3": 0, "1-2": 0})
+
+    def test_unrated_products_match_no_rating(self):
+        Product.objects.create(title="Doll", category=self.toys, vendor=self.vendor, price=20,
+                               rating_avg=1.5, rating_count=2)
+        response = self.client.get('/api/v1/products/', {'rating': '1-2,0-1', 'fields': 'title'})
+        self.assertEqual([product["title"] for product in response.json()], ["Doll"])
+
+    def test_selections_filter_results_but_not_their_own_facet(self):
+        response = self.client.get('/api/v1/products/', {
+            'facets': 'category,price', 'category': self.toys.pk, 'price': '0-25,250+'})
+        data = response.json()
+
+        self.assertEqual([product["title"] for product in data["results"]], ["Kite"])
+        # Category counts keep every category within the selected prices
+        self.assertEqual(self.counts(data["facets"]["category"]), {self.toys.pk: 1, self.books.pk: 1})
+        self.assertEqual(self.counts(data["facets"]["price"])["25-50"], 1)
+        self.assertEqual([entry["value"] for entry in data["facets"]["category"] if entry["selected"]],
+                         [self.toys.pk])
+
+    def test_list_shape_unchanged_without_facets(self):
+        response = self.client.get('/api/v1/products/', {'in_stock': 'false'})
+        self.assertEqual([product["title"] for product in response.json()], ["Kite"])
+
+
+@override_settings(IMAGE_DERIVATIVES_ENABLED=False)
+class SuggestTests(TestCase):
+
+    def setUp(self):
+        suggest_index.reset()
+        self.addCleanup(suggest_index.reset)
+        vendor = create_vendor()
+        self.category = Category.objects.create(title="Headwear", slug="headwear")
+        self.headphones = Product.objects.create(
+            title="Wireless Headphones", vendor=vendor, status="published", order_count=2)
+        self.headset = Product.objects.create(
+            title="Gaming headset", category=self.category, vendor=vendor, status="published",
+            order_count=5)
+        Product.objects.create(title="Draft headlamp", vendor=vendor, status="draft")
+
+    def suggest(self, query):
+        data = self.client.get('/api/v1/search/suggest/', {'query': query}).json()
+        return ([product["title"] for product in data["products"]],
+                [category["title"] for category in data["categories"]])
+
+    def test_matches_word_prefixes_by_popularity(self):
+        self.assertEqual(self.suggest("HEAD"), (["Gaming headset", "Wireless Headphones"], ["Headwear"]))
+        self.assertEqual(self.suggest("wireless he"), (["Wireless Headphones"], []))
+        self.assertEqual(self.suggest("x"), ([], []))
+
+    def test_follows_saves_and_deletes(self):
+        self.suggest("head")
+
+        self.headphones.order_count = 9
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headphones.save()
+        self.assertEqual(self.suggest("head")[0], ["Wireless Headphones", "Gaming headset"])
+
+        self.headset.status = "draft"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headset.save()
+            self.headphones.delete()
+        self.assertEqual(self.suggest("head"), ([], ["Headwear"]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(title="Heaters", slug="heaters")
+        self.assertEqual(self.suggest("hea")[1], ["Headwear", "Heaters"])
+
+    def test_rolled_back_saves_change_nothing(self):
+        self.suggest("head")
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Product.objects.create(title="Headband", vendor=self.headset.vendor, status="published")
+                transaction.set_rollback(True)
+        self.assertEqual(self.suggest("headb"), ([], []))
+
+    def test_changes_reach_other_workers(self):
+        other_worker = SuggestIndex()
+        self.assertEqual(other_worker.suggest("head")["products"][0]["title"], "Gaming headset")
+        self.suggest("head")
+
+        self.headphones.order_count = 9
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headphones.save()
+        self.assertEqual(self.suggest("head")[0], ["Wireless Headphones", "Gaming headset"])
+
+        # Until VERSION_CHECK_INTERVAL has passed, lookups don't query
+        with self.assertNumQueries(0):
+            self.assertEqual(other_worker.suggest("head")["products"][0]["title"], "Gaming headset")
+        with override_settings(VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(other_worker.suggest("head")["products"][0]["title"], "Wireless Headphones")
+
+    def test_short_prefixes_are_remembered_until_a_match_changes(self):
+        suggest_index.ensure_built()
+        suggest_index.products.memo_threshold = 0
+        self.assertEqual(self.suggest("h")[0], ["Gaming headset", "Wireless Headphones"])
+        self.assertIn("h", suggest_index.products.memo)
+
+        self.headphones.order_count = 9
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headphones.save()
+        self.assertEqual(self.suggest("h")[0], ["Wireless Headphones", "Gaming headset"])
+
+
+@override_settings(IMAGE_DERIVATIVES_ENABLED=False)
+class FuzzySearchTests(TestCase):
+
+    def setUp(self):
+        trigram_index.reset()
+        self.addCleanup(trigram_index.reset)
+        vendor = create_vendor()
+        self.headphones = Product.objects.create(
+            title="Wireless Headphones", vendor=vendor, status="published")
+        Product.objects.create(title="Headphone stand", vendor=vendor, status="published")
+        Product.objects.create(title="Draft headphones", vendor=vendor, status="draft")
+
+    def search(self, query):
+        response = self.client.get('/api/v1/search/', {'query': query})
+        return [product["title"] for product in response.json()]
+
+    def test_misspelled_queries_fall_back_to_similar_titles(self):
+        self.assertEqual(self.search("headphnes"), ["Wireless Headphones", "Headphone stand"])
+        self.assertEqual(self.search("wireles headphnes"), ["Wireless Headphones"])
+        self.assertEqual(self.search("zzzz"), [])
+
+    def test_exact_matches_come_first(self):
+        Product.objects.create(title="Wirless mouse", vendor=self.headphones.vendor, status="published")
+        self.assertEqual(self.search("wireless"), ["Wireless Headphones", "Wirless mouse"])
+        with self.settings(SEARCH_FUZZY_MIN_RESULTS=1):
+            self.assertEqual(self.search("wireless"), ["Wireless Headphones"])
+
+    def test_index_follows_saves(self):
+        self.search("headphnes")
+        self.headphones.title = "Wireless earbuds"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headphones.save()
+        self.assertEqual(self.search("earbds"), ["Wireless earbuds"])
+        self.assertEqual(self.search("headphnes"), ["Headphone stand"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.headphones.delete()
+        self.assertEqual(self.search("earbds"), [])
+
+    def test_rolled_back_saves_and_other_workers(self):
+        other_worker = TrigramIndex()
+        self.assertEqual(other_worker.search(["earbds"], 10), [])
+        self.search("headphnes")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Product.objects.create(title="Wireless earbuds", vendor=self.headphones.vendor,
+                                       status="published")
+                transaction.set_rollback(True)
+        self.assertEqual(self.search("earbds"), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            earbuds = Product.objects.create(title="Wireless earbuds", vendor=self.headphones.vendor,
+                                             status="published")
+        self.assertEqual(self.search("earbds"), ["Wireless earbuds"])
+
+        # Other workers look at the version once VERSION_CHECK_INTERVAL has
+        # passed, and keep answering from their index while it is rebuilt
+        with self.assertNumQueries(0):
+            self.assertEqual(other_worker.search(["earbds"], 10), [])
+        with override_settings(VERSION_CHECK_INTERVAL=0), \
+                mock.patch.object(other_worker, "start_rebuild") as start_rebuild:
+            self.assertEqual(other_worker.search(["earbds"], 10), [])
+        other_worker.build(*start_rebuild.call_args.args)
+        self.assertEqual(other_worker.search(["earbds"], 10), [earbuds.pk])
+
+
+class RelatedProductTests(TestCase):
+
+    def setUp(self):
+        self.vendor = create_vendor()
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@example.com", password="password")
+        self.shirt, self.socks, self.hat, self.scarf = [
+            Product.objects.create(title=title, vendor=self.vendor, status="published")
+            for title in ["Shirt", "Socks", "Hat", "Scarf"]
+        ]
+
+    def order(self, *products, payment_status="paid"):
+        order = CartOrder.objects.create(buyer=self.buyer)
+        for product in products:
+            CartOrderItem.objects.create(order=order, vendor=self.vendor, product=product, qty=1)
+        order.payment_status = payment_status
+        order.save()
+        return order
+
+    def related(self, product):
+        response = self.client.get(f'/api/v1/products/{product.pid}/related/', {'fields': 'title'})
+        return [item["title"] for item in response.json()]
+
+    def build(self):
+        call_command("build_related_products", "--top", "2", "--chunk-size", "2", stdout=StringIO())
+
+    def test_ranks_products_bought_together(self):
+        self.order(self.shirt, self.socks)
+        self.order(self.shirt, self.socks, self.hat)
+        self.order(self.shirt, self.hat, self.hat)
+        self.order(self.shirt, self.scarf, payment_status="pending")
+        self.build()
+
+        self.assertEqual(self.related(self.shirt), ["Socks", "Hat"])
+        self.assertEqual(self.related(self.hat), ["Shirt", "Socks"])
+        self.assertEqual(self.related(self.scarf), [])
+        self.assertEqual(ProductPair.objects.get(product=self.shirt, other=self.hat).count, 2)
+
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/v1/products/{self.shirt.pid}/related/', {'fields': 'title'})
+
+    def test_pages_follow_the_rank(self):
+        for rank, product in enumerate([self.hat, self.scarf, self.socks], 1):
+            RelatedProduct.objects.create(product=self.shirt, related=product, rank=rank)
+        titles = []
+        url = f'/api/v1/products/{self.shirt.pid}/related/?fields=title&page_size=1'
+        while url:
+            data = self.client.get(url).json()
+            titles += [item["title"] for item in data["results"]]
+            url = data["next"]
+        self.assertEqual(titles, ["Hat", "Scarf", "Socks"])
+
+    def test_runs_incrementally_and_takes_back_refunds(self):
+        first = self.order(self.shirt, self.socks)
+        self.build()
+        self.order(self.shirt, self.hat)
+        self.order(self.shirt, self.hat)
+        self.build()
+        self.assertEqual(self.related(self.shirt), ["Hat", "Socks"])
+        self.assertEqual(ProductPair.objects.get(product=self.shirt, other=self.socks).count, 1)
+
+        first.payment_status = "cancelled"
+        first.save()
+        self.build()
+        self.assertEqual(self.related(self.shirt), ["Hat"])
+        self.assertFalse(ProductPair.objects.filter(product=self.socks).exists())
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.old = create_product(vendor, category, title="Old")
+        self.new = create_product(vendor, category, title="New")
+        Product.objects.filter(pk=self.old.pk).update(updated="2020-01-01T00:00:00Z")
+
+    def stream(self, **params):
+        response = self.client.get('/api/v1/products/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_ndjson_streams_product_payloads_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            lines = self.stream().splitlines()
+        products = [json.loads(line) for line in lines]
+        self.assertEqual([product["title"] for product in products], ["Old", "New"])
+        listed = {product["pid"]: product for product in self.client.get('/api/v1/products/').json()}
+        self.assertEqual(products[1], listed[self.new.pid])
+
+        # One query for the products, one per prefetched collection
+        self.assertLessEqual(len(queries), 6)
+
+    def test_csv_and_updated_since(self):
+        rows = list(csv.DictReader(StringIO(self.stream(output="csv", updated_since="2021-01-01"))))
+        self.assertEqual([(row["title"], row["category"], row["vendor"]) for row in rows],
+                         [("New", "Toys", "Shop")])
+
+        response = self.client.get('/api/v1/products/export/', {'updated_since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+    def test_updated_since_sees_changes_outside_the_product_row(self):
+        def changed():
+            return [row["title"] for row in csv.DictReader(
+                StringIO(self.stream(output="csv", updated_since="2021-01-01")))]
+
+        changes = [
+            lambda: Size.objects.create(product=self.old, name="L", price=2),
+            lambda: Specification.objects.filter(product=self.old).delete(),
+            lambda: Review.objects.create(product=self.old, rating=5, review="Great"),
+            lambda: Category.objects.filter(pk=self.old.category_id).first().save(),
+            lambda: self.old.vendor.save(),
+            lambda: self.record_and_flush(self.old.pid),
+        ]
+        for change in changes:
+            Product.objects.filter(pk=self.old.pk).update(updated="2020-01-01T00:00:00Z")
+            self.assertEqual(changed(), ["New"])
+            change()
+            self.assertEqual(sorted(changed()), ["New", "Old"])
+
+    def record_and_flush(self, pid):
+        counter = ViewCounter()
+        counter.record(pid)
+        counter.flush()
+
+    def test_command_writes_the_same_lines(self):
+        out = StringIO()
+        call_command("export_products", "--chunk-size", "1", stdout=out)
+        self.assertEqual([json.loads(line)["pid"] for line in out.getvalue().splitlines()],
+                         [self.old.pid, self.new.pid])
+
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        self.vendor = create_vendor()
+        self.category = Category.objects.create(title="Toys", slug="toys")
+
+    def test_command_imports_products_with_children(self):
+        rows = [
+            {"title": "Robot", "price": "19.99", "category": "toys",
+             "specifications": [{"title": "Material", "content": "Tin"}],
+             "colors": [{"name": "Red", "color_code": "#f00"}],
+             "sizes": [{"name": "S", "price": "1.00"}, {"name": "L", "price": "2.00"}],
+             "gallery": [{"image": "product/robot.jpg"}]},
+            {"title": "", "price": "1"},
+            {"title": "Kite", "category": "garden"},
+            {"title": "Ball", "status": "draft"},
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as file:
+            file.write("\n".join(json.dumps(row) for row in rows) + "\nnot json\n")
+        self.addCleanup(os.remove, file.name)
+
+        out, err = StringIO(), StringIO()
+        call_command("import_products", file.name, "--vendor", self.vendor.pk,
+                     "--chunk-size", "2", stdout=out, stderr=err)
+
+        robot = Product.objects.get(title="Robot")
+        self.assertEqual((robot.vendor, robot.category, robot.slug, str(robot.price)),
+                         (self.vendor, self.category, "robot", "19.99"))
+        self.assertEqual(len(robot.pid), 10)
+        self.assertEqual([size.name for size in robot.size()], ["S", "L"])
+        self.assertEqual(robot.specification()[0].content, "Tin")
+        self.assertEqual(robot.color()[0].color_code, "#f00")
+        self.assertEqual(robot.gallery()[0].image.name, "product/robot.jpg")
+        self.assertEqual(Product.objects.get(title="Ball").status, "draft")
+
+        self.assertIn("Imported 2 products", out.getvalue())
+        self.assertEqual([line.split(":")[0] for line in err.getvalue().splitlines()],
+                         ["Row 2", "Row 3", "Row 5"])
+        self.assertEqual(self.client.get('/api/v1/search/', {'query': 'robot'}).json()[0]["pid"], robot.pid)
+
+    @override_settings(VERSION_CHECK_INTERVAL=0)
+    def test_import_refreshes_indexes_built_before(self):
+        suggest_index.reset()
+        trigram_index.reset()
+        self.addCleanup(suggest_index.reset)
+        self.addCleanup(trigram_index.reset)
+        Product.objects.create(title="Robot", vendor=self.vendor, status="published")
+        suggest_index.ensure_built()
+        trigram_index.ensure_built()
+
+        # The command runs in its own process, so it can only reach the web
+        # workers' indexes through the shared versions it bumps
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as file:
+            file.write(json.dumps({"title": "Kaleidoscope", "status": "published"}) + "\n")
+        self.addCleanup(os.remove, file.name)
+        with mock.patch.object(suggest_index, "reset"), mock.patch.object(trigram_index, "reset"):
+            call_command("import_products", file.name, "--vendor", self.vendor.pk, stdout=StringIO())
+
+        self.assertEqual([product["title"] for product in suggest_index.suggest("kal")["products"]],
+                         ["Kaleidoscope"])
+        kaleidoscope = Product.objects.get(title="Kaleidoscope")
+        # Rebuilt in the foreground: a thread wouldn't see this test's rows
+        with mock.patch.object(trigram_index, "start_rebuild", trigram_index.build):
+            self.assertEqual(trigram_index.search(["kaleidoscpe"], 10), [kaleidoscope.pk])
+
+    def test_endpoint_imports_csv(self):
+        data = (
+            "title,price,category,colors\n"
+            "Robot,5,toys,\"[{\"\"name\"\": \"\"Red\"\"}]\"\n"
+            "Kite,abc,,\n"
+        )
+        upload = SimpleUploadedFile("products.csv", data.encode("utf-8-sig"))
+        response = self.client.post(f'/api/v1/vendor-import-products/{self.vendor.pk}/', {'file': upload})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["created"], 1)
+        self.assertEqual(response.json()["errors"][0]["row"], 3)
+        self.assertIn("price", response.json()["errors"][0]["errors"])
+        self.assertEqual(Product.objects.get(title="Robot").color()[0].name, "Red")
+
+
+@override_settings(IMAGE_DERIVATIVE_WORKERS=0, PRODUCT_VIEWS_FLUSH_INTERVAL=0)
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        # Changing STORAGES is what makes default_storage pick up the others
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+            MEDIA_ROOT=media.name,
+            STORAGES={})
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(view_counter.flush)
+        self.vendor = create_vendor()
+
+    def upload(self, name, color="red"):
+        buffer = BytesIO()
+        Image.new("RGB", (2000, 1000), color).save(buffer, "JPEG")
+        return SimpleUploadedFile(name, buffer.getvalue())
+
+    def test_saving_an_image_queues_its_derivatives(self):
+        with mock.patch.object(pipeline, "schedule") as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.create(title="Robot", vendor=self.vendor, image=self.upload("robot.jpg"))
+        schedule.assert_called_once_with(Product, product.pk)
+
+    def test_derivatives_are_rendered_once_per_content_and_served(self):
+        product = Product.objects.create(title="Robot", vendor=self.vendor, image=self.upload("robot.jpg"))
+        derivatives = pipeline.generate(Product, product.pk)
+
+        self.assertEqual(derivatives["source"], product.image.name)
+        expected = {"thumbnail": (160, 80), "card": (480, 240), "zoom": (1600, 800)}
+        for size, dimensions in expected.items():
+            name = derivatives[size]["webp"]
+            self.assertRegex(name, rf"^derivatives/[0-9a-f]{{2}}/[0-9a-f]{{32}}-{size}\.webp$")
+            with Image.open(default_storage.open(name)) as image:
+                self.assertEqual((image.format, image.size), ("WEBP", dimensions))
+
+        # The same picture uploaded again reuses the stored files
+        gallery = Gallery.objects.create(product=product, image=self.upload("copy.jpg"))
+        with mock.patch.object(pipeline, "render") as render:
+            self.assertEqual({key: value for key, value in pipeline.generate(Gallery, gallery.pk).items()
+                              if key != "source"},
+                             {key: value for key, value in derivatives.items() if key != "source"})
+        render.assert_not_called()
+
+        response = self.client.get(f'/api/v1/products/{product.pid}/').json()
+        self.assertEqual(response["image_derivatives"]["card"]["webp"],
+                         "http://testserver/media/" + derivatives["card"]["webp"])
+        self.assertEqual(response["gallery"][0]["image_derivatives"]["card"]["webp"],
+                         "http://testserver/media/" + derivatives["card"]["webp"])
+
+        # A new image drops the derivatives of the old one
+        product.refresh_from_db()
+        product.image = self.upload("other.jpg", color="blue")
+        with mock.patch.object(pipeline, "schedule"), self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives, {})
+        self.assertEqual(self.client.get(f'/api/v1/products/{product.pid}/').json()["image_derivatives"], {})
+
+    @override_settings(IMAGE_DERIVATIVE_WORKERS=1)
+    def test_process_pool_renders(self):
+        pool = Pipeline()
+        self.addCleanup(lambda: pool.processes and pool.processes.shutdown())
+        output = pool.render(self.upload("robot.jpg").read(), [("thumbnail", "webp")])
+        with Image.open(BytesIO(output["thumbnail", "webp"])) as image:
+            self.assertEqual(image.size, (160, 80))
+
+
+class ContentAddressedStorageTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE="store.storage.LocalMediaStorage",
+            MEDIA_ROOT=media.name,
+            STORAGES={},
+            IMAGE_DERIVATIVES_ENABLED=False)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.vendor = create_vendor()
+
+    def upload(self, data=b"robot picture"):
+        return SimpleUploadedFile("Robot.JPG", data)
+
+    def test_same_bytes_are_stored_once_and_counted(self):
+        robot = Product.objects.create(title="Robot", vendor=self.vendor, image=self.upload())
+        copy = Product.objects.create(title="Copy", vendor=self.vendor, image=self.upload())
+        gallery = Gallery.objects.create(product=robot, image=self.upload())
+
+        name = robot.image.name
+        self.assertRegex(name, r"^content/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        self.assertEqual({copy.image.name, gallery.image.name}, {name})
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(name))), [os.path.basename(name)])
+        self.assertEqual(StoredFile.objects.get(name=name).references, 3)
+
+        # Gallery rows are deleted and recreated on every product edit
+        robot.gallery().delete()
+        Gallery.objects.create(product=robot, image=self.upload())
+        copy.image = self.upload(b"other picture")
+        copy.save()
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+        self.assertEqual(StoredFile.objects.get(name=copy.image.name).references, 1)
+
+        # Still used elsewhere, so deleting it through one row keeps it
+        robot.image.delete(save=False)
+        self.assertTrue(default_storage.exists(name))
+
+    def test_collect_media_deletes_unreferenced_files(self):
+        robot = Product.objects.create(title="Robot", vendor=self.vendor, image=self.upload())
+        kept = Product.objects.create(title="Kite", vendor=self.vendor, image=self.upload(b"kite")).image.name
+        orphan = robot.image.name
+        robot.delete()
+        # Bulk updates send no signals, --recount catches up with them
+        Product.objects.filter(title="Kite").update(image="product.jpg")
+
+        out = StringIO()
+        call_command("collect_media", "--grace-hours", "0", stdout=out)
+        self.assertIn("Deleted 1 unreferenced files", out.getvalue())
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(kept))
+
+        call_command("collect_media", "--grace-hours", "0", "--recount", stdout=out)
+        self.assertFalse(default_storage.exists(kept))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_imported_rows_keep_their_files(self):
+        name = default_storage.save("robot.jpg", ContentFile(b"robot picture"))
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as file:
+            file.write(json.dumps({"title": "Robot", "image": name, "gallery": [{"image": name}]}) + "\n")
+        self.addCleanup(os.remove, file.name)
+        call_command("import_products", file.name, "--vendor", self.vendor.pk, stdout=StringIO())
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+        call_command("collect_media", "--grace-hours", "0", stdout=StringIO())
+        self.assertTrue(default_storage.exists(name))
+
+    def test_uploads_while_collecting_keep_their_file(self):
+        name = Product.objects.create(title="Robot", vendor=self.vendor, image=self.upload()).image.name
+        Product.objects.filter(title="Robot").delete()
+        StoredFile.objects.filter(name=name).update(date=timezone.now() - timedelta(days=2))
+
+        def upload_first():
+            # The same bytes uploaded after the orphans were listed
+            self.assertEqual(default_storage.save("robot.jpg", self.upload()), name)
+            return transaction.atomic()
+
+        out = StringIO()
+        with mock.patch("store.management.commands.collect_media.transaction", atomic=upload_first):
+            call_command("collect_media", stdout=out)
+        self.assertIn("Deleted 0 unreferenced files", out.getvalue())
+        self.assertTrue(default_storage.exists(name))
+        self.assertTrue(StoredFile.objects.filter(name=name).exists())
+
+
+class MediaURLCacheTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.storage = LocalMediaStorage(location=media.name, base_url="/media/")
+
+    def test_urls_are_remembered_until_the_file_changes(self):
+        with mock.patch.object(FileSystemStorage, "url", autospec=True,
+                               side_effect=lambda storage, name: "/media/" + name) as url:
+            self.assertEqual(self.storage.url("product/robot.jpg"), "/media/product/robot.jpg")
+            self.assertEqual(self.storage.url("product/robot.jpg"), "/media/product/robot.jpg")
+            self.assertEqual(url.call_count, 1)
+
+            self.storage.delete("product/robot.jpg")
+            self.storage.url("product/robot.jpg")
+            self.assertEqual(url.call_count, 2)
+
+            name = self.storage.save("robot.jpg", ContentFile(b"robot"))
+            self.storage.url(name)
+            self.storage.url(name)
+            self.assertEqual(url.call_count, 3)
+
+    @override_settings(MEDIA_URL_CACHE_SIZE=2)
+    def test_least_recently_used_urls_are_dropped(self):
+        for name in ["a.jpg", "b.jpg", "a.jpg", "c.jpg"]:
+            self.storage.url(name)
+        self.assertEqual(list(self.storage.url_cache.urls), ["a.jpg", "c.jpg"])
+
+    def test_signed_s3_urls_are_not_cached(self):
+        storage = MediaStorage()
+        self.assertTrue(storage.has_stable_urls())
+        self.assertEqual(storage.url("content/ab/robot.jpg"), S3Boto3Storage.url(storage, "content/ab/robot.jpg"))
+        storage.custom_domain = None
+        self.assertFalse(storage.has_stable_urls())
+
+
+class CartTotalsTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        for i, tax_fee in enumerate(["0.10", "0.20", "0.70"]):
+            Cart.objects.create(
+                product=create_product(vendor, category, f"Product {i}"), cart_id="cart", qty=1, price="0.10", sub_total="0.10",
+                shipping_amount="0.10", service_fee="0.20", tax_fee=tax_fee, total="1.10")
+
+    def test_detail_sums_exact_decimals_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/cart-detail/cart/')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.json(), {
+            "shipping": 0.3, "tax": 1.0, "service_fee": 0.6, "sub_total": 0.3, "total": 3.3})
+        self.assertEqual(self.client.get('/api/v1/cart-detail/empty/').json()["total"], 0.0)
+
+    def test_list_includes_summary_on_request(self):
+        self.assertIsInstance(self.client.get('/api/v1/cart-list/cart/').json(), list)
+
+        response = self.client.get('/api/v1/cart-list/cart/', {'summary': 'true'}).json()
+        self.assertEqual(len(response["results"]), 3)
+        self.assertEqual(response["summary"]["tax"], 1.0)
+
+        response = self.client.get('/api/v1/cart-list/cart/', {'summary': 'true', 'page_size': 2}).json()
+        self.assertEqual((len(response["results"]), response["summary"]["total"]), (2, 3.3))
+
+
+class TaxRateTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tax_rates.reset()
+        self.addCleanup(tax_rates.reset)
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.product = create_product(vendor, category)
+        Tax.objects.create(country="United States", rate=10)
+
+    def add_to_cart(self, country, qty=2):
+        return self.client.post('/api/v1/cart-view/', {
+            "product_id": self.product.pk, "user_id": "undefined", "qty": qty, "price": "10.00",
+            "shipping_amount": "1.00", "country": country, "size": "M", "color": "Red", "cart_id": "cart",
+        })
+
+    def test_rates_are_read_from_memory_with_normalized_countries(self):
+        self.assertEqual(tax_rates.get_rate("United States"), 10)
+        # No query until VERSION_CHECK_INTERVAL has passed
+        with self.assertNumQueries(0):
+            self.assertEqual(tax_rates.get_rate("  united   STATES "), 10)
+            self.assertIsNone(tax_rates.get_rate("Canada"))
+            self.assertIsNone(tax_rates.get_rate(None))
+        with self.settings(VERSION_CHECK_INTERVAL=0), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(tax_rates.get_rate("united states"), 10)
+        # The version check, no Tax query
+        self.assertEqual([query["sql"] for query in queries if "store_tax" in query["sql"]], [])
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(self.add_to_cart(" united states").status_code, 201)
+        self.assertEqual(str(Cart.objects.get(cart_id="cart").tax_fee), "0.20")
+
+    def test_tax_changes_reload_the_rates(self):
+        self.assertIsNone(tax_rates.get_rate("Canada"))
+        with self.captureOnCommitCallbacks(execute=True):
+            Tax.objects.create(country="Canada", rate=5)
+        self.assertEqual(tax_rates.get_rate("canada"), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Tax.objects.filter(country="Canada").delete()
+        self.assertIsNone(tax_rates.get_rate("canada"))
+
+    def test_changes_reach_other_workers(self):
+        # Each worker has its own TaxRates and local cache; the version
+        # they check is shared
+        other_worker = TaxRates()
+        self.assertEqual(other_worker.get_rate("united states"), 10)
+        self.assertEqual(tax_rates.get_rate("united states"), 10)
+
+        # Saved through this worker, e.g. in the admin
+        tax = Tax.objects.get(country="United States")
+        tax.rate = 12
+        with self.captureOnCommitCallbacks(execute=True):
+            tax.save()
+        cache.clear()
+        self.assertEqual(tax_rates.get_rate("united states"), 12)
+        # The other worker notices once VERSION_CHECK_INTERVAL has passed
+        self.assertEqual(other_worker.get_rate("united states"), 10)
+        with self.settings(VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(other_worker.get_rate("united states"), 12)
+
+
+class CartBatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tax_rates.reset()
+        self.addCleanup(tax_rates.reset)
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.products = [create_product(vendor, category, f"Product {i}") for i in range(5)]
+        self.buyer = User.objects.create_user(username="buyer", email="buyer@example.com", password="password")
+        Tax.objects.create(country="Canada", rate=5)
+
+    def item(self, product, qty=2):
+        return {"product_id": product.pk, "qty": qty, "price": "10.00", "shipping_amount": "1.00",
+                "size": "M", "color": "Red"}
+
+    def post(self, cart_id, items, user_id="undefined"):
+        return self.client.post('/api/v1/cart-view/batch/', {
+            "cart_id": cart_id, "user_id": user_id, "country": "canada", "items": items,
+        }, content_type="application/json")
+
+    def test_batch_matches_single_adds_in_constant_queries(self):
+        self.client.post('/api/v1/cart-view/', {
+            "product_id": self.products[0].pk, "user_id": "undefined", "qty": 1, "price": "10.00",
+            "shipping_amount": "1.00", "country": "Canada", "size": "M", "color": "Red", "cart_id": "single",
+        })
+        self.post("batch", [self.item(self.products[0], qty=1)])
+        fields = ["qty", "sub_total", "shipping_amount", "tax_fee", "service_fee", "total"]
+        self.assertEqual(Cart.objects.filter(cart_id="single").values(*fields)[0],
+                         Cart.objects.filter(cart_id="batch").values(*fields)[0])
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.post("batch", [self.item(product) for product in self.products[:2]], self.buyer.pk)
+        self.assertEqual((response.status_code, response.json()["created"], response.json()["updated"]),
+                         (201, 1, 1))
+        with CaptureQueriesContext(connection) as many:
+            response = self.post("batch", [self.item(product, qty=3) for product in self.products], self.buyer.pk)
+        self.assertEqual((response.json()["created"], response.json()["updated"]), (3, 2))
+        self.assertEqual(len(few), len(many))
+
+        rows = Cart.objects.filter(cart_id="batch")
+        self.assertEqual(rows.count(), 5)
+        self.assertEqual({row.qty for row in rows}, {3})
+        self.assertEqual(str(rows.totals()["tax"]), "0.75")
+
+    def test_invalid_batches_are_rejected(self):
+        response = self.post("batch", [self.item(self.products[0]), {"product_id": 0, "qty": 1, "price": "1"}])
+        self.assertEqual((response.status_code, response.json()["missing"]), (400, [0]))
+        self.assertEqual(self.post("batch", []).status_code, 400)
+        self.assertEqual(self.post("batch", [self.item(self.products[0], qty=0)]).status_code, 400)
+        self.assertEqual(self.post("batch", [self.item(self.products[0])], user_id=0).status_code, 400)
+        self.assertFalse(Cart.objects.exists())
+
+
+class CartUpsertTests(TestCase):
+
+    def setUp(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.products = [create_product(vendor, category, f"Product {i}") for i in range(3)]
+
+    def cart(self, product, qty, cart_id="abc"):
+        cart = Cart(cart_id=cart_id, product=product, color="Red", size="M")
+        cart.set_amounts(qty, Decimal("10.00"), Decimal("1.00"), 0)
+        return cart
+
+    def test_upsert_inserts_and_updates_in_one_query(self):
+        first = self.cart(self.products[0], 1)
+        self.assertEqual(Cart.objects.upsert([first]), [True])
+        self.assertIsNotNone(first.pk)
+
+        carts = [self.cart(product, 4) for product in self.products]
+        with self.assertNumQueries(1):
+            self.assertEqual(Cart.objects.upsert(carts), [False, True, True])
+        self.assertEqual(carts[0].pk, first.pk)
+        self.assertEqual(Cart.objects.count(), 3)
+        self.assertEqual(set(Cart.objects.values_list("qty", flat=True)), {4})
+        self.assertEqual(Cart.objects.get(pk=first.pk).total, Decimal("48.00"))
+
+    def test_add_to_cart_view_updates_the_same_row(self):
+        payload = {
+            "product_id": self.products[0].pk, "user_id": "undefined", "qty": 1, "price": "10.00",
+            "shipping_amount": "1.00", "country": "Canada", "size": "M", "color": "Red", "cart_id": "abc",
+        }
+        self.assertEqual(self.client.post('/api/v1/cart-view/', payload).status_code, 201)
+        payload["qty"] = 3
+        self.assertEqual(self.client.post('/api/v1/cart-view/', payload).status_code, 200)
+        self.assertEqual(list(Cart.objects.values_list("qty", flat=True)), [3])
+
+
+@override_settings(IMAGE_DERIVATIVES_ENABLED=False)
+class CartConcurrencyTests(TransactionTestCase):
+    threads = 8
+    rounds = 10
+
+    def setUp(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.products = [create_product(vendor, category, f"Product {i}") for i in range(2)]
+
+    def add_concurrently(self, add):
+        # Every thread adds each product `rounds` times to one cart
+        Cart.objects.all().delete()
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def run(qty):
+            try:
+                barrier.wait()
+                for round in range(self.rounds):
+                    for product in self.products:
+                        cart = Cart(cart_id="shared", product=product)
+                        cart.set_amounts(qty, Decimal("10.00"), Decimal("0.00"), 0)
+                        for attempt in range(50):
+                            try:
+                                add(cart)
+                                break
+                            except OperationalError:
+                                # SQLite's shared in-memory test database locks
+                                # the whole table
+                                time.sleep(0.01)
+                        else:
+                            errors.append(f"gave up adding {product.pk}")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(qty,)) for qty in range(1, self.threads + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_adds_keep_one_row_per_product(self):
+        errors = self.add_concurrently(lambda cart: Cart.objects.upsert([cart]))
+        self.assertEqual(errors, [])
+        rows = Cart.objects.filter(cart_id="shared")
+        self.assertEqual(sorted(rows.values_list("product_id", flat=True)), [product.pk for product in self.products])
+
+    def test_upsert_takes_one_statement(self):
+        # benchmark_carts compares the throughput against get-then-save
+        command = benchmark_carts.Command()
+        cart = Cart(cart_id="other", product=self.products[0])
+        cart.set_amounts(1, Decimal("10.00"), Decimal("0.00"), 0)
+        for add, statements in ((command.upsert, 1), (command.get_then_save, 2)):
+            add(cart)
+            with self.assertNumQueries(statements):
+                add(cart)
+        self.assertEqual(Cart.objects.filter(cart_id="other").count(), 1)
+
+    def test_benchmark_leaves_no_rows(self):
+        out = StringIO()
+        call_command("benchmark_carts", threads=2, rounds=2, stdout=out)
+        self.assertIn("upsert: ", out.getvalue())
+        self.assertIn("get-then-save: ", out.getvalue())
+        self.assertFalse(Cart.objects.exists())
+
+
+@override_settings(CART_CACHE_ENABLED=True, CART_CACHE_MAX_ITEMS=3)
+class CartCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tax_rates.reset()
+        self.addCleanup(tax_rates.reset)
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        self.products = [create_product(vendor, category, f"Product {i}") for i in range(4)]
+        Tax.objects.create(country="Canada", rate=5)
+
+    def add(self, product, qty=1, user_id="undefined"):
+        return self.client.post('/api/v1/cart-view/', {
+            "product_id": product.pk, "user_id": user_id, "qty": qty, "price": "10.00",
+            "shipping_amount": "1.00", "country": "Canada", "size": "M", "color": "Red", "cart_id": "abc",
+        })
+
+    def test_anonymous_carts_stay_out_of_the_table(self):
+        self.assertEqual(self.add(self.products[0]).status_code, 201)
+        self.assertEqual(self.add(self.products[0], qty=3).status_code, 200)
+        self.assertEqual(self.add(self.products[1]).status_code, 201)
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.client.get('/api/v1/cart-list/abc/', {'summary': 'true'}).json()
+        self.assertEqual([(item["id"], item["qty"], item["product"]["title"]) for item in response["results"]],
+                         [(self.products[0].pk, 3, "Product 0"), (self.products[1].pk, 1, "Product 1")])
+        with self.assertNumQueries(0):
+            totals = self.client.get('/api/v1/cart-detail/abc/').json()
+        self.assertEqual(totals, response["summary"])
+        self.assertEqual(totals, {"shipping": 4.0, "tax": 0.2, "service_fee": 4.0, "sub_total": 40.0, "total": 48.2})
+
+        self.assertEqual(self.client.delete(f'/api/v1/cart-delete/abc/{self.products[1].pk}/').status_code, 204)
+        self.assertEqual(self.client.delete(f'/api/v1/cart-delete/abc/{self.products[1].pk}/').status_code, 404)
+        self.assertEqual(len(self.client.get('/api/v1/cart-list/abc/').json()), 1)
+
+    @mock.patch("store.carts.time.sleep")
+    def test_a_held_lock_fails_the_change(self, sleep):
+        self.add(self.products[0])
+        cart_store.get_cache().add(cart_store.key("abc") + ":lock", 1)
+
+        response = self.add(self.products[0], qty=5)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.delete(f'/api/v1/cart-delete/abc/{self.products[0].pk}/').status_code, 409)
+        self.assertEqual(cart_store.get("abc")[0].qty, 1)
+        # The lock still belongs to its holder
+        self.assertIsNotNone(cart_store.get_cache().get(cart_store.key("abc") + ":lock"))
+
+    def test_carts_are_bounded(self):
+        for product in self.products[:3]:
+            self.add(product)
+        response = self.add(self.products[3])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.add(self.products[0], qty=2).status_code, 200)
+        self.assertEqual(len(cart_store.get("abc")), 3)
+
+    def test_rows_saved_before_carry_over(self):
+        Cart.objects.create(product=self.products[0], cart_id="abc", qty=5, total="50.00")
+        self.add(self.products[1])
+        self.assertEqual(sorted((cart.product_id, cart.qty) for cart in cart_store.get("abc")),
+                         [(self.products[0].pk, 5), (self.products[1].pk, 1)])
+
+    def test_checkout_writes_the_cart_to_the_table(self):
+        Cart.objects.create(product=self.products[2], cart_id="abc", qty=5, total="50.00")
+        self.add(self.products[0], qty=2)
+        self.add(self.products[1])
+        self.client.delete(f'/api/v1/cart-delete/abc/{self.products[2].pk}/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/create-order/', {
+                "full_name": "Buyer", "email": "buyer@example.com", "mobile": "1", "address": "1 Street",
+                "city": "Vancouver", "state": "BC", "country": "Canada", "cart_id": "abc", "user_id": 0,
+            })
+        self.assertEqual(response.status_code, 201)
+        order = CartOrder.objects.get(oid=response.json()["order_oid"])
+        self.assertEqual(sorted(CartOrderItem.objects.filter(order=order).values_list("product_id", "qty")),
+                         [(self.products[0].pk, 2), (self.products[1].pk, 1)])
+        self.assertEqual(str(order.total), "36.15")
+        self.assertEqual(Cart.objects.filter(cart_id="abc").count(), 2)
+        self.assertIsNone(cart_store.get("abc"))
+
+        # Signed in carts still use the table
+        buyer = User.objects.create_user(username="buyer", email="buyer@example.com", password="password")
+        self.add(self.products[3], user_id=buyer.pk)
+        self.assertTrue(Cart.objects.filter(product=self.products[3], user=buyer).exists())
+
+
+class PurgeCartsTests(TestCase):
+
+    def test_deletes_idle_anonymous_carts_in_chunks(self):
+        vendor = create_vendor()
+        category = Category.objects.create(title="Toys", slug="toys")
+        products = [create_product(vendor, category, f"Product {i}") for i in range(2)]
+        for cart_id in ("old 1", "old 2", "old 3", "active", "user"):
+            for product in products:
+                Cart.objects.create(product=product, cart_id=cart_id)
+        Cart.objects.filter(cart_id="user").update(user=vendor.user)
+        Cart.objects.update(date=timezone.now() - timedelta(days=40), updated=timezone.now() - timedelta(days=40))
+        # Changing one item of a cart keeps all of it
+        cart = Cart(cart_id="active", product=products[0])
+        cart.set_amounts(2, Decimal("10.00"), Decimal("0.00"), 0)
+        Cart.objects.upsert([cart])
+
+        out = StringIO()
+        call_command("purge_carts", days=30, chunk_size=2, dry_run=True, stdout=out)
+        self.assertIn("Would delete 3 carts", out.getvalue())
+        self.assertEqual(Cart.objects.count(), 10)
+
+        out = StringIO()
+        call_command("purge_carts", days=30, chunk_size=2, stdout=out)
+        self.assertEqual(out.getvalue().count("/s)"), 2)
+        self.assertIn("Deleted 3 carts (6 items) idle for more than 30 days", out.getvalue())
+        self.assertEqual(sorted(Cart.objects.values_list("cart_id", flat=True)), ["active", "active", "user", "user"])
 
-# Create your tests here.
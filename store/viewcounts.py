@@ -0,0 +1,142 @@
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from store.models import Product
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """
+    Buffers product views in memory and writes them in batches.
+
+    `record()` only touches a dict; `flush()` turns the buffered counts into
+    `UPDATE ... SET views = views + n`, one statement per distinct `n`, so a
+    popular product costs one row update per flush instead of one per
+    request. Flushes run whenever PRODUCT_VIEWS_MAX_PENDING products are
+    waiting, when the process exits, and in web workers every
+    PRODUCT_VIEWS_FLUSH_INTERVAL seconds on a background thread, which
+    backend/wsgi.py starts. Flushes leave cache versions alone: bumping
+    them for every viewed product each interval would drop the hottest
+    cached details and list ETags constantly, so cached payloads show
+    counts up to PRODUCT_DETAIL_CACHE_TIMEOUT old.
+
+    With PRODUCT_VIEWS_DEDUPE_SECONDS set, repeat views of a product by the
+    same visitor inside that window are counted once.
+    """
+    # Most visitors remembered for deduplication
+    max_seen = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.seen = OrderedDict()
+        self.thread = None
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "PRODUCT_VIEWS_FLUSH_INTERVAL", 10)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, "PRODUCT_VIEWS_MAX_PENDING", 10000)
+
+    @property
+    def dedupe_seconds(self):
+        return getattr(settings, "PRODUCT_VIEWS_DEDUPE_SECONDS", 0)
+
+    def record(self, pid, visitor=None):
+        with self.lock:
+            if visitor is not None and self.is_repeat(pid, visitor):
+                return
+            self.pending[pid] += 1
+            full = len(self.pending) >= self.max_pending
+
+        if full:
+            self.flush()
+
+    def is_repeat(self, pid, visitor):
+        # Called with the lock held
+        window = self.dedupe_seconds
+        if not window:
+            return False
+
+        now = time.monotonic()
+        key = (pid, visitor)
+        last = self.seen.get(key)
+        if last is not None and now - last < window:
+            return True
+
+        self.seen[key] = now
+        self.seen.move_to_end(key)
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+        if not pending:
+            return 0
+
+        by_count = defaultdict(list)
+        for pid, count in pending.items():
+            by_count[count].append(pid)
+
+        try:
+            with transaction.atomic():
+                for count, pids in by_count.items():
+                    Product.objects.filter(pid__in=pids).update(
+                        views=Coalesce(models.F("views"), 0) + count, updated=timezone.now())
+        except Exception:
+            logger.exception("Could not flush %d product view counts", len(pending))
+            self.restore(pending)
+            return 0
+        return sum(pending.values())
+
+    def restore(self, pending):
+        # Put unwritten counts back, as long as that stays within bounds
+        with self.lock:
+            for pid, count in pending.items():
+                if pid in self.pending or len(self.pending) < self.max_pending:
+                    self.pending[pid] += count
+
+    def start(self):
+        # Only for processes serving requests; tests and management
+        # commands flush explicitly or on exit
+        if self.thread is not None or not self.flush_interval:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="product-view-flush", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval or 1)
+            close_old_connections()
+            self.flush()
+
+
+view_counter = ViewCounter()
+
+# Write whatever is still buffered when the worker shuts down
+atexit.register(view_counter.flush)
+
+
+def record_view(pid, request):
+    visitor = None
+    if request.user.is_authenticated:
+        visitor = f"user:{request.user.pk}"
+    elif request.META.get("REMOTE_ADDR"):
+        visitor = f"ip:{request.META['REMOTE_ADDR']}"
+    view_counter.record(pid, visitor)
@@ -2,11 +2,22 @@ from django.shortcuts import render, redirect
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Q
+from django.http import Http404, StreamingHttpResponse
 
 from userauths.models import User
-from store.models import Product, Category, Cart, Tax, CartOrder, CartOrderItem, Coupon, Notification, Review
-from store.serializer import ProductSerializer, CategorySerializer, CartSerializer, CartOrderSerializer, CartOrderItemSerializer, CouponSerializer, ReviewSerializer
+from store.models import Product, Category, Cart, CartOrder, CartOrderItem, Coupon, Notification, Review
+from store.carts import CartFull, cart_store, cart_totals
+from store.fieldsets import SparseFieldsetViewMixin, optimize_instances
+from store import cache as product_cache
+from store.conditional import ConditionalGetMixin
+from store.facets import FacetedListMixin, parse_bool
+from store.viewcounts import record_view
+from store import export, search
+from store.suggest import suggest_index, DEFAULT_LIMIT, MAX_LIMIT
+from store.taxes import tax_rates
+from store.serializer import ProductSerializer, CategorySerializer, CartSerializer, CartBatchSerializer, CartOrderSerializer, CartOrderItemSerializer, CouponSerializer, ReviewSerializer
 
 from rest_framework import generics, status
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -29,26 +40,142 @@ def send_notification(user=None, vendor=None, order=None, order_item=None):
     )
 
 
-class CategoryListAPIView(generics.ListAPIView):
+class CategoryListAPIView(ConditionalGetMixin, generics.ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [AllowAny]
+    version_names = ("categories",)
 
 
-class ProductListAPIView(generics.ListAPIView):
+def sort_products(queryset, request):
+    # ?sort=newest|rating|popular and ?min_rating= read the stored counters
+    min_rating = request.GET.get('min_rating')
+    if min_rating:
+        try:
+            queryset = queryset.filter(rating_avg__gte=float(min_rating))
+        except ValueError:
+            pass
+    return queryset.sorted_by(request.GET.get('sort'))
+
+
+class ProductListAPIView(ConditionalGetMixin, FacetedListMixin, SparseFieldsetViewMixin, generics.ListAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
+    keyset_ordering = ('-date', '-id')
+    version_names = ("products", "categories", "vendors")
+
+    def get_queryset(self):
+        return sort_products(super().get_queryset(), self.request)
 
 
-class ProductDetailAPIView(generics.RetrieveAPIView):
+class ProductDetailAPIView(ConditionalGetMixin, SparseFieldsetViewMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
 
+    def get_versions(self):
+        return product_cache.product_versions(self.kwargs["pid"])
+
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        # Revalidations (304) are views too
+        if response.status_code in (200, 304):
+            record_view(self.kwargs["pid"], request)
+        return response
+
     def get_object(self):
         pid = self.kwargs["pid"]
-        return Product.objects.get(pid=pid)
+        return generics.get_object_or_404(self.filter_queryset(self.get_queryset()), pid=pid)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Only the default shape is cached; ?fields= / ?expand= go straight
+        # to the database.
+        if 'fields' in request.query_params or 'expand' in request.query_params:
+            return super().retrieve(request, *args, **kwargs)
+
+        data = product_cache.get_product_detail(
+            self.kwargs["pid"], request,
+            lambda: self.get_serializer(self.get_object()).data,
+            getattr(self, "versions", None))
+        return Response(data)
+
+
+class ProductBatchAPIView(SparseFieldsetViewMixin, generics.ListAPIView):
+    queryset = Product.objects.all()
+    serializer_class = ProductSerializer
+    permission_classes = [AllowAny]
+    max_pids = 100
+
+    def list(self, request, *args, **kwargs):
+        # ?pids=a,b,c in that order; unknown pids are listed under "missing"
+        pids = list(dict.fromkeys(
+            pid.strip() for pid in request.query_params.get('pids', '').split(',') if pid.strip()))
+        if len(pids) > self.max_pids:
+            return Response({'error': f'At most {self.max_pids} pids per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Like the detail view, only the default shape is cached
+        if 'fields' in request.query_params or 'expand' in request.query_params:
+            details = self.build(pids)
+        else:
+            details = product_cache.get_product_details(pids, request, self.build)
+
+        return Response({
+            'results': [details[pid] for pid in pids if pid in details],
+            'missing': [pid for pid in pids if pid not in details],
+        })
+
+    def build(self, pids):
+        if not pids:
+            return {}
+        products = list(self.filter_queryset(self.get_queryset()).filter(pid__in=pids))
+        data = self.get_serializer(products, many=True).data
+        return {product.pid: item for product, item in zip(products, data)}
+
+
+class ProductExportAPIView(SparseFieldsetViewMixin, generics.GenericAPIView):
+    queryset = Product.objects.all()
+    serializer_class = ProductSerializer
+    permission_classes = [AllowAny]
+    chunk_size = 500
+
+    def get(self, request, *args, **kwargs):
+        # ?output=ndjson (default, one product payload per line) or csv, and
+        # ?updated_since=<ISO date or datetime> for incremental pulls
+        output = request.query_params.get('output', 'ndjson')
+        if output not in export.FORMATS:
+            return Response({'error': f'output must be one of {", ".join(export.FORMATS)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        updated_since = None
+        if request.query_params.get('updated_since'):
+            try:
+                updated_since = export.parse_since(request.query_params['updated_since'])
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if output == 'csv':
+            queryset = export.export_queryset(self.get_queryset(), updated_since)
+            lines = export.csv_lines(queryset, self.chunk_size)
+            content_type = 'text/csv'
+        else:
+            queryset = export.export_queryset(self.filter_queryset(self.get_queryset()), updated_since)
+            lines = export.ndjson_lines(
+                queryset, lambda products: self.get_serializer(products, many=True).data, self.chunk_size)
+            content_type = 'application/x-ndjson'
+
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="products.{output}"'
+        return response
+
+
+def get_tax_rate(country):
+    # Fraction of the price charged as tax per item in `country`
+    rate = tax_rates.get_rate(country)
+    if rate is not None:
+        return rate / 100
+    return 0
 
 
 class CartAPIView(generics.ListCreateAPIView):
@@ -75,59 +202,91 @@ class CartAPIView(generics.ListCreateAPIView):
         else:
             user = None
 
-        tax = Tax.objects.filter(country=country).first()
-        if tax:
-            tax_rate = tax.rate / 100
+        tax_rate = get_tax_rate(country)
+
+        cart = Cart()
+        cart.product = product
+        cart.user = user
+        cart.set_amounts(qty, price, shipping_amount, tax_rate)
+        cart.color = color
+        cart.size = size
+        cart.country = country
+        cart.cart_id = cart_id
+
+        if user is None and cart_store.is_enabled():
+            try:
+                created, = cart_store.add(cart_id, [cart])
+            except CartFull as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            tax_rate = 0
-
-        cart = Cart.objects.filter(cart_id=cart_id, product=product).first()
-
-        if cart:
-            cart.product = product
-            cart.user = user
-            cart.qty = qty
-            cart.price = price
-            cart.sub_total = Decimal(price) * int(qty)
-            cart.shipping_amount = Decimal(shipping_amount) * int(qty)
-            cart.tax_fee = int(qty) * Decimal(tax_rate)
-            cart.color = color
-            cart.size = size
-            cart.country = country
-            cart.cart_id = cart_id
+            # Add or update in one statement, safe against concurrent clicks
+            created, = Cart.objects.upsert([cart])
+        if not created:
+            return Response({'message': "Cart Updates Successsfully"}, status=status.HTTP_200_OK)
 
-            service_fee_percentage = 10 / 100
-            cart.service_fee = Decimal(service_fee_percentage) * cart.sub_total
+        return Response({'message': "Cart Created Successsfully"}, status=status.HTTP_201_CREATED)
 
-            cart.total = cart.sub_total + cart.shipping_amount + cart.service_fee + cart.tax_fee
-            cart.save()
 
-            return Response({'message': "Cart Updates Successsfully"}, status=status.HTTP_200_OK)
+class CartBatchAPIView(generics.GenericAPIView):
+    """
+    Add or update several items of a cart at once, e.g. a bundle or a saved
+    cart being restored. Each item is priced like a CartAPIView call and
+    saved as the cart's row for its product (a product listed twice keeps
+    its last item). The products and the user are read with one query
+    each, and all rows are written by a single upsert statement (or one
+    cache write for anonymous carts, see store.carts).
+    """
+    serializer_class = CartBatchSerializer
+    permission_classes = [AllowAny]
 
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        cart_id = data['cart_id']
+        country = data.get('country')
+
+        items = {item['product_id']: item for item in data['items']}
+        products = Product.objects.in_bulk(list(items))
+        missing = [product_id for product_id in items if product_id not in products]
+        if missing:
+            return Response({'error': 'Unknown products', 'missing': missing},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        user = None
+        if data.get('user_id') is not None:
+            user = User.objects.filter(id=data['user_id']).first()
+            if user is None:
+                return Response({'error': 'Unknown user'}, status=status.HTTP_400_BAD_REQUEST)
+
+        tax_rate = get_tax_rate(country)
+
+        carts = []
+        for product_id, item in items.items():
+            cart = Cart(cart_id=cart_id, product=products[product_id], user=user, country=country)
+            cart.set_amounts(item['qty'], item['price'], item['shipping_amount'], tax_rate)
+            cart.color = item.get('color')
+            cart.size = item.get('size')
+            carts.append(cart)
+
+        if user is None and cart_store.is_enabled():
+            try:
+                created = sum(cart_store.add(cart_id, carts))
+            except CartFull as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            cart = Cart()
-            cart.product = product
-            cart.user = user
-            cart.qty = qty
-            cart.price = price
-            cart.sub_total = Decimal(price) * int(qty)
-            cart.shipping_amount = Decimal(shipping_amount) * int(qty)
-            cart.tax_fee = int(qty) * Decimal(tax_rate)
-            cart.color = color
-            cart.size = size
-            cart.country = country
-            cart.cart_id = cart_id
+            created = sum(Cart.objects.upsert(carts))
+        updated = len(carts) - created
 
-            service_fee_percentage = 10 / 100
-            cart.service_fee = Decimal(service_fee_percentage) * cart.sub_total
+        return Response(
+            {'message': 'Cart Updated Successfully', 'created': created, 'updated': updated},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
-            cart.total = cart.sub_total + cart.shipping_amount + cart.service_fee + cart.tax_fee
-            cart.save()
 
-            return Response({'message': "Cart Created Successsfully"}, status=status.HTTP_201_CREATED)
-
-
-class CartListView(generics.ListAPIView):
+class CartListView(SparseFieldsetViewMixin, generics.ListAPIView):
+    # `?summary=true` returns `{"results": [...], "summary": {...}}` (or the
+    # paginated object with a `summary` key), the summary being what
+    # CartDetailView returns, so a cart renders from one request
     serializer_class = CartSerializer
     permission_classes = [AllowAny]
     queryset = Cart.objects.all()
@@ -143,6 +302,44 @@ class CartListView(generics.ListAPIView):
             queryset = Cart.objects.filter(cart_id=cart_id)
         return queryset
 
+    def get_cached_carts(self):
+        # An anonymous cart held by store.carts, None for the table's carts
+        if self.kwargs.get('user_id') is not None or not cart_store.is_enabled():
+            return None
+        carts = cart_store.get(self.kwargs['cart_id'])
+        if carts is not None:
+            optimize_instances(carts, self.get_serializer())
+        return carts
+
+    def list(self, request, *args, **kwargs):
+        try:
+            summary = parse_bool(request.query_params.get('summary', 'false'))
+        except ValueError:
+            return Response({'error': 'summary must be true or false'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.get_cached_carts()
+        if queryset is not None:
+            totals = cart_totals(queryset)
+        elif not summary:
+            return super().list(request, *args, **kwargs)
+        else:
+            queryset = self.get_queryset()
+            totals = queryset.totals()
+            queryset = self.filter_queryset(queryset)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+            if summary:
+                response.data['summary'] = totals
+            return response
+
+        serializer = self.get_serializer(queryset, many=True)
+        if not summary:
+            return Response(serializer.data)
+        return Response({'results': serializer.data, 'summary': totals})
+
 
 class CartDetailView(generics.RetrieveAPIView):
     serializer_class = CartSerializer
@@ -162,48 +359,12 @@ class CartDetailView(generics.RetrieveAPIView):
         return queryset
 
     def get(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-
-        # Initializations
-        total_shipping = 0.0
-        total_tax = 0.0
-        total_service_fee = 0.0
-        total_sub_total = 0.0
-        total_total = 0.0
-
-        # Iterate over the queryset of cart items to calculate cumulative sums
-        for cart_item in queryset:
-            # Calculate the cumulative shipping, tax, service_fee, and total values
-            total_shipping += float(self.calculate_shipping(cart_item))
-            total_tax += float(self.calculate_tax(cart_item))
-            total_service_fee += float(self.calculate_service_fee(cart_item))
-            total_sub_total += float(self.calculate_sub_total(cart_item))
-            total_total += round(float(self.calculate_total(cart_item)), 2)
-
-        data = {
-            'shipping': round(total_shipping, 2),
-            'tax': total_tax,
-            'service_fee': total_service_fee,
-            'sub_total': total_sub_total,
-            'total': total_total,
-        }
-
-        return Response(data)
-
-    def calculate_shipping(self, cart_item):
-        return cart_item.shipping_amount
-
-    def calculate_tax(self, cart_item):
-        return cart_item.tax_fee
-
-    def calculate_service_fee(self, cart_item):
-        return cart_item.service_fee
-
-    def calculate_sub_total(self, cart_item):
-        return cart_item.sub_total
-
-    def calculate_total(self, cart_item):
-        return cart_item.total
+        if self.kwargs.get('user_id') is None and cart_store.is_enabled():
+            carts = cart_store.get(self.kwargs['cart_id'])
+            if carts is not None:
+                return Response(cart_totals(carts))
+        # Summed by the database, as Decimals
+        return Response(self.get_queryset().totals())
 
 
 class CartItemDeleteView(generics.DestroyAPIView):
@@ -215,6 +376,15 @@ class CartItemDeleteView(generics.DestroyAPIView):
         item_id = self.kwargs['item_id']
         user_id = self.kwargs.get('user_id')
 
+        if user_id is None and cart_store.is_enabled():
+            # Cached items' ids are their product's
+            carts = cart_store.get(cart_id)
+            if carts is not None:
+                for cart in carts:
+                    if cart.pk == item_id:
+                        return cart
+                raise Http404
+
         if user_id is not None:
             user = User.objects.get(id=user_id)
             cart = Cart.objects.get(cart_id=cart_id, id=item_id, user=user)
@@ -223,6 +393,12 @@ class CartItemDeleteView(generics.DestroyAPIView):
 
         return cart
 
+    def perform_destroy(self, instance):
+        if instance._state.adding:
+            cart_store.remove(instance.cart_id, instance.product_id)
+        else:
+            instance.delete()
+
 
 class CreateOrderView(generics.CreateAPIView):
     serializer_class = CartOrderSerializer
@@ -249,6 +425,10 @@ class CreateOrderView(generics.CreateAPIView):
         else:
             user = None
 
+        if cart_store.is_enabled():
+            # Anonymous carts are only written to the table now
+            cart_store.materialize(cart_id)
+
         cart_items = Cart.objects.filter(cart_id=cart_id)
 
         total_shipping = Decimal(0.0)
@@ -307,13 +487,14 @@ class CreateOrderView(generics.CreateAPIView):
         return Response({"message": "Order Created Successfully", 'order_oid': order.oid}, status=status.HTTP_201_CREATED)
 
 
-class CheckoutView(generics.RetrieveAPIView):
+class CheckoutView(SparseFieldsetViewMixin, generics.RetrieveAPIView):
     serializer_class = CartOrderSerializer
     lookup_field = 'order_oid'
 
     def get_object(self):
         order_oid = self.kwargs['order_oid']
-        order = CartOrder.objects.get(oid=order_oid)
+        order = self.filter_queryset(
+            CartOrder.objects.all()).get(oid=order_oid)
         return order
 
 
@@ -590,7 +771,7 @@ class ReviewRatingAPIView(generics.CreateAPIView):
         return Response({"message": "Review Created Successfully."}, status=status.HTTP_201_CREATED)
 
 
-class ReviewListAPIView(generics.ListAPIView):
+class ReviewListAPIView(SparseFieldsetViewMixin, generics.ListAPIView):
     queryset = Review.objects.all()
     serializer_class = ReviewSerializer
     permission_classes = [AllowAny]
@@ -604,16 +785,40 @@ class ReviewListAPIView(generics.ListAPIView):
         return reviews
 
 
-class SearchProductsAPIView(generics.ListAPIView):
+class RelatedProductsAPIView(SparseFieldsetViewMixin, generics.ListAPIView):
+    serializer_class = ProductSerializer
+    permission_classes = [AllowAny]
+
+    def get_queryset(self):
+        # Frequently bought together, as ranked by build_related_products.
+        # The rank is annotated so keyset pagination can page through it.
+        return Product.objects.filter(
+            related_to__product__pid=self.kwargs['pid'],
+            status="published",
+        ).annotate(related_rank=F('related_to__rank')).order_by('related_rank')
+
+
+class SearchProductsAPIView(FacetedListMixin, SparseFieldsetViewMixin, generics.ListAPIView):
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
+    keyset_ordering = ('-date', '-id')
 
     def get_queryset(self):
         query = self.request.GET.get('query', '')
-        print("query ======", query)
 
-        products = Product.objects.filter(
-            Q(status="published") &
-            (Q(title__icontains=query) | Q(category__title__iexact=query))
-        )
-        return products
+        # Best matches first unless ?sort= asks for another order
+        products = search.search_products(
+            Product.objects.filter(status="published"), query)
+        return sort_products(products, self.request)
+
+
+class SearchSuggestAPIView(generics.GenericAPIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        # Search-as-you-type, answered from the in-memory prefix index
+        try:
+            limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        except ValueError:
+            limit = DEFAULT_LIMIT
+        return Response(suggest_index.suggest(request.GET.get('query', ''), max(limit, 1)))